@@ -1,29 +1,300 @@
 from flask import Flask, render_template, request, jsonify
 import cv2
 import numpy as np
-import tensorflow as tf
 from werkzeug.utils import secure_filename
 import os
 import hashlib
+import hmac
+import time
+import threading
 from datetime import datetime
 from blockchain import Blockchain  # Import blockchain module
+from ledger_verify import VerifyJobs
+from inference_queue import BatchingPredictor, DirectPredictor
+from inference_backends import create_backend
+from image_context import ImageContext, DecodeStats
+from feature_engine import image_features, center_features, as_dict
+from feature_rules import fruit_rules, rot_rules
+from fruit_segmentation import find_fruit_regions, crop_batch
+from upload_ingest import IngestRequest, HashingUploadBuffer
+from prediction_cache import PredictionCache, model_fingerprint, pipeline_fingerprint
+from model_artifact import PREPROCESSING_SPEC, artifact_fingerprint
+from single_flight import SingleFlight
+from cascade import CascadeStats
+from process_memory import read_smaps_rollup, worker_memory_report
+
+_APP_INIT_START = time.perf_counter()
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_IMAGE_BYTES'] = int(os.environ.get('FRUIT_MAX_IMAGE_BYTES', app.config['MAX_CONTENT_LENGTH']))
+# Uploads are processed in memory; set FRUIT_SAVE_UPLOADS=1 to keep a copy on disk for debugging
+app.config['SAVE_UPLOADS'] = os.environ.get('FRUIT_SAVE_UPLOADS', '0') == '1'
+
+# Stream uploads into memory, hashing and validating them as they arrive
+IngestRequest.max_image_bytes = app.config['MAX_IMAGE_BYTES']
+app.request_class = IngestRequest
+
+# Inference backend: 'keras' (.h5), 'tflite' (per-thread interpreter pool)
+# or 'mmap' (TFLite over the verified artifact written by export_mmap_model.py)
+app.config['INFERENCE_BACKEND'] = os.environ.get('FRUIT_BACKEND', 'keras')
+app.config['KERAS_MODEL_PATH'] = 'fruit_freshness_model.h5'
+app.config['TFLITE_MODEL_PATH'] = os.environ.get('FRUIT_TFLITE_MODEL_PATH', 'fruit_freshness_model.tflite')
+app.config['MMAP_MODEL_PATH'] = os.environ.get('FRUIT_MMAP_MODEL_PATH', 'fruit_freshness_model.fmm')
+app.config['TFLITE_POOL_SIZE'] = int(os.environ.get('FRUIT_TFLITE_POOL_SIZE', 4))  # one interpreter per worker thread
+app.config['TFLITE_THREADS'] = int(os.environ.get('FRUIT_TFLITE_THREADS', 1))  # XNNPACK threads per interpreter
+
+# Slim start-up: defer the TensorFlow import and model load to the first prediction (keras backend)
+app.config['LAZY_MODEL'] = os.environ.get('FRUIT_LAZY_MODEL', '0') == '1'
+# Warm the model up at start-up (synthetic fruit-like images, every batch size in use);
+# /ready answers 503 until this has finished
+app.config['WARMUP'] = os.environ.get('FRUIT_WARMUP', '1') == '1'
+app.config['WARMUP_PASSES'] = int(os.environ.get('FRUIT_WARMUP_PASSES', 2))
+
+# gunicorn preload_app: the master imports the app and loads fork-safe state only;
+# threads, interpreters and connections are recreated in each worker by after_fork()
+# (set by gunicorn.conf.py)
+app.config['PRELOAD'] = os.environ.get('FRUIT_PRELOAD', '0') == '1'
+# TensorFlow can't be forked, so a Keras model is loaded by every worker on its own. Under
+# preload the TFLite model (shared page cache) is used instead unless FRUIT_BACKEND says keras
+if app.config['PRELOAD'] and app.config['INFERENCE_BACKEND'] == 'keras':
+    if 'FRUIT_BACKEND' not in os.environ and os.path.exists(app.config['TFLITE_MODEL_PATH']):
+        app.config['INFERENCE_BACKEND'] = 'tflite'
+        print(f"[Startup] Preload: serving {app.config['TFLITE_MODEL_PATH']} (tflite) so workers share the weights")
+    else:
+        print("[Startup] WARNING: preload with the keras backend - every worker loads its own copy of the model; "
+              "set FRUIT_BACKEND=tflite or mmap to share the weights")
+
+# Micro-batching: gather up to N images or wait at most M ms per forward pass
+# (FRUIT_BATCHING=0 runs inference directly in each request thread)
+app.config['BATCHING_ENABLED'] = os.environ.get('FRUIT_BATCHING', '1') == '1'
+app.config['BATCH_MAX_SIZE'] = int(os.environ.get('FRUIT_BATCH_MAX_SIZE', 8))
+app.config['BATCH_MAX_WAIT_MS'] = float(os.environ.get('FRUIT_BATCH_MAX_WAIT_MS', 5))
+
+# Result cache keyed by image SHA-256 + model version + pipeline settings (size 0 disables it)
+app.config['MODEL_PATH'] = {
+    'tflite': app.config['TFLITE_MODEL_PATH'],
+    'mmap': app.config['MMAP_MODEL_PATH']
+}.get(app.config['INFERENCE_BACKEND'], app.config['KERAS_MODEL_PATH'])
+app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('FRUIT_CACHE_MAX_ENTRIES', 1024))
+app.config['CACHE_TTL_SECONDS'] = float(os.environ.get('FRUIT_CACHE_TTL_SECONDS', 0)) or None
+# Optional on-disk tier (SQLite file) that survives worker restarts
+app.config['CACHE_DISK_PATH'] = os.environ.get('FRUIT_CACHE_DISK_PATH') or None
+
+# Longest side (px) the OpenCV heuristics run at; larger uploads are analysed on a
+# pyramid level and size-dependent constants scale with it (0 = full resolution).
+# See calibrate_analysis_resolution.py for the decision drift per setting
+app.config['ANALYSIS_MAX_SIDE'] = int(os.environ.get('FRUIT_ANALYSIS_MAX_SIDE', 1024))
+# Worst-case bound for is_fruit_like: time budget per call (0 = none) and
+# how many large contours are approximated as polygons at most
+app.config['VALIDATOR_BUDGET_MS'] = float(os.environ.get('FRUIT_VALIDATOR_BUDGET_MS', 500))
+app.config['VALIDATOR_MAX_POLYGONS'] = int(os.environ.get('FRUIT_VALIDATOR_MAX_POLYGONS', 64))
+# Peak memory for the per-image heuristics; larger images are analysed in strips
+# (tiled_analysis.py) - matters with ANALYSIS_MAX_SIDE=0 or huge non-JPEG uploads
+app.config['ANALYSIS_MEMORY_MB'] = float(os.environ.get('FRUIT_ANALYSIS_MEMORY_MB', 96))
+# Decode oversized JPEG uploads at 1/2, 1/4 or 1/8 scale, just above ANALYSIS_MAX_SIDE
+app.config['REDUCED_DECODE'] = os.environ.get('FRUIT_REDUCED_DECODE', '1') == '1'
 
-# Create uploads folder if it doesn't exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Multi-fruit photos (opt-in with FRUIT_SEGMENTATION=1): every fruit region found in the
+# fruit-color mask is graded too; the crops share the whole image's batched model call
+# (regions smaller than SEGMENT_MIN_AREA of the image are ignored). Off by default: a
+# single fruit with strong color zones (half rotten) can still be split in two
+app.config['SEGMENTATION'] = os.environ.get('FRUIT_SEGMENTATION', '0') == '1'
+app.config['SEGMENT_MAX_FRUITS'] = int(os.environ.get('FRUIT_SEGMENT_MAX_FRUITS', 12))
+app.config['SEGMENT_MIN_AREA'] = float(os.environ.get('FRUIT_SEGMENT_MIN_AREA', 0.02))
+
+# Cascade: the model is skipped when the heuristics have decided - always on the rotten
+# override; on the fresh override only with FRUIT_CASCADE_FRESH_EXIT=1 (reported as
+# Fresh at CASCADE_FRESH_CONFIDENCE %, since the model no longer grades ripeness)
+app.config['CASCADE_FRESH_EXIT'] = os.environ.get('FRUIT_CASCADE_FRESH_EXIT', '0') == '1'
+app.config['CASCADE_FRESH_CONFIDENCE'] = float(os.environ.get('FRUIT_CASCADE_FRESH_CONFIDENCE', 90))
+# Optional tiny first-stage model (.tflite or .h5, same inputs and classes): its verdict is
+# kept when its top probability reaches TINY_MODEL_CONFIDENCE, otherwise the full model decides
+app.config['TINY_MODEL_PATH'] = os.environ.get('FRUIT_TINY_MODEL_PATH') or None
+app.config['TINY_MODEL_CONFIDENCE'] = float(os.environ.get('FRUIT_TINY_MODEL_CONFIDENCE', 0.9))
+
+# Concurrent identical uploads share one pipeline run; each still gets its own ledger block unless disabled
+app.config['LEDGER_COALESCED'] = os.environ.get('FRUIT_LEDGER_COALESCED', '1') == '1'
+# Ledger: append-only segment files in LEDGER_DIR (blockchain_data.json is migrated on first start);
+# fsync after every LEDGER_FSYNC_EVERY blocks and/or every LEDGER_FSYNC_MS milliseconds (0 = off)
+app.config['LEDGER_DIR'] = os.environ.get('FRUIT_LEDGER_DIR', 'ledger')
+app.config['LEDGER_FSYNC_EVERY'] = int(os.environ.get('FRUIT_LEDGER_FSYNC_EVERY', 1))
+app.config['LEDGER_FSYNC_MS'] = float(os.environ.get('FRUIT_LEDGER_FSYNC_MS', 0))
+app.config['LEDGER_SEGMENT_MB'] = float(os.environ.get('FRUIT_LEDGER_SEGMENT_MB', 64))
+# Chain checks only verify blocks added since the last one; every LEDGER_DEEP_VERIFY_S seconds
+# (0 = never) a background audit (ledger_verify.py) re-verifies the whole chain, as does
+# /blockchain/verify?deep=1 in the request
+app.config['LEDGER_DEEP_VERIFY_S'] = float(os.environ.get('FRUIT_LEDGER_DEEP_VERIFY_S', 86400))
+# Processes for full-ledger audits started at /admin/ledger/verify (0 = one per CPU)
+app.config['LEDGER_VERIFY_WORKERS'] = int(os.environ.get('FRUIT_LEDGER_VERIFY_WORKERS', 0)) or None
+
+# /admin/* endpoints require this token in the X-Admin-Token header (unset = admin endpoints disabled)
+app.config['ADMIN_TOKEN'] = os.environ.get('FRUIT_ADMIN_TOKEN') or None
+
+# Create uploads folder only when debug copies are enabled
+if app.config['SAVE_UPLOADS']:
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+def record_ledger_audit(result):
+    """A full audit's result is this worker's deep chain check (passed or failed)"""
+    if result['is_valid']:
+        blockchain.record_deep_verification(result['last_index'], result['last_hash'])
+    else:
+        blockchain.record_audit_failure(result['first_invalid_index'], result['reason'])
+
+def start_scheduled_audit():
+    """
+    The scheduled deep check runs as a background audit, never inside a request
+    - An audit finished since this worker's last deep check (another worker may
+      have started it) is used instead of starting a new one
+    """
+    latest = verify_jobs.latest_finished()
+    if latest is not None and latest['finished_at'] > blockchain.watermark['deep_verified_at']:
+        record_ledger_audit(latest['result'])
+        if blockchain.audit_failure is not None or blockchain.watermark['deep_verified_at'] >= latest['finished_at']:
+            return
+    verify_jobs.start()
 
-blockchain = Blockchain()
+blockchain = Blockchain(
+    storage_dir=app.config['LEDGER_DIR'],
+    fsync_every=app.config['LEDGER_FSYNC_EVERY'],
+    fsync_interval_ms=app.config['LEDGER_FSYNC_MS'],
+    segment_max_bytes=int(app.config['LEDGER_SEGMENT_MB'] * 1024 * 1024),
+    deep_verify_interval_s=app.config['LEDGER_DEEP_VERIFY_S'],
+    on_deep_verify_due=start_scheduled_audit
+)
 
-# Load the trained model
-model = None
+verify_jobs = VerifyJobs(app.config['LEDGER_DIR'], workers=app.config['LEDGER_VERIFY_WORKERS'], on_done=record_ledger_audit)
+
+MODEL_INPUT_SIZE = PREPROCESSING_SPEC['input_size']
+
+# Load the trained model through the configured backend
+backend = None
 try:
-    model = tf.keras.models.load_model('fruit_freshness_model.h5')
-    print("Model loaded successfully!")
-except:
-    print("Model not found. Please train the model first by running train_model.py")
+    backend = create_backend(
+        app.config['INFERENCE_BACKEND'],
+        app.config['KERAS_MODEL_PATH'],
+        app.config['TFLITE_MODEL_PATH'],
+        pool_size=app.config['TFLITE_POOL_SIZE'],
+        num_threads=app.config['TFLITE_THREADS'],
+        lazy=app.config['LAZY_MODEL'],
+        preload=app.config['PRELOAD'],
+        mmap_model_path=app.config['MMAP_MODEL_PATH']
+    )
+    if backend.loaded:
+        print(f"Model loaded successfully! (backend: {backend.name}, runtime: {backend.runtime})")
+    else:
+        print(f"Model will load on first prediction (backend: {backend.name})")
+except Exception as e:
+    print(f"Model not found ({e}). Please train the model first by running train_model.py")
+
+tiny_backend = None
+if app.config['TINY_MODEL_PATH']:
+    try:
+        tiny_backend = create_backend(
+            'tflite' if app.config['TINY_MODEL_PATH'].endswith('.tflite') else 'keras',
+            app.config['TINY_MODEL_PATH'],
+            app.config['TINY_MODEL_PATH'],
+            pool_size=app.config['TFLITE_POOL_SIZE'],
+            num_threads=app.config['TFLITE_THREADS'],
+            lazy=app.config['LAZY_MODEL'],
+            preload=app.config['PRELOAD']
+        )
+        print(f"Tiny first-stage model: {app.config['TINY_MODEL_PATH']} (backend: {tiny_backend.name})")
+    except Exception as e:
+        print(f"Tiny model not available ({e}) - every image goes to the full model")
+
+# Settings besides the model that change a verdict - part of every cache key
+PIPELINE_SETTINGS = [
+    'ANALYSIS_MAX_SIDE', 'ANALYSIS_MEMORY_MB', 'REDUCED_DECODE', 'VALIDATOR_MAX_POLYGONS',
+    'SEGMENTATION', 'SEGMENT_MAX_FRUITS', 'SEGMENT_MIN_AREA',
+    'CASCADE_FRESH_EXIT', 'CASCADE_FRESH_CONFIDENCE', 'TINY_MODEL_CONFIDENCE'
+]
+
+def pipeline_version():
+    """Hash of PIPELINE_SETTINGS and the tiny model in use (its file hash, not just its path)"""
+    settings = {name: app.config[name] for name in PIPELINE_SETTINGS}
+    settings['tiny_model'] = model_fingerprint(app.config['TINY_MODEL_PATH']) if tiny_backend is not None else None
+    return pipeline_fingerprint(settings)
+
+prediction_cache = PredictionCache(
+    app.config['MODEL_PATH'],
+    max_entries=app.config['CACHE_MAX_ENTRIES'],
+    ttl_seconds=app.config['CACHE_TTL_SECONDS'],
+    disk_path=app.config['CACHE_DISK_PATH'],
+    # The artifact carries its own content hash - no need to re-read the weights
+    fingerprint=artifact_fingerprint if app.config['INFERENCE_BACKEND'] == 'mmap' else model_fingerprint,
+    pipeline_version=pipeline_version()
+)
+
+in_flight = SingleFlight()
+decode_stats = DecodeStats()
+cascade_stats = CascadeStats()
+
+def create_predictor():
+    """Batching (or direct) front-end for the backend - owns a thread, so it is per process"""
+    if backend is None:
+        return None
+    if app.config['BATCHING_ENABLED']:
+        return BatchingPredictor(
+            backend.predict_batch,
+            max_batch_size=app.config['BATCH_MAX_SIZE'],
+            max_wait_ms=app.config['BATCH_MAX_WAIT_MS']
+        )
+    return DirectPredictor(backend.predict_batch)
+
+def create_tiny_predictor():
+    """The tiny model runs in the request thread - it is only worth it if it is cheap"""
+    return DirectPredictor(tiny_backend.predict_batch) if tiny_backend is not None else None
+
+predictor = None
+tiny_predictor = None
+if not app.config['PRELOAD']:
+    predictor = create_predictor()
+    if predictor is not None:
+        predictor.start()
+    tiny_predictor = create_tiny_predictor()
+
+def startup_report():
+    """Start-up cost broken down into runtime import, model load and warmup"""
+    timings = getattr(backend, 'timings', {}) if backend is not None else {}
+    return {
+        'backend': backend.name if backend is not None else None,
+        'runtime': getattr(backend, 'runtime', None),
+        'import_s': timings.get('import_s'),
+        'model_load_s': timings.get('model_load_s'),
+        'warmup_s': STARTUP_TIMINGS.get('warmup_s'),
+        'app_init_s': STARTUP_TIMINGS.get('app_init_s')
+    }
+
+STARTUP_TIMINGS = {'warmup_s': None, 'app_init_s': None}
+READINESS = {'ready': False, 'status': 'starting'}
+
+def after_fork():
+    """
+    Recreate per-process runtime state in a freshly forked gunicorn worker
+    - Threads don't survive fork(): new batching thread and single-flight table
+    - TFLite interpreters, the SQLite cache connection and the ledger files are reopened
+    - Imported modules and the Flask app stay shared copy-on-write; TFLite/mmap model
+      files are shared through the page cache. A Keras model is not shared: TensorFlow
+      can't be forked, so each worker loads its own copy
+    """
+    global predictor, tiny_predictor, in_flight, decode_stats, cascade_stats
+    if backend is not None:
+        backend.reset_after_fork()
+    if tiny_backend is not None:
+        tiny_backend.reset_after_fork()
+    prediction_cache.reset_after_fork()
+    blockchain.reset_after_fork()
+    in_flight = SingleFlight()
+    decode_stats = DecodeStats()
+    cascade_stats = CascadeStats()
+    predictor = create_predictor()
+    if predictor is not None:
+        predictor.start()
+    tiny_predictor = create_tiny_predictor()
+    start_warmup()
 
 FRESHNESS_LEVELS = [
     'Fresh',
@@ -66,21 +337,17 @@ FRESHNESS_INFO = {
     }
 }
 
-def preprocess_image(image_path):
+def preprocess_image(image):
     """
     Preprocess image using OpenCV
-    - Read image
+    - Read image (file path or an already decoded ImageContext)
     - Resize to model input size
     - Normalize pixel values
     """
-    # Read image using OpenCV
-    img = cv2.imread(image_path)
-    
-    # Convert BGR to RGB (OpenCV reads in BGR format)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    ctx = ImageContext.from_source(image)
     
-    # Resize image to 128x128 (model input size)
-    img_resized = cv2.resize(img, (128, 128))
+    # RGB image resized to 128x128 (model input size)
+    img_resized = ctx.resized_rgb(MODEL_INPUT_SIZE)
     
     # Normalize pixel values to [0, 1]
     img_normalized = img_resized.astype('float32') / 255.0
@@ -90,391 +357,144 @@ def preprocess_image(image_path):
     
     return img_batch
 
-def calculate_image_hash(image_path):
+def calculate_image_hash(image):
     """Calculate SHA-256 hash of the image file"""
-    with open(image_path, 'rb') as f:
+    if isinstance(image, ImageContext) and image.raw is not None:
+        return image.sha256()
+    with open(image, 'rb') as f:
         return hashlib.sha256(f.read()).hexdigest()
 
-def detect_rotten_features(image_path):
+def detect_rotten_features(image):
     """
     Advanced rotten detection based on visual features
+    Accepts a file path or an ImageContext shared with the other stages
+    Scores the center-region feature vector (feature_engine) with
+    feature_rules.rot_rules; images too large for ANALYSIS_MEMORY_MB are
+    measured strip by strip
     Returns: (is_rotten: bool, rot_score: float, details: dict)
     """
-    img = cv2.imread(image_path)
-    if img is None:
+    ctx = ImageContext.from_source(image)
+    if not ctx.is_valid:
         return False, 0, {}
-    
-    h, w = img.shape[:2]
+    ctx = ctx.working(app.config['ANALYSIS_MAX_SIDE'])
     
     # FOCUS ON CENTER REGION (70% of image) to avoid background noise
-    center_h_start = int(h * 0.15)
-    center_h_end = int(h * 0.85)
-    center_w_start = int(w * 0.15)
-    center_w_end = int(w * 0.85)
-    
-    img_center = img[center_h_start:center_h_end, center_w_start:center_w_end]
-    
-    img_hsv = cv2.cvtColor(img_center, cv2.COLOR_BGR2HSV)
-    gray = cv2.cvtColor(img_center, cv2.COLOR_BGR2GRAY)
-    
-    total_pixels = img_center.shape[0] * img_center.shape[1]
-    
-    h_channel = img_hsv[:, :, 0]
-    s_channel = img_hsv[:, :, 1]
-    v_channel = img_hsv[:, :, 2]
-    
-    b_channel = img_center[:, :, 0]
-    g_channel = img_center[:, :, 1]
-    r_channel = img_center[:, :, 2]
+    features = center_features(ctx, budget_bytes=app.config['ANALYSIS_MEMORY_MB'] * 1024 * 1024)
+    result = as_dict(rot_rules(features))
+    f = as_dict(features)
     
-    rot_indicators = {}
-    rot_score = 0
-    
-    # PRE-CHECK: Verify there's actual fruit color (not just dark background)
-    fruit_color_pixels = np.sum(
-        (((h_channel <= 10) | (h_channel >= 160)) & (s_channel >= 40) & (v_channel >= 50)) |  # Red
-        ((h_channel >= 5) & (h_channel <= 35) & (s_channel >= 40) & (v_channel >= 50)) |  # Orange/Yellow
-        ((h_channel >= 35) & (h_channel <= 90) & (s_channel >= 40) & (v_channel >= 50))  # Green
-    )
-    fruit_color_ratio = fruit_color_pixels / total_pixels
-    rot_indicators['fruit_color_ratio'] = fruit_color_ratio * 100
-    
-    # DETECT GROUP FRUITS (high fruit color = multiple fruits)
-    is_group_fruit = fruit_color_ratio > 0.50  # 50%+ fruit color = likely group
-    rot_indicators['is_group_fruit'] = is_group_fruit
-    
-    # Check overall image quality
-    avg_brightness_check = np.mean(v_channel)
-    
-    # Strong penalties for poor quality images
-    if fruit_color_ratio < 0.15 or avg_brightness_check < 80:
-        rot_indicators['warning'] = 'Poor image quality or insufficient fruit visible'
+    rot_indicators = {
+        'fruit_color_ratio': f['fruit_color_ratio'] * 100,
+        'is_group_fruit': result['is_group_fruit']
+    }
+    if result['poor_quality']:
         # These are likely bad images, not rotten fruit - return NOT rotten
+        rot_indicators['warning'] = 'Poor image quality or insufficient fruit visible'
         return False, 0, rot_indicators
-    elif fruit_color_ratio < 0.25:
+    if result['background_penalty']:
         rot_indicators['warning'] = 'Some background detected'
-        background_penalty = True
-    else:
-        background_penalty = False
-    
-    # 1. DARK SPOTS - Adjusted thresholds for group fruits
-    # Group fruits have shadows between them - use stricter thresholds
-    very_dark = np.sum((b_channel < 40) & (g_channel < 40) & (r_channel < 40))  # Stricter: 40 instead of 50
-    dark = np.sum((b_channel < 70) & (g_channel < 70) & (r_channel < 70))  # Stricter: 70 instead of 80
-    
-    very_dark_ratio = very_dark / total_pixels
-    dark_ratio = dark / total_pixels
-    
-    rot_indicators['very_dark_spots'] = very_dark_ratio * 100
-    rot_indicators['dark_spots'] = dark_ratio * 100
-    
-    # Relaxed thresholds for group fruits (shadows are normal)
-    if is_group_fruit:
-        if very_dark_ratio > 0.10:  # 10%+ for groups (doubled)
-            rot_score += 40
-        elif dark_ratio > 0.15:  # 15%+ for groups
-            rot_score += 30
-        elif dark_ratio > 0.08:  # 8%+ for groups
-            rot_score += 20
-    else:
-        if very_dark_ratio > 0.05:  # 5%+ very dark = strong rot
-            rot_score += 40
-        elif dark_ratio > 0.08:  # 8%+ dark = moderate rot
-            rot_score += 30
-        elif dark_ratio > 0.03:  # 3%+ dark = early rot
-            rot_score += 20
-    
-    # 2. BROWN/MUDDY COLORS - Multiple brown ranges
-    # Dark brown (deep rot)
-    dark_brown = np.sum(
-        (h_channel >= 5) & (h_channel <= 25) &
-        (s_channel >= 30) & (s_channel <= 255) &
-        (v_channel >= 15) & (v_channel <= 100)
-    )
-    # Medium brown (rotting)
-    med_brown = np.sum(
-        (h_channel >= 5) & (h_channel <= 30) &
-        (s_channel >= 25) & (s_channel <= 180) &
-        (v_channel >= 80) & (v_channel <= 150)
-    )
     
-    brown_ratio = (dark_brown + med_brown) / total_pixels
-    rot_indicators['brown_areas'] = brown_ratio * 100
-    
-    if brown_ratio > 0.12:
-        rot_score += 35
-    elif brown_ratio > 0.06:
-        rot_score += 25
-    elif brown_ratio > 0.03:
-        rot_score += 15
-    
-    # 3. WRINKLED/SHRIVELED TEXTURE
-    laplacian = cv2.Laplacian(gray, cv2.CV_64F)
-    texture_variance = np.var(laplacian)
-    rot_indicators['texture_variance'] = texture_variance
-    
-    if texture_variance > 1500:  # Very rough = rot
-        rot_score += 20
-    
-    # 4. LOW OVERALL BRIGHTNESS (rotting darkens fruit)
-    avg_brightness = np.mean(v_channel)
-    rot_indicators['avg_brightness'] = avg_brightness
-    
-    if avg_brightness < 80:
-        rot_score += 25
-    elif avg_brightness < 120:
-        rot_score += 15
-    
-    # 5. MOLD - Grayish discoloration
-    mold_pixels = np.sum(
-        (s_channel < 60) &  # Low saturation (gray)
-        (v_channel > 60) & (v_channel < 200)
-    )
-    mold_ratio = mold_pixels / total_pixels
-    rot_indicators['mold_areas'] = mold_ratio * 100
-    
-    if mold_ratio > 0.25:
-        rot_score += 25
-    elif mold_ratio > 0.15:
-        rot_score += 15
-    
-    # 6. BRIGHTNESS VARIATION (rot creates blotchy patches)
-    # Group fruits naturally have variation between different fruits
-    brightness_std = np.std(v_channel)
-    rot_indicators['brightness_std'] = brightness_std
-    
-    if is_group_fruit:
-        # Group fruits: only extreme variation is concerning
-        if brightness_std > 90:  # Very extreme
-            rot_score += 15
-        elif brightness_std > 75:
-            rot_score += 8
-    else:
-        if brightness_std > 70:  # Very uneven = rot patches
-            rot_score += 20
-        elif brightness_std > 50:
-            rot_score += 10
-    
-    # 7. COLOR DESATURATION (rot dulls colors)
-    avg_saturation = np.mean(s_channel)
-    rot_indicators['avg_saturation'] = avg_saturation
-    
-    if avg_saturation < 50:  # Very dull
-        rot_score += 15
-    elif avg_saturation < 70:  # Somewhat dull
-        rot_score += 8
-    
-    # 8. BROWNISH HUE DOMINANCE
-    brown_hue_pixels = np.sum((h_channel >= 8) & (h_channel <= 28))
-    brown_hue_ratio = brown_hue_pixels / total_pixels
-    rot_indicators['brown_hue_dominance'] = brown_hue_ratio * 100
-    
-    if brown_hue_ratio > 0.30:  # 30%+ brown hue
-        rot_score += 20
-    elif brown_hue_ratio > 0.20:
-        rot_score += 10
-    
-    # 9. SPOT DETECTION - Find concentrated dark/brown spots (rot typically starts in patches)
-    kernel = np.ones((5,5), np.uint8)
-    dark_mask = ((b_channel < 60) & (g_channel < 60) & (r_channel < 60)).astype(np.uint8)  # Stricter: 60 instead of 70
-    dark_dilated = cv2.dilate(dark_mask, kernel, iterations=2)
-    num_dark_spots = cv2.connectedComponents(dark_dilated)[0] - 1  # -1 for background
-    
-    rot_indicators['dark_spot_count'] = num_dark_spots
-    
-    # Group fruits: gaps between fruits create "spots" - ignore unless excessive
-    if is_group_fruit:
-        if num_dark_spots > 10:  # Allow more spots for groups
-            rot_score += 15
-        elif num_dark_spots > 6:
-            rot_score += 8
-    else:
-        if num_dark_spots > 5:  # Multiple dark spots = spreading rot
-            rot_score += 20
-        elif num_dark_spots > 2:
-            rot_score += 10
-    
-    # 10. SOFTNESS INDICATOR - Low contrast = mushy/soft texture
-    contrast = np.max(v_channel) - np.min(v_channel)
-    rot_indicators['contrast'] = contrast
-    if contrast < 100:  # Very low contrast = soft/mushy
-        rot_score += 15
-    
-    # APPLY BACKGROUND PENALTY
-    if background_penalty:
-        rot_score = int(rot_score * 0.6)  # Reduce score by 40% if too much background
+    rot_indicators.update({
+        'very_dark_spots': f['very_dark_ratio'] * 100,
+        'dark_spots': f['dark_ratio'] * 100,
+        'brown_areas': f['brown_ratio'] * 100,
+        'texture_variance': f['texture_variance'],
+        'avg_brightness': f['avg_brightness'],
+        'mold_areas': f['mold_ratio'] * 100,
+        'brightness_std': f['brightness_std'],
+        'avg_saturation': f['avg_saturation'],
+        'brown_hue_dominance': f['brown_hue_ratio'] * 100,
+        'dark_spot_count': f['num_dark_spots'],
+        'contrast': f['contrast']
+    })
+    if result['background_penalty']:
         rot_indicators['background_penalty_applied'] = True
-    
-    # DECISION: Higher threshold for rotten classification
-    # Group fruits need higher threshold to avoid false positives
-    threshold = 70 if is_group_fruit else 60
-    
-    # FRESH FRUIT OVERRIDE: If bright, colorful, and high saturation = NOT rotten
-    # Even if shadows/gaps score high
-    is_clearly_fresh = (
-        avg_brightness > 130 and  # Bright
-        avg_saturation > 100 and  # Saturated colors
-        fruit_color_ratio > 0.70 and  # Lots of fruit visible
-        brown_ratio < 0.40  # Not too much brown
-    )
-    
-    if is_clearly_fresh:
-        is_rotten = False
+    if result['fresh_override']:
         rot_indicators['fresh_override'] = True
-        print(f"[Fresh Override] Bright:{avg_brightness:.0f}, Sat:{avg_saturation:.0f}, FruitColor:{fruit_color_ratio*100:.0f}%")
-    else:
-        is_rotten = rot_score >= threshold
+        print(f"[Fresh Override] Bright:{f['avg_brightness']:.0f}, Sat:{f['avg_saturation']:.0f}, FruitColor:{f['fruit_color_ratio']*100:.0f}%")
     
-    rot_indicators['threshold_used'] = threshold
+    rot_indicators['threshold_used'] = result['threshold']
+    rot_indicators['final_score'] = result['rot_score']
     
-    rot_indicators['final_score'] = rot_score
-    
-    return is_rotten, rot_score, rot_indicators
+    return result['is_rotten'], result['rot_score'], rot_indicators
 
-def is_fruit_like(image_path):
+def is_fruit_like(image, budget_ms=None, report=None):
     """
     OPTIMIZED fruit detection - Fast, accurate, handles all cases
+    Accepts a file path or an ImageContext shared with the other stages
+    Scores the whole-image feature vector (feature_engine) with
+    feature_rules.fruit_rules. Bounded cost:
+    - Contours are prefiltered by area in one vectorized step, at most
+      VALIDATOR_MAX_POLYGONS are approximated, and the scan stops at 2 rectangles
+    - HoughLinesP only runs when its result can change the decision
+    - budget_ms (default VALIDATOR_BUDGET_MS) cuts the polygon scan and Hough
+      short once spent; pass a dict as report to see what ran and what was cut
+      (report['budget_exceeded'] - the verdict then depends on timing)
     Returns: (is_fruit: bool, confidence: float, reason: str)
     """
-    img = cv2.imread(image_path)
-    if img is None:
+    start = time.perf_counter()
+    if budget_ms is None:
+        budget_ms = app.config['VALIDATOR_BUDGET_MS']
+    deadline = start + budget_ms / 1000.0 if budget_ms else None
+    if report is None:
+        report = {}
+    report.update({'truncated': [], 'skipped': [], 'early_exit': None})
+    
+    ctx = ImageContext.from_source(image)
+    if not ctx.is_valid:
         return False, 0, "Unable to read image"
+    ctx = ctx.working(app.config['ANALYSIS_MAX_SIDE'])
     
-    h, w = img.shape[:2]
-    total_pixels = h * w
-    
-    img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    features = image_features(ctx, budget_bytes=app.config['ANALYSIS_MEMORY_MB'] * 1024 * 1024,
+                              max_polygons=app.config['VALIDATOR_MAX_POLYGONS'], deadline=deadline, report=report)
+    result = as_dict(fruit_rules(features))
+    report['elapsed_ms'] = (time.perf_counter() - start) * 1000.0
+    report['budget_exceeded'] = any(stage.endswith('(budget)') for stage in report['truncated'])
     
-    # ===== LAYER 1: HARD REJECTS (Fast elimination) =====
+    if result['early_exit']:
+        report['early_exit'] = result['early_exit']
+        return False, 0, result['reason']
     
-    # Check unique colors
-    unique_colors = len(np.unique(img.reshape(-1, img.shape[2]), axis=0))
-    if unique_colors < 50:
-        return False, 0, "Simple graphic"
+    f = as_dict(features)
+    print(f"[Fruit Detection] Score: {result['score']}/100 | Is Fruit: {result['is_fruit']}")
+    print(f"[Details] Colors:{f['fruit_color_ratio']*100:.1f}% | Rectangles:{f['rectangular_objects']} | EdgeRatio:{f['edge_ratio']*100:.1f}%")
+    if report['truncated']:
+        print(f"[Fruit Detection] Cut short: {', '.join(report['truncated'])} ({report['elapsed_ms']:.0f} ms)")
     
-    # Calculate edges FIRST (needed by multiple checks)
-    edges = cv2.Canny(gray, 100, 200)
-    edge_ratio = np.sum(edges > 0) / total_pixels
-    
-    # Detect rectangles and squares (boxes, packages, screens, books)
-    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    
-    rectangular_objects = 0
-    for contour in contours:
-        area = cv2.contourArea(contour)
-        if area < 500:  # Ignore tiny contours
-            continue
-        
-        # Approximate contour to polygon
-        peri = cv2.arcLength(contour, True)
-        approx = cv2.approxPolyDP(contour, 0.04 * peri, True)
-        
-        # Check if it's a rectangle/square (4 corners)
-        if len(approx) == 4:
-            x, y, w, h = cv2.boundingRect(approx)
-            aspect_ratio = float(w) / h if h > 0 else 0
-            
-            # Rectangle or square (aspect ratio between 0.5 and 2.0)
-            if 0.5 <= aspect_ratio <= 2.0 and area > (total_pixels * 0.05):
-                rectangular_objects += 1
-    
-    # Reject if multiple large rectangles/squares detected (packaging, screens)
-    if rectangular_objects >= 2:
-        return False, 0, "Rectangular objects detected (boxes/packages/screens)"
-    
-    # Check for metallic/reflective surfaces (cars, bikes)
-    hist_peaks = np.histogram(gray, bins=256)[0]
-    has_metallic_peaks = np.max(hist_peaks) > (total_pixels * 0.2)
-    
-    if has_metallic_peaks and edge_ratio > 0.20:
-        return False, 0, "Metallic vehicle surface"
-    
-    # Check for very sharp mechanical edges
-    if edge_ratio > 0.30:
-        return False, 0, "Mechanical object (too many sharp edges)"
-    
-    # Check for artificial straight lines (vehicle frames)
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=80, minLineLength=50, maxLineGap=10)
-    num_lines = len(lines) if lines is not None else 0
-    if num_lines > 30 and edge_ratio > 0.15:
-        return False, 0, "Artificial structure detected"
-    
-    # ===== LAYER 2: FRUIT COLOR ANALYSIS (Generous ranges) =====
-    
-    h_channel = img_hsv[:, :, 0]
-    s_channel = img_hsv[:, :, 1]
-    v_channel = img_hsv[:, :, 2]
-    
-    # All fruit colors including brown for rotten
-    fruit_pixels = (
-        # Red
-        ((h_channel <= 10) | (h_channel >= 160)) & (s_channel >= 30) & (v_channel >= 30) |
-        # Orange  
-        ((h_channel >= 5) & (h_channel <= 25) & (s_channel >= 30) & (v_channel >= 30)) |
-        # Yellow
-        ((h_channel >= 20) & (h_channel <= 40) & (s_channel >= 25) & (v_channel >= 30)) |
-        # Green
-        ((h_channel >= 35) & (h_channel <= 90) & (s_channel >= 25) & (v_channel >= 30)) |
-        # Brown/dark (rotten)
-        ((h_channel >= 5) & (h_channel <= 30) & (s_channel >= 20) & (v_channel >= 15) & (v_channel <= 150))
-    )
-    
-    fruit_color_ratio = np.sum(fruit_pixels) / total_pixels
-    
-    # ===== LAYER 3: TEXTURE & NATURALNESS =====
-    
-    laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
-    has_texture = 80 < laplacian_var < 3000
-    
-    brightness_std = np.std(v_channel)
-    has_shading = brightness_std > 20
-    
-    if brightness_std < 10:
-        return False, 0, "Uniform fill"
-    
-    # ===== SCORING =====
-    
-    score = 0
-    
-    # Give MORE credit for high fruit color (important for group fruits)
-    if fruit_color_ratio >= 0.60:  # 60%+ fruit color = definitely fruit
-        score += 50
-    elif fruit_color_ratio >= 0.30:
-        score += 40
-    elif fruit_color_ratio >= 0.15:
-        score += 25
-    elif fruit_color_ratio >= 0.08:
-        score += 10
-    
-    if has_texture:
-        score += 25
-    if has_shading:
-        score += 20
-    if unique_colors > 500:
-        score += 15
-    elif unique_colors > 150:
-        score += 10
-    # Circles are fine for group fruits - no penalty
-    if edge_ratio < 0.08:
-        score += 10
-    
-    # ===== DECISION =====
-    is_fruit = (
-        score >= 40 and  # Lowered from 45 for better fruit acceptance
-        fruit_color_ratio >= 0.06 and  # Lowered from 0.08 for dark rotten fruits
-        rectangular_objects < 2 and  # Reject if 2+ rectangles (packaging/boxes)
-        edge_ratio < 0.30 and  # Increased tolerance
-        (num_lines <= 30 or edge_ratio < 0.15)  # Lines OK if edges are low
-    )
+    return result['is_fruit'], result['confidence'], result['reason']
+
+def load_upload(file, filename):
+    """
+    Build the request's ImageContext from the uploaded file without touching disk
+    - The SHA-256 was computed while the body streamed in (HashingUploadBuffer)
+    - A debug copy is written to UPLOAD_FOLDER only when SAVE_UPLOADS is on
+    """
+    target_side = app.config['ANALYSIS_MAX_SIDE'] if app.config['REDUCED_DECODE'] else None
+    if isinstance(file.stream, HashingUploadBuffer):
+        image = ImageContext.from_bytes(file.stream.getbuffer(), sha256=file.stream.hexdigest(), target_side=target_side)
+    else:
+        image = ImageContext.from_bytes(file.read(), target_side=target_side)
     
-    confidence = min(100, max(0, score))
-    reason = f"Score:{score}, Colors:{fruit_color_ratio*100:.0f}%, Rectangles:{rectangular_objects}"
+    if image.is_valid:
+        decode_stats.record(image)
+        print(f"[Upload] Decoded {image.shape[1]}x{image.shape[0]} at 1/{image.reduction} in {image.decode_ms:.1f} ms")
     
-    print(f"[Fruit Detection] Score: {score}/100 | Is Fruit: {is_fruit}")
-    print(f"[Details] Colors:{fruit_color_ratio*100:.1f}% | Rectangles:{rectangular_objects} | EdgeRatio:{edge_ratio*100:.1f}%")
+    if app.config['SAVE_UPLOADS']:
+        # Prefix with the content hash so concurrent uploads named image.jpg don't collide
+        debug_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{image.sha256()[:16]}_{filename}")
+        with open(debug_path, 'wb') as f:
+            f.write(image.raw)
+        print(f"[Upload] Debug copy saved to {debug_path}")
     
-    return is_fruit, confidence, reason
+    return image
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'error': '⚠️ Image is too large. Please upload a smaller photo.'}), 413
+
+@app.errorhandler(415)
+def upload_not_image(e):
+    return jsonify({'error': '⚠️ Unsupported file type. Please upload a JPG, PNG or WebP photo.'}), 415
 
 @app.route('/')
 def index():
@@ -482,6 +502,210 @@ def index():
                          freshness_levels=FRESHNESS_LEVELS,
                          freshness_info=FRESHNESS_INFO)
 
+def segment_fruits(image):
+    """
+    Fruit regions of a multi-fruit photo and their model inputs
+    Returns: (regions, crops) - ([], None) when segmentation is off or fewer than 2 fruits are found
+    """
+    if not app.config['SEGMENTATION']:
+        return [], None
+    ctx = ImageContext.from_source(image).working(app.config['ANALYSIS_MAX_SIDE'])
+    regions = find_fruit_regions(ctx, min_area=app.config['SEGMENT_MIN_AREA'],
+                                 max_regions=app.config['SEGMENT_MAX_FRUITS'])
+    if len(regions) < 2:
+        return [], None
+    return regions, crop_batch(ctx, regions, MODEL_INPUT_SIZE)
+
+def grade_fruits(regions, predictions):
+    """
+    Per-fruit freshness (model verdict per crop, bounding boxes in upload pixels)
+    plus an aggregate verdict over all fruits
+    """
+    fruits = []
+    for region, probs in zip(regions, predictions):
+        idx = int(np.argmax(probs))
+        level = FRESHNESS_LEVELS[idx]
+        fruits.append({
+            'bbox': region['bbox'],
+            'freshness_level': level,
+            'confidence': min(float(probs[idx]) * 100, 100.0),
+            'color': FRESHNESS_INFO[level]['color']
+        })
+    
+    counts = {level: 0 for level in FRESHNESS_LEVELS}
+    for fruit in fruits:
+        counts[fruit['freshness_level']] += 1
+    # Most common level; ties go to the less fresh one
+    majority = max(reversed(FRESHNESS_LEVELS), key=lambda level: counts[level])
+    worst = max(FRESHNESS_LEVELS.index(fruit['freshness_level']) for fruit in fruits)
+    
+    aggregate = {
+        'fruit_count': len(fruits),
+        'counts': {level: count for level, count in counts.items() if count},
+        'majority_level': majority,
+        'worst_level': FRESHNESS_LEVELS[worst],
+        'rotten_share': counts['Rotten'] / len(fruits)
+    }
+    return fruits, aggregate
+
+def verdict_predictions(class_idx, confidence, remainder_idx):
+    """Probabilities for a verdict reached without the model: confidence% on the class, the rest on remainder_idx"""
+    predictions = np.zeros((1, len(FRESHNESS_LEVELS)))
+    predictions[0][class_idx] = confidence / 100.0
+    predictions[0][remainder_idx] = (100 - confidence) / 100.0
+    return predictions
+
+def classify_image(image, filename, report=None):
+    """
+    Run the vision pipeline and the model on one decoded upload
+    - report (optional dict) gets the validator's report under 'validator'
+    Returns: (status_code: int, result: dict) - result is either the freshness
+    verdict or an {'error': ...} body, and never depends on the ledger
+    """
+    # CASCADE: stages run cheapest first and the first confident verdict wins;
+    # the CNN only runs when the heuristics have not decided
+    stage_ms = {}
+    if report is None:
+        report = {}
+    report['validator'] = {}
+    
+    # PRE-CHECK: Verify it's actually a fruit
+    start = time.perf_counter()
+    is_fruit, fruit_confidence, reason = is_fruit_like(image, report=report['validator'])
+    stage_ms['validator'] = (time.perf_counter() - start) * 1000.0
+    
+    print(f"[Upload] File: {filename} | Fruit Check: {is_fruit} (Score: {fruit_confidence}/100)")
+    
+    if not is_fruit:
+        print(f"[REJECTED] Not a fruit - {reason}")
+        cascade_stats.record(stage_ms, 'validator_reject')
+        return 400, {
+            'error': '⚠️ This is not a fruit image! Please upload a real fruit photo.'
+        }
+    
+    # CHECK FOR ROTTEN FEATURES FIRST
+    start = time.perf_counter()
+    is_rotten, rot_score, rot_details = detect_rotten_features(image)
+    stage_ms['rot_heuristics'] = (time.perf_counter() - start) * 1000.0
+    print(f"[Rot Detection] Score: {rot_score}/100 | Is Rotten: {is_rotten}")
+    print(f"[Rot Details] {rot_details}")
+    
+    # MULTI-FRUIT: crops of every fruit region are graded by the full model
+    regions, crops = segment_fruits(image)
+    if regions:
+        print(f"[Segmentation] {len(regions)} fruits found")
+    fruit_predictions = None
+    
+    if is_rotten:
+        # OVERRIDE: clear rot detected - Rotten, without running the model
+        exit_name = 'rotten_override'
+        predicted_class_idx = 4  # Rotten is index 4
+        confidence = min(rot_score, 100)  # Cap at 100%
+        print(f"[OVERRIDE] Rotten features detected! Overriding to Rotten ({confidence}%) - model skipped")
+        predictions = verdict_predictions(predicted_class_idx, confidence, 0)  # Fresh gets remainder
+    elif app.config['CASCADE_FRESH_EXIT'] and rot_details.get('fresh_override'):
+        # Bright, saturated, mostly fruit - Fresh, without running the model
+        exit_name = 'fresh_override'
+        predicted_class_idx = 0
+        confidence = app.config['CASCADE_FRESH_CONFIDENCE']
+        print(f"[Cascade] Clearly fresh - model skipped ({confidence}%)")
+        predictions = verdict_predictions(predicted_class_idx, confidence, 1)  # Slightly Ripe gets remainder
+    else:
+        if predictor is None:
+            return 500, {'error': 'Model not loaded. Please train the model first.'}
+        
+        # Preprocess image using OpenCV
+        processed_image = preprocess_image(image)
+        
+        predictions = None
+        if tiny_predictor is not None:
+            # TINY MODEL: keep its verdict only when it is confident
+            start = time.perf_counter()
+            tiny = tiny_predictor.predict(processed_image)
+            stage_ms['tiny_model'] = (time.perf_counter() - start) * 1000.0
+            if float(np.max(tiny[0])) >= app.config['TINY_MODEL_CONFIDENCE']:
+                predictions = tiny
+                exit_name = 'tiny_model'
+        
+        if predictions is None:
+            # FULL MODEL: fruit crops ride along in the same forward pass
+            start = time.perf_counter()
+            if regions:
+                outputs = predictor.predict(np.concatenate([processed_image, crops]))
+                predictions, fruit_predictions = outputs[:1], outputs[1:]
+            else:
+                predictions = predictor.predict(processed_image)
+            stage_ms['full_model'] = (time.perf_counter() - start) * 1000.0
+            exit_name = 'full_model'
+        
+        predicted_class_idx = int(np.argmax(predictions[0]))
+        confidence = float(predictions[0][predicted_class_idx]) * 100
+    
+    if regions and fruit_predictions is None:
+        if predictor is None:
+            regions = []
+        else:
+            # Early exit on a multi-fruit photo: the crops still need the full model,
+            # so this request is counted as a full model run, not as a skip
+            start = time.perf_counter()
+            fruit_predictions = predictor.predict(crops)
+            stage_ms['full_model'] = (time.perf_counter() - start) * 1000.0
+    
+    cascade_stats.record(stage_ms, exit_name)
+    
+    # CONFIDENCE THRESHOLD CHECK
+    CONFIDENCE_THRESHOLD = 45.0  # Reject if confidence < 45%
+    
+    if confidence < CONFIDENCE_THRESHOLD:
+        return 400, {
+            'error': '⚠️ Image quality too poor. Please upload a clearer fruit photo.'
+        }
+    
+    # Ensure confidence is capped at 100%
+    confidence = min(confidence, 100.0)
+    
+    predicted_freshness = FRESHNESS_LEVELS[predicted_class_idx]
+    freshness_details = FRESHNESS_INFO[predicted_freshness]
+    
+    # Get top 3 predictions
+    top_3_idx = np.argsort(predictions[0])[-3:][::-1]
+    top_3_predictions = [
+        {
+            'level': FRESHNESS_LEVELS[idx],
+            'confidence': min(float(predictions[0][idx]) * 100, 100.0),  # Cap at 100%
+            'color': FRESHNESS_INFO[FRESHNESS_LEVELS[idx]]['color']
+        }
+        for idx in top_3_idx
+    ]
+    
+    result = {
+        'freshness_level': predicted_freshness,
+        'confidence': float(confidence),
+        'emoji': freshness_details['emoji'],
+        'color': freshness_details['color'],
+        'description': freshness_details['description'],
+        'recommendation': freshness_details['recommendation'],
+        'top_predictions': top_3_predictions
+    }
+    if regions:
+        result['fruits'], result['aggregate'] = grade_fruits(regions, fruit_predictions)
+    
+    return 200, result
+
+def classify_and_cache(image, image_hash, filename):
+    """classify_image() plus storing the outcome in the prediction cache"""
+    report = {}
+    status, result = classify_image(image, filename, report=report)
+    if status == 500:  # Server-side failures are not a property of the image
+        return status, result
+    if report['validator'].get('budget_exceeded'):
+        # The validator was cut short (missed rectangles/lines lean towards "fruit") - the
+        # verdict depends on load at the time, so the next upload of this image runs again
+        print(f"[Cache] Not caching {image_hash[:16]}: fruit validator ran out of its time budget")
+        return status, result
+    prediction_cache.put(image_hash, {'status': status, 'result': result})
+    return status, result
+
 @app.route('/predict', methods=['POST'])
 def predict():
     if 'file' not in request.files:
@@ -493,100 +717,46 @@ def predict():
         return jsonify({'error': 'No file selected'}), 400
     
     if file:
-        # Save uploaded file
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
         
         try:
-            # PRE-CHECK: Verify it's actually a fruit
-            is_fruit, fruit_confidence, reason = is_fruit_like(filepath)
-            
-            print(f"[Upload] File: {filename} | Fruit Check: {is_fruit} (Score: {fruit_confidence}/100)")
-            
-            if not is_fruit:
-                os.remove(filepath)
-                print(f"[REJECTED] Not a fruit - {reason}")
-                return jsonify({
-                    'error': '⚠️ This is not a fruit image! Please upload a real fruit photo.'
-                }), 400
-            
-            image_hash = calculate_image_hash(filepath)
-            
-            # CHECK FOR ROTTEN FEATURES FIRST
-            is_rotten, rot_score, rot_details = detect_rotten_features(filepath)
-            print(f"[Rot Detection] Score: {rot_score}/100 | Is Rotten: {is_rotten}")
-            print(f"[Rot Details] {rot_details}")
-            
-            # Preprocess image using OpenCV
-            processed_image = preprocess_image(filepath)
-            
-            # Make prediction
-            if model is None:
-                return jsonify({'error': 'Model not loaded. Please train the model first.'}), 500
+            # Decode once, straight from the in-memory upload - every stage below shares this context
+            image = load_upload(file, filename)
+            image_hash = calculate_image_hash(image)
             
-            predictions = model.predict(processed_image)
-            predicted_class_idx = np.argmax(predictions[0])
-            confidence = float(predictions[0][predicted_class_idx]) * 100
+            # CACHE: identical image + same model = same verdict, skip the whole pipeline
+            prediction_cache.check_model()
+            cached = prediction_cache.get(image_hash)
+            coalesced = False
+            if cached is not None:
+                status, result = cached['status'], cached['result']
+                print(f"[Cache] Hit for {image_hash[:16]} ({filename})")
+            else:
+                # SINGLE-FLIGHT: duplicates arriving while this image is in the pipeline wait for its result
+                (status, result), coalesced = in_flight.do(
+                    image_hash, lambda: classify_and_cache(image, image_hash, filename)
+                )
+                if coalesced:
+                    print(f"[Coalesced] Reused in-flight result for {image_hash[:16]} ({filename})")
             
-            # OVERRIDE: If clear rot detected, force Rotten classification
-            if is_rotten:
-                predicted_class_idx = 4  # Rotten is index 4
-                confidence = min(rot_score, 100)  # Cap at 100%
-                print(f"[OVERRIDE] Rotten features detected! Overriding to Rotten ({confidence}%)")
-                
-                # Override predictions array to reflect rotten
-                predictions = np.zeros((1, 5))
-                predictions[0][4] = confidence / 100.0  # Rotten
-                predictions[0][0] = (100 - confidence) / 100.0  # Fresh gets remainder
+            if status != 200:
+                return jsonify(result), status
             
-            # CONFIDENCE THRESHOLD CHECK
-            CONFIDENCE_THRESHOLD = 45.0  # Reject if confidence < 45%
-            
-            if confidence < CONFIDENCE_THRESHOLD:
-                os.remove(filepath)
-                return jsonify({
-                    'error': '⚠️ Image quality too poor. Please upload a clearer fruit photo.'
-                }), 400
-            
-            # Ensure confidence is capped at 100%
-            confidence = min(confidence, 100.0)
-            
-            predicted_freshness = FRESHNESS_LEVELS[predicted_class_idx]
-            freshness_details = FRESHNESS_INFO[predicted_freshness]
-            
-            # Get top 3 predictions
-            top_3_idx = np.argsort(predictions[0])[-3:][::-1]
-            top_3_predictions = [
-                {
-                    'level': FRESHNESS_LEVELS[idx],
-                    'confidence': min(float(predictions[0][idx]) * 100, 100.0),  # Cap at 100%
-                    'color': FRESHNESS_INFO[FRESHNESS_LEVELS[idx]]['color']
-                }
-                for idx in top_3_idx
-            ]
+            if coalesced and not app.config['LEDGER_COALESCED']:
+                return jsonify(result)
             
             block_data = {
                 'type': 'freshness_check',
                 'image_hash': image_hash,
                 'filename': filename,
-                'freshness_level': predicted_freshness,
-                'confidence': confidence,
+                'freshness_level': result['freshness_level'],
+                'confidence': result['confidence'],
                 'timestamp': datetime.now().isoformat()
             }
             new_block = blockchain.add_block(block_data)
             
-            # Clean up uploaded file
-            os.remove(filepath)
-            
             return jsonify({
-                'freshness_level': predicted_freshness,
-                'confidence': confidence,
-                'emoji': freshness_details['emoji'],
-                'color': freshness_details['color'],
-                'description': freshness_details['description'],
-                'recommendation': freshness_details['recommendation'],
-                'top_predictions': top_3_predictions,
+                **result,
                 'blockchain_record': {  # Include blockchain info in response
                     'block_index': new_block.index,
                     'block_hash': new_block.hash,
@@ -595,9 +765,6 @@ def predict():
             })
         
         except Exception as e:
-            # Clean up uploaded file
-            if os.path.exists(filepath):
-                os.remove(filepath)
             return jsonify({'error': str(e)}), 500
 
 @app.route('/blockchain', methods=['GET'])
@@ -608,18 +775,166 @@ def get_blockchain():
     return jsonify({
         'records': recent_records,
         'total_blocks': len(blockchain.chain),
-        'is_valid': is_valid
+        'is_valid': is_valid,
+        'deep_verified_at': blockchain.watermark['deep_verified_at']
     })
 
 @app.route('/blockchain/verify', methods=['GET'])
 def verify_blockchain():
-    """Verify blockchain integrity"""
-    is_valid = blockchain.is_chain_valid()
+    """Verify blockchain integrity (?deep=1 re-checks every block, not just the new ones)"""
+    deep = request.args.get('deep') == '1'
+    is_valid = blockchain.is_chain_valid(deep=deep)
     return jsonify({
         'is_valid': is_valid,
+        'deep': deep,
         'total_blocks': len(blockchain.chain),
+        'verified_up_to': blockchain.watermark['index'],
+        'deep_verified_at': blockchain.watermark['deep_verified_at'],
+        'first_invalid_index': blockchain.first_invalid_index,
+        'reason': blockchain.invalid_reason,
         'message': 'Blockchain is valid and secure' if is_valid else 'Blockchain integrity compromised!'
     })
 
+def make_warmup_images(count, seed=0):
+    """
+    Synthetic phone-photo-like inputs: a shaded, noisy fruit-colored ellipse
+    on a lighter background, at a typical 4:3 resolution
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for i in range(count):
+        img = np.full((480, 640, 3), 200, dtype=np.uint8)
+        hue_bgr = [(40, 90, 230), (30, 200, 240), (60, 180, 80), (50, 50, 200)][i % 4]
+        cv2.ellipse(img, (320, 240), (180, 150), 0, 0, 360, hue_bgr, -1)
+        noise = rng.normal(0, 12, img.shape)
+        images.append(np.clip(img + noise, 0, 255).astype(np.uint8))
+    return images
+
+def warmup_batch_sizes():
+    """
+    Every batch size the predictor can hand to the model
+    - Multi-fruit requests add 2..SEGMENT_MAX_FRUITS crops (plus the photo itself),
+      and a request larger than the batch limit runs as a batch of its own
+    """
+    sizes = set(range(1, predictor.max_batch_size + 1)) if isinstance(predictor, BatchingPredictor) else {1}
+    if app.config['SEGMENTATION']:
+        sizes.update(range(2, app.config['SEGMENT_MAX_FRUITS'] + 2))
+    return sorted(sizes)
+
+def run_warmup():
+    """
+    Warm the full inference path before taking traffic
+    - Loads a lazy backend, then traces/allocates for every batch size in use
+    - Each pass runs the real preprocessing on synthetic images
+    """
+    if predictor is None:
+        READINESS.update(ready=False, status='model not loaded')
+        return
+    try:
+        start = time.perf_counter()
+        if not app.config['WARMUP']:
+            READINESS.update(ready=True, status='ready (warmup disabled)')
+            return
+        
+        READINESS.update(ready=False, status='warming up')
+        sizes = warmup_batch_sizes()
+        images = [preprocess_image(ImageContext(img)) for img in make_warmup_images(max(sizes))]
+        for _ in range(max(1, app.config['WARMUP_PASSES'])):
+            for size in sizes:
+                predictor.predict(np.concatenate(images[:size], axis=0))
+        
+        # Direct mode: request threads take their own interpreters from the pool
+        if isinstance(predictor, DirectPredictor) and hasattr(backend, 'warm_idle_interpreters'):
+            backend.warm_idle_interpreters(images[0])
+        
+        # The tiny model always runs in request threads
+        if tiny_predictor is not None:
+            for _ in range(max(1, app.config['WARMUP_PASSES'])):
+                tiny_predictor.predict(images[0])
+            if hasattr(tiny_backend, 'warm_idle_interpreters'):
+                tiny_backend.warm_idle_interpreters(images[0])
+        
+        STARTUP_TIMINGS['warmup_s'] = time.perf_counter() - start
+        READINESS.update(ready=True, status='ready')
+        print(f"[Startup] Warmup finished in {STARTUP_TIMINGS['warmup_s']:.2f}s (batch sizes {sizes})")
+    except Exception as e:
+        READINESS.update(ready=False, status=f'warmup failed: {e}')
+        print(f"[Startup] Warmup failed: {e}")
+
+def start_warmup():
+    """Warm up in the background so the worker boots quickly and /ready reports progress"""
+    threading.Thread(target=run_warmup, name='model-warmup', daemon=True).start()
+
+def admin_denied():
+    """Error response unless the request carries the admin token, else None"""
+    token = app.config['ADMIN_TOKEN']
+    if token is None:
+        return jsonify({'error': 'Admin endpoints are disabled (set FRUIT_ADMIN_TOKEN)'}), 403
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+        return jsonify({'error': 'Invalid admin token'}), 401
+    return None
+
+@app.route('/admin/ledger/verify', methods=['POST'])
+def start_ledger_verification():
+    """Start a parallel re-check of every block on disk; poll the returned status URL for progress"""
+    denied = admin_denied()
+    if denied is not None:
+        return denied
+    job_id, started = verify_jobs.start()
+    job = {'job_id': job_id, 'status_url': f"/admin/ledger/verify/{job_id}"}
+    if not started:
+        # One audit per ledger: each one runs a pool of one process per CPU
+        return jsonify({'error': 'A ledger verification is already running', **job}), 409
+    return jsonify(job), 202
+
+@app.route('/admin/ledger/verify/<job_id>', methods=['GET'])
+def ledger_verification_status(job_id):
+    """Progress of a ledger verification job, and its result once done"""
+    denied = admin_denied()
+    if denied is not None:
+        return denied
+    status = verify_jobs.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(status)
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness probe for the load balancer - 503 until warmup has finished"""
+    return jsonify(READINESS), (200 if READINESS['ready'] else 503)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Serving metrics for tuning throughput against latency"""
+    return jsonify({
+        'backend': {
+            'name': backend.name,
+            **(backend.stats() if hasattr(backend, 'stats') else {})
+        } if backend is not None else None,
+        'startup': startup_report(),
+        'batching': predictor.stats() if predictor is not None else None,
+        'cache': prediction_cache.stats(),
+        'single_flight': in_flight.stats(),
+        'decode': decode_stats.stats(),
+        'cascade': cascade_stats.stats(),
+        'ledger': blockchain.stats()
+    })
+
+@app.route('/metrics/memory', methods=['GET'])
+def memory_metrics():
+    """Shared vs private pages of this worker and its sibling workers"""
+    return jsonify({
+        'pid': os.getpid(),
+        'worker': read_smaps_rollup(),
+        'preload': app.config['PRELOAD'],
+        'gunicorn': worker_memory_report(os.getppid()) if app.config['PRELOAD'] else None
+    })
+
+if not app.config['PRELOAD']:
+    start_warmup()
+
+STARTUP_TIMINGS['app_init_s'] = time.perf_counter() - _APP_INIT_START
+print(f"[Startup] {startup_report()}")
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,175 @@
+"""
+Vision heuristics over a stack of images
+detect_rotten_features and is_fruit_like for an N x H x W x 3 uint8 BGR batch
+(e.g. photos resized to a common working size), for bulk scoring and offline
+evaluation. Pixel statistics are reduced over the whole stack at once:
+- color planes are converted as one tall image
+- per-image histograms come from a single bincount with per-image offsets
+- the Laplacian and the dark-spot dilation run on the stack with per-image
+  borders (reflected rows / blank separator rows)
+Only the contour, Hough and unique-color checks loop over images.
+
+Features are the same vectors feature_engine measures for one image (one row
+per image), scored by the same rule sets (feature_rules). They equal the
+single-image features of each image at its own resolution (i.e. with
+FRUIT_ANALYSIS_MAX_SIDE=0 or images already within it), because every path
+finishes its statistics with pixel_stats.
+"""
+
+import cv2
+import numpy as np
+
+from color_features import rule_codes, codes_matching, count_unique_colors, VALIDATOR_FRUIT_RULES
+from feature_engine import IMAGE_FEATURES, CENTER_FEATURES, FEATURES, UNIQUE_COLOR_LIMIT, LINES_MIN_EDGE_RATIO
+from feature_rules import rot_rules, fruit_rules
+from pixel_stats import batch_histograms, histogram_mean, histogram_std, histogram_range, moments_variance
+from shape_features import count_rectangles, count_lines
+
+
+# ===== STACK HELPERS =====
+
+def _check_batch(batch):
+    batch = np.asarray(batch)
+    if batch.ndim != 4 or batch.shape[3] != 3 or batch.dtype != np.uint8:
+        raise ValueError(f"Expected an N x H x W x 3 uint8 batch, got {batch.shape} {batch.dtype}")
+    return np.ascontiguousarray(batch)
+
+
+def _convert(batch, code):
+    """cv2.cvtColor over the whole stack as one tall image"""
+    n, h, w, _ = batch.shape
+    converted = cv2.cvtColor(batch.reshape(n * h, w, 3), code)
+    return converted.reshape((n, h, w) + converted.shape[2:])
+
+
+def _center(stack):
+    """Center region (15%-85% on both axes), as ImageContext.center crops it"""
+    h, w = stack.shape[1:3]
+    return np.ascontiguousarray(stack[:, int(h * 0.15):int(h * 0.85), int(w * 0.15):int(w * 0.85)])
+
+
+def _rule_histograms(hsv):
+    n, h, w, _ = hsv.shape
+    codes = rule_codes(hsv.reshape(n * h, w, 3)).reshape(n, h * w)
+    return batch_histograms(codes)
+
+
+def _laplacian_variances(gray):
+    """Per-image variance of the 3x3 Laplacian, each image with its own reflected border"""
+    n, h, w = gray.shape
+    padded = np.pad(gray, ((0, 0), (1, 1), (0, 0)), mode='reflect')  # = BORDER_REFLECT_101
+    lap = cv2.Laplacian(padded.reshape(n * (h + 2), w), cv2.CV_16S).reshape(n, h + 2, w)[:, 1:-1]
+    values = lap.reshape(n, -1).astype(np.float64)
+    totals = values.sum(axis=1)
+    squares = np.einsum('ij,ij->i', values, values)
+    return np.array([moments_variance(h * w, totals[i], squares[i]) for i in range(n)])
+
+
+def _count_spots(mask, kernel_size):
+    """
+    Connected components of each dilated mask (N x H x W uint8), labelled in one pass
+    Images are separated by blank rows: wider than both images' dilation reach,
+    so nothing touches across, and a component is assigned to the image it started in
+    """
+    n, h, w = mask.shape
+    reach = 2 * (kernel_size // 2)  # two dilation passes
+    stride = h + 2 * reach + 1
+    stacked = np.zeros((n, stride, w), dtype=np.uint8)
+    stacked[:, :h] = mask
+
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    dilated = cv2.dilate(stacked.reshape(n * stride, w), kernel, iterations=2)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(dilated)
+    owner = (stats[1:, cv2.CC_STAT_TOP] + reach) // stride
+    return np.bincount(owner, minlength=n)
+
+
+# ===== ROT DETECTION =====
+
+def batch_rot_features(batch, scale=1.0):
+    """Measurements scored by detect_rotten_features, one CENTER_FEATURES row per image"""
+    batch = _check_batch(batch)
+    center = _center(batch)
+    n, h, w, _ = center.shape
+    total_pixels = h * w
+
+    hsv = _convert(center, cv2.COLOR_BGR2HSV)
+    codes = _rule_histograms(hsv)
+    s_hist = batch_histograms(hsv[:, :, :, 1])
+    v_hist = batch_histograms(hsv[:, :, :, 2])
+
+    # A pixel is below a threshold on all channels iff its brightest channel is
+    brightest = center.max(axis=3).reshape(n, -1)
+
+    features = np.zeros(n, dtype=CENTER_FEATURES)
+    features['fruit_color_ratio'] = codes[:, codes_matching('rot_fruit_color')].sum(axis=1) / total_pixels
+    features['very_dark_ratio'] = (brightest < 40).sum(axis=1) / total_pixels
+    features['dark_ratio'] = (brightest < 70).sum(axis=1) / total_pixels
+    features['brown_ratio'] = (codes[:, codes_matching('dark_brown')].sum(axis=1) +
+                               codes[:, codes_matching('med_brown')].sum(axis=1)) / total_pixels
+    features['texture_variance'] = _laplacian_variances(_convert(center, cv2.COLOR_BGR2GRAY))
+    features['mold_ratio'] = codes[:, codes_matching('mold')].sum(axis=1) / total_pixels
+    features['brown_hue_ratio'] = codes[:, codes_matching('brown_hue')].sum(axis=1) / total_pixels
+    features['avg_brightness'] = [histogram_mean(hist) for hist in v_hist]
+    features['brightness_std'] = [histogram_std(hist) for hist in v_hist]
+    features['avg_saturation'] = [histogram_mean(hist) for hist in s_hist]
+    features['contrast'] = [histogram_range(hist) for hist in v_hist]
+
+    kernel_size = max(1, int(round(5 * scale)))
+    dark_mask = (brightest < 60).astype(np.uint8).reshape(n, h, w)
+    features['num_dark_spots'] = _count_spots(dark_mask, kernel_size)
+    return features
+
+
+def batch_detect_rotten_features(batch, scale=1.0):
+    """Returns (CENTER_FEATURES, feature_rules.ROT_RESULTS) arrays for a batch"""
+    features = batch_rot_features(batch, scale=scale)
+    return features, rot_rules(features)
+
+
+# ===== FRUIT VALIDATION =====
+
+def batch_fruit_features(batch, scale=1.0, max_polygons=64):
+    """Measurements scored by is_fruit_like, one IMAGE_FEATURES row per image"""
+    batch = _check_batch(batch)
+    n, h, w, _ = batch.shape
+    total_pixels = h * w
+
+    hsv = _convert(batch, cv2.COLOR_BGR2HSV)
+    gray = _convert(batch, cv2.COLOR_BGR2GRAY)
+    codes = _rule_histograms(hsv)
+    v_hist = batch_histograms(hsv[:, :, :, 2])
+
+    features = np.zeros(n, dtype=IMAGE_FEATURES)
+    features['total_pixels'] = total_pixels
+    features['fruit_color_ratio'] = codes[:, codes_matching(*VALIDATOR_FRUIT_RULES)].sum(axis=1) / total_pixels
+    features['gray_peak'] = batch_histograms(gray).max(axis=1)
+    features['laplacian_var'] = _laplacian_variances(gray)
+    features['brightness_std'] = [histogram_std(hist) for hist in v_hist]
+
+    edges = np.stack([cv2.Canny(gray[i], 100, 200) for i in range(n)])
+    features['edge_ratio'] = np.count_nonzero(edges.reshape(n, -1), axis=1) / total_pixels
+
+    # Per-image geometry; lines only matter when edge_ratio >= 0.15
+    for i in range(n):
+        features['unique_colors'][i] = min(count_unique_colors(batch[i], limit=UNIQUE_COLOR_LIMIT), UNIQUE_COLOR_LIMIT + 1)
+        features['rectangular_objects'][i] = count_rectangles(edges[i], scale=scale, max_polygons=max_polygons)
+        if features['edge_ratio'][i] >= LINES_MIN_EDGE_RATIO:
+            features['num_lines'][i] = count_lines(edges[i], scale=scale)
+    return features
+
+
+def batch_is_fruit_like(batch, scale=1.0, max_polygons=64):
+    """Returns (IMAGE_FEATURES, feature_rules.FRUIT_RESULTS) arrays for a batch"""
+    batch = _check_batch(batch)
+    features = batch_fruit_features(batch, scale=scale, max_polygons=max_polygons)
+    return features, fruit_rules(features)
+
+
+def batch_features(batch, scale=1.0, max_polygons=64):
+    """Full FEATURES vectors (whole image and center region) for a batch"""
+    batch = _check_batch(batch)
+    features = np.zeros(len(batch), dtype=FEATURES)
+    features['image'] = batch_fruit_features(batch, scale=scale, max_polygons=max_polygons)
+    features['center'] = batch_rot_features(batch, scale=scale)
+    return features
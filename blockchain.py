@@ -1,7 +1,25 @@
+import atexit
+import bisect
 import hashlib
 import json
+import mmap
+from collections import OrderedDict
 from datetime import datetime
 import os
+import threading
+import time
+
+from ledger_store import (SegmentLog, RECORD_HEADER, read_record, read_snapshot, record_offsets,
+                          segment_first_index, write_snapshot)
+
+# Verified tip (index, hash, position in the log) and time of the last deep check
+SNAPSHOT_FILE = 'snapshot.bin'
+# Recent blocks kept in memory; older ones are read back from their segment when needed
+HOT_BLOCKS = 1024
+# Older segments kept memory-mapped at once
+MAPPED_SEGMENTS = 4
+# A scheduled deep check handed to on_deep_verify_due is asked for again after this long
+DEEP_VERIFY_RETRY_S = 300
 
 class Block:
     def __init__(self, index, timestamp, data, previous_hash):
@@ -30,16 +48,154 @@ class Block:
             'previous_hash': self.previous_hash,
             'hash': self.hash
         }
+    
+    @classmethod
+    def from_dict(cls, block_data):
+        """Block from to_dict() output, keeping the stored hash (is_chain_valid recomputes it)"""
+        block = cls.__new__(cls)
+        block.index = block_data['index']
+        block.timestamp = block_data['timestamp']
+        block.data = block_data['data']
+        block.previous_hash = block_data['previous_hash']
+        block.hash = block_data['hash']
+        return block
+
+class LazyChain:
+    """
+    The chain as a list-like sequence without every block in memory
+    - Blocks from hot_start on (the recent tail) are Block objects in memory
+    - Older blocks stay in their segment files and are decoded when accessed
+      (segments are memory-mapped, their record offsets found on first use)
+    - demote() hands blocks that are safely on disk back to their segments
+    """
+    def __init__(self, segments=(), hot_start=0, hot=None):
+        self._lock = threading.Lock()
+        self._maps = OrderedDict()  # segment path -> (mmap, record offsets)
+        self._set_cold(segments, hot_start, hot if hot is not None else [])
+    
+    def reset_after_fork(self):
+        self._lock = threading.Lock()
+    
+    def _set_cold(self, segments, hot_start, hot):
+        """segments: paths of the segments holding blocks 0..hot_start-1, in order"""
+        with self._lock:
+            for data, _ in self._maps.values():
+                data.close()
+            self._maps.clear()
+            self._cold_paths = list(segments)
+            self._cold_first = [segment_first_index(path) for path in segments]
+            # Swapped as one object, so readers never see a new hot_start with the old list
+            self._state = (hot_start, hot)
+    
+    @property
+    def hot(self):
+        return self._state[1]
+    
+    def __len__(self):
+        hot_start, hot = self._state
+        return hot_start + len(hot)
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        hot_start, hot = self._state
+        if i < 0:
+            i += hot_start + len(hot)
+        if i >= hot_start:
+            return hot[i - hot_start]
+        if i < 0:
+            raise IndexError('chain index out of range')
+        with self._lock:
+            data, offset = self._locate(i)
+            payload = read_record(data, offset)
+        return Block.from_dict(json.loads(payload))
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+    def __reversed__(self):
+        for i in range(len(self) - 1, -1, -1):
+            yield self[i]
+    
+    def append(self, block):
+        self._state[1].append(block)
+    
+    def _locate(self, i):
+        """(mapped segment, record offset) of cold block i (call while holding _lock)"""
+        k = bisect.bisect_right(self._cold_first, i) - 1
+        path = self._cold_paths[k]
+        cached = self._maps.get(path)
+        if cached is None:
+            stop = self._cold_first[k + 1] if k + 1 < len(self._cold_first) else self._state[0]
+            count = stop - self._cold_first[k]
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            offsets, _ = record_offsets(data, count)
+            if len(offsets) < count:
+                data.close()
+                raise ValueError(f"{path} holds {len(offsets)} of its {count} blocks")
+            cached = self._maps[path] = (data, offsets)
+            while len(self._maps) > MAPPED_SEGMENTS:
+                self._maps.popitem(last=False)[1][0].close()
+        else:
+            self._maps.move_to_end(path)
+        return cached[0], cached[1][i - self._cold_first[k]]
+    
+    def record_end(self, i):
+        """Offset just past cold block i's record in its segment"""
+        with self._lock:
+            data, offset = self._locate(i)
+            return offset + RECORD_HEADER.size + RECORD_HEADER.unpack_from(data, offset)[0]
+    
+    def demote(self, stop, segments):
+        """Drop blocks before stop from memory; segments: paths holding blocks 0..stop-1"""
+        hot_start, hot = self._state
+        if stop > hot_start:
+            self._set_cold(segments, stop, hot[stop - hot_start:])
 
 class Blockchain:
-    def __init__(self, storage_file='blockchain_data.json'):
-        self.storage_file = storage_file
-        self.chain = []
+    """
+    Hash-linked chain of freshness records
+    - Stored append-only in segment files under storage_dir (ledger_store.SegmentLog):
+      adding a block writes one record instead of rewriting the whole chain
+    - fsync_every / fsync_interval_ms: durability policy (every N blocks and/or
+      every T milliseconds; 0 turns a trigger off)
+    - A chain in the old single-file format (legacy_file) is migrated once,
+      when the ledger directory has no segments yet
+    - Verification resumes from a persisted watermark; deep_verify_interval_s
+      schedules a full re-check (0 = only on request). With on_deep_verify_due
+      set, a due check calls it (to start a background audit that reports back
+      through record_deep_verification / record_audit_failure) and the caller
+      only gets the routine check
+    - The watermark is saved as a snapshot of the verified tip: a restart
+      trusts the blocks up to it without reading them (see load_chain)
+    """
+    def __init__(self, storage_dir='ledger', legacy_file='blockchain_data.json',
+                 fsync_every=1, fsync_interval_ms=0, segment_max_bytes=64 * 1024 * 1024,
+                 deep_verify_interval_s=0, on_deep_verify_due=None):
+        self.storage_dir = storage_dir
+        self.legacy_file = legacy_file
+        self.deep_verify_interval_s = deep_verify_interval_s
+        self.on_deep_verify_due = on_deep_verify_due
+        self._deep_requested_at = 0.0
+        self.audit_failure = None  # (index, reason) from a failed background audit
+        self.snapshot_file = os.path.join(storage_dir, SNAPSHOT_FILE)
+        self.watermark = {'index': -1, 'hash': None, 'deep_verified_at': 0.0}
+        self.first_invalid_index = None
+        self.invalid_reason = None
+        self._verify_lock = threading.Lock()
+        self.chain = LazyChain()
+        self.log = SegmentLog(storage_dir, segment_max_bytes=segment_max_bytes,
+                              fsync_every=fsync_every, fsync_interval_ms=fsync_interval_ms)
         self.load_chain()
-        
-        # Create genesis block if chain is empty
-        if len(self.chain) == 0:
-            self.create_genesis_block()
+        atexit.register(self.checkpoint)
+    
+    def reset_after_fork(self):
+        """Reopen the ledger files in a forked worker"""
+        self.log.reset_after_fork()
+        self.chain.reset_after_fork()
+        self._verify_lock = threading.Lock()
     
     def create_genesis_block(self):
         """Create the first block in the chain"""
@@ -47,8 +203,7 @@ class Blockchain:
             'type': 'genesis',
             'message': 'Fruit Freshness Blockchain Initialized'
         }, '0')
-        self.chain.append(genesis_block)
-        self.save_chain()
+        self._write(genesis_block)
     
     def get_latest_block(self):
         """Get the most recent block"""
@@ -56,63 +211,274 @@ class Blockchain:
     
     def add_block(self, data):
         """Add a new block to the chain"""
-        latest_block = self.get_latest_block()
-        new_block = Block(
-            index=latest_block.index + 1,
-            timestamp=datetime.now().isoformat(),
-            data=data,
-            previous_hash=latest_block.hash
-        )
-        self.chain.append(new_block)
-        self.save_chain()
+        with self.log.exclusive():
+            # Other workers may have appended since this one last looked
+            self._catch_up()
+            latest_block = self.get_latest_block()
+            new_block = Block(
+                index=latest_block.index + 1,
+                timestamp=datetime.now().isoformat(),
+                data=data,
+                previous_hash=latest_block.hash
+            )
+            self._write(new_block)
         return new_block
     
-    def is_chain_valid(self):
-        """Verify the integrity of the blockchain"""
-        for i in range(1, len(self.chain)):
-            current_block = self.chain[i]
-            previous_block = self.chain[i - 1]
+    def is_chain_valid(self, deep=False):
+        """
+        Verify the integrity of the blockchain
+        - Routine checks only verify the blocks after the watermark (the last
+          verified block, if its hash is unchanged) and then advance it
+        - deep=True, or a due scheduled check, re-checks every block (a due
+          check goes to on_deep_verify_due instead, when set)
+        - On failure the first bad block is kept in first_invalid_index, and why
+          ('hash mismatch', 'broken link' or 'corrupt record') in invalid_reason;
+          a failed background audit keeps the chain invalid until a deep check passes
+        """
+        if not deep and self.deep_verify_interval_s and \
+                time.time() - self.watermark['deep_verified_at'] >= self.deep_verify_interval_s:
+            if self.on_deep_verify_due is None:
+                deep = True
+            elif time.time() - self._deep_requested_at >= DEEP_VERIFY_RETRY_S:
+                self._deep_requested_at = time.time()
+                self.on_deep_verify_due()
+        if not self._verify(deep):
+            return False
+        if self.audit_failure is not None:
+            self.first_invalid_index, self.invalid_reason = self.audit_failure
+            return False
+        return True
+    
+    def _verify(self, deep):
+        chain_length, position = self.refresh()
+        with self._verify_lock:
+            start = 1 if deep else self._watermark_start()
+            self.first_invalid_index, self.invalid_reason = self._first_invalid(start, chain_length)
+            if self.first_invalid_index is not None:
+                return False
+            if deep:
+                self.audit_failure = None
+            self._advance_watermark(chain_length - 1, position, deep)
+            return True
+    
+    def _stored_block(self, i):
+        """chain[i], or None when its record can't be read back from disk (bad CRC, undecodable)"""
+        try:
+            return self.chain[i]
+        except (ValueError, KeyError, TypeError):
+            return None
+    
+    def _first_invalid(self, start, stop):
+        """(index, reason) of the first bad block in chain[start:stop], or (None, None)"""
+        start = max(1, start)
+        if start >= stop:
+            return None, None
+        previous_block = self._stored_block(start - 1)
+        if previous_block is None:
+            return start - 1, 'corrupt record'
+        for i in range(start, stop):
+            current_block = self._stored_block(i)
+            if current_block is None:
+                return i, 'corrupt record'
             
             # Check if current block's hash is correct
             if current_block.hash != current_block.calculate_hash():
-                return False
+                return i, 'hash mismatch'
             
             # Check if previous hash matches
             if current_block.previous_hash != previous_block.hash:
-                return False
+                return i, 'broken link'
+            
+            previous_block = current_block
         
-        return True
+        return None, None
+    
+    def record_deep_verification(self, index, block_hash):
+        """
+        Blocks 0..index passed a full check out of process (ledger_verify): it
+        counts as the deep check, and blocks added since get the routine one
+        """
+        chain_length, position = self.refresh()
+        with self._verify_lock:
+            audited_block = self._stored_block(index) if index is not None and index < chain_length else None
+            if audited_block is None or audited_block.hash != block_hash:
+                return
+            self.first_invalid_index, self.invalid_reason = self._first_invalid(index + 1, chain_length)
+            if self.first_invalid_index is None:
+                self.audit_failure = None
+                self._advance_watermark(chain_length - 1, position, deep=True)
+    
+    def record_audit_failure(self, index, reason):
+        """An out-of-process full check found block index bad: routine checks report it from now on"""
+        with self._verify_lock:
+            self.audit_failure = (index, reason)
+            self.first_invalid_index, self.invalid_reason = index, reason
+    
+    def checkpoint(self):
+        """fsync the log and snapshot the verified tip (at exit, so the next start reads almost nothing)"""
+        try:
+            self.log.sync()
+            self._verify(deep=False)
+        except OSError as e:
+            print(f"[Ledger] Checkpoint skipped: {e}")
+    
+    def close(self):
+        """Checkpoint now and release the ledger files (nothing left to do at exit)"""
+        atexit.unregister(self.checkpoint)
+        self.checkpoint()
+        self.log.close()
+    
+    # ===== VERIFIED WATERMARK =====
+    
+    def _watermark_start(self):
+        """First block a routine check has to verify"""
+        index = self.watermark['index']
+        if 0 <= index < len(self.chain):
+            watermark_block = self._stored_block(index)
+            if watermark_block is not None and watermark_block.hash == self.watermark['hash']:
+                return index + 1
+        return 1
+    
+    def _advance_watermark(self, index, position, deep):
+        """Move the watermark to block index, whose record ends at position, and save the snapshot"""
+        if index == self.watermark['index'] and not deep:
+            return
+        self.watermark = {
+            'index': index,
+            'hash': self.chain[index].hash,
+            'deep_verified_at': time.time() if deep else self.watermark['deep_verified_at']
+        }
+        path, end = position
+        write_snapshot(self.snapshot_file, {
+            **self.watermark,
+            'segment_first_index': segment_first_index(path),
+            'end': end
+        })
+        # Everything but the recent tail is on disk and can leave memory
+        if len(self.chain.hot) > 2 * HOT_BLOCKS:
+            with self.log.exclusive():
+                stop = len(self.chain) - HOT_BLOCKS
+                self.chain.demote(stop, [segment for segment in self.log.segments() if segment_first_index(segment) < stop])
     
-    def save_chain(self):
-        """Save blockchain to file"""
-        chain_data = [block.to_dict() for block in self.chain]
-        with open(self.storage_file, 'w') as f:
-            json.dump(chain_data, f, indent=2)
+    # ===== STORAGE =====
+    
+    def _write(self, block):
+        """Append one block to the ledger and the in-memory chain"""
+        payload = json.dumps(block.to_dict(), separators=(',', ':')).encode()
+        self.log.append(payload, block.index)
+        self.chain.append(block)
+    
+    @staticmethod
+    def _decode(payload):
+        return Block.from_dict(json.loads(payload))
+    
+    def _catch_up(self):
+        """Load blocks other processes appended (call while holding the log)"""
+        for payload in self.log.read_new():
+            self.chain.append(self._decode(payload))
+    
+    def refresh(self):
+        """
+        Pick up blocks appended by other workers
+        Returns: (chain length, log position just past its last block)
+        """
+        with self.log.exclusive():
+            self._catch_up()
+            return len(self.chain), self.log.position()
     
     def load_chain(self):
-        """Load blockchain from file"""
-        if os.path.exists(self.storage_file):
+        """
+        Load blockchain from the ledger, migrating or creating it when empty
+        - With a snapshot, blocks up to its verified tip are trusted and left on
+          disk (decoded when asked for); only records appended after it are read
+        - Otherwise every record is read, keeping the stored hashes; the first
+          is_chain_valid() then verifies them all and writes a snapshot
+        """
+        snapshot = read_snapshot(self.snapshot_file)
+        if snapshot is not None:
             try:
-                with open(self.storage_file, 'r') as f:
-                    chain_data = json.load(f)
-                    self.chain = []
-                    for block_data in chain_data:
-                        block = Block(
-                            block_data['index'],
-                            block_data['timestamp'],
-                            block_data['data'],
-                            block_data['previous_hash']
-                        )
-                        self.chain.append(block)
-            except Exception as e:
-                print(f"Error loading blockchain: {e}")
-                self.chain = []
+                self._load_from_snapshot(snapshot)
+                return
+            except (OSError, ValueError, KeyError, IndexError) as e:
+                print(f"[Ledger] Snapshot not usable ({e}) - reading the whole ledger")
+        
+        self.chain = LazyChain(hot=[self._decode(payload) for payload in self.log.read_all()])
+        if len(self.chain):
+            return
+        with self.log.exclusive():
+            # Another worker may have initialized the ledger meanwhile
+            self._catch_up()
+            if self.chain:
+                return
+            legacy_chain = self.load_legacy_chain()
+            if legacy_chain:
+                for block in legacy_chain:
+                    self._write(block)
+                print(f"[Ledger] Migrated {len(legacy_chain)} blocks from {self.legacy_file} to {self.storage_dir}/")
+            else:
+                self.create_genesis_block()
+            self.log.sync()
+    
+    def _load_from_snapshot(self, snapshot):
+        segments = [path for path in self.log.segments()
+                    if segment_first_index(path) <= snapshot['segment_first_index']]
+        if not segments or segment_first_index(segments[-1]) != snapshot['segment_first_index']:
+            raise ValueError('its segment is missing')
+        index = snapshot['index']
+        chain = LazyChain(segments, index + 1)
+        tip = chain[index]
+        if tip.index != index or tip.hash != snapshot['hash'] or chain.record_end(index) != snapshot['end']:
+            raise ValueError(f"block {index} does not match it")
+        
+        for payload in self.log.read_from(segments[-1], snapshot['end']):
+            chain.append(self._decode(payload))
+        self.chain = chain
+        self.watermark = {key: snapshot[key] for key in ('index', 'hash', 'deep_verified_at')}
+        print(f"[Ledger] Loaded snapshot at block {index} (+{len(chain.hot)} newer blocks)")
+    
+    def load_legacy_chain(self):
+        """Blocks of a chain in the old single-JSON-file format ([] when there is none)"""
+        if not self.legacy_file or not os.path.exists(self.legacy_file):
+            return []
+        try:
+            with open(self.legacy_file, 'r') as f:
+                chain_data = json.load(f)
+            return [
+                Block(
+                    block_data['index'],
+                    block_data['timestamp'],
+                    block_data['data'],
+                    block_data['previous_hash']
+                )
+                for block_data in chain_data
+            ]
+        except Exception as e:
+            print(f"Error loading blockchain: {e}")
+            return []
+    
+    def stats(self):
+        """Ledger size, durability counters and verification watermark"""
+        return {
+            'blocks': len(self.chain),
+            'blocks_in_memory': len(self.chain.hot),
+            'verified_up_to': self.watermark['index'],
+            'deep_verified_at': self.watermark['deep_verified_at'],
+            **self.log.stats()
+        }
     
     def get_chain(self):
         """Get the entire blockchain as a list of dictionaries"""
+        self.refresh()
         return [block.to_dict() for block in self.chain]
     
     def get_recent_records(self, limit=10):
         """Get the most recent records from the blockchain"""
-        records = [block.to_dict() for block in self.chain if block.data.get('type') == 'freshness_check']
-        return records[-limit:][::-1]  # Return last N records in reverse order
+        self.refresh()
+        # Newest first, reading back only as far as needed
+        records = []
+        for block in reversed(self.chain):
+            if len(records) >= limit:
+                break
+            if block.data.get('type') == 'freshness_check':
+                records.append(block.to_dict())
+        return records
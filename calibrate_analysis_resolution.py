@@ -0,0 +1,85 @@
+"""
+Calibrate FRUIT_ANALYSIS_MAX_SIDE
+Runs the fruit validator and the rot scorer (feature_engine plus
+feature_rules, the code behind is_fruit_like and detect_rotten_features) at
+several working resolutions on realimages/ and img/ (decoded as /predict does,
+including the reduced JPEG decode), and reports how far scores and decisions
+drift from the full-resolution result, next to the time each setting takes.
+Does not import app, so no model, ledger or warmup is loaded.
+Usage: python calibrate_analysis_resolution.py [max_side ...]
+"""
+import os
+import sys
+import time
+
+from feature_engine import as_dict, extract_features
+from feature_rules import fruit_rules, rot_rules
+from image_context import ImageContext
+
+FOLDERS = ['realimages', 'img']
+SETTINGS = [int(arg) for arg in sys.argv[1:]] or [2048, 1024, 768, 512]
+# Same bounds as the server (no time budget: results must not depend on timing)
+BUDGET_BYTES = float(os.environ.get('FRUIT_ANALYSIS_MEMORY_MB', 96)) * 1024 * 1024
+MAX_POLYGONS = int(os.environ.get('FRUIT_VALIDATOR_MAX_POLYGONS', 64))
+RATIO_KEYS = ['fruit_color_ratio', 'dark_ratio', 'brown_ratio', 'mold_ratio', 'brown_hue_ratio']
+
+
+def analyse(raw, max_side):
+    """
+    Decode plus both rule sets on a fresh context (nothing cached between settings)
+    Returns ((is_fruit, confidence), (is_rotten, rot_score, center features), seconds)
+    """
+    ctx = ImageContext.from_bytes(raw, target_side=max_side)
+    start = time.perf_counter() - ctx.decode_ms / 1000.0
+    features = extract_features(ctx.working(max_side), budget_bytes=BUDGET_BYTES, max_polygons=MAX_POLYGONS)
+    fruit = as_dict(fruit_rules(features['image']))
+    rot = as_dict(rot_rules(features['center']))
+    elapsed = time.perf_counter() - start
+    return ((fruit['is_fruit'], fruit['confidence']),
+            (rot['is_rotten'], rot['rot_score'], as_dict(features['center'])), elapsed)
+
+
+images = []
+for folder in FOLDERS:
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
+            with open(os.path.join(folder, name), 'rb') as f:
+                images.append((os.path.join(folder, name), f.read()))
+
+print(f"Calibrating on {len(images)} images...")
+print("=" * 80)
+
+baseline = {path: analyse(raw, 0) for path, raw in images}
+full_time = sum(result[2] for result in baseline.values())
+print(f"{'max side':>9s} {'time':>8s} {'speedup':>8s} {'fruit flips':>12s} {'rot flips':>10s} "
+      f"{'|d fruit|':>10s} {'|d rot|':>8s} {'max d ratio':>12s}")
+print(f"{'full':>9s} {full_time:7.2f}s {1.0:7.1f}x {0:12d} {0:10d} {0.0:10.1f} {0.0:8.1f} {0.0:11.2f}%")
+
+for max_side in SETTINGS:
+    total_time = 0.0
+    fruit_flips, rot_flips = [], []
+    fruit_drift, rot_drift, ratio_drift = [], [], []
+    for path, raw in images:
+        (full_fruit, full_rot, _) = baseline[path]
+        fruit, rot, elapsed = analyse(raw, max_side)
+        total_time += elapsed
+
+        if fruit[0] != full_fruit[0]:
+            fruit_flips.append(path)
+        if rot[0] != full_rot[0]:
+            rot_flips.append(path)
+        fruit_drift.append(abs(fruit[1] - full_fruit[1]))
+        rot_drift.append(abs(rot[1] - full_rot[1]))
+        for key in RATIO_KEYS:
+            ratio_drift.append(abs(rot[2][key] - full_rot[2][key]) * 100)
+
+    print(f"{max_side:9d} {total_time:7.2f}s {full_time / total_time:7.1f}x {len(fruit_flips):12d} "
+          f"{len(rot_flips):10d} {sum(fruit_drift) / len(images):10.1f} {sum(rot_drift) / len(images):8.1f} "
+          f"{max(ratio_drift, default=0.0):11.2f}%")
+    for path in fruit_flips:
+        print(f"{'':9s}   fruit decision changed: {path}")
+    for path in rot_flips:
+        print(f"{'':9s}   rot decision changed:   {path}")
+
+print("=" * 80)
+print("Set FRUIT_ANALYSIS_MAX_SIDE to the smallest setting whose flips are acceptable")
@@ -0,0 +1,59 @@
+import threading
+
+# /predict stages, cheapest first; each can end the cascade with a verdict
+STAGES = ['validator', 'rot_heuristics', 'tiny_model', 'full_model']
+EXITS = ['validator_reject', 'rotten_override', 'fresh_override', 'tiny_model', 'full_model']
+# Exits that used to pay for the full model (rejected images never reached it)
+MODEL_SKIPPING_EXITS = ['rotten_override', 'fresh_override', 'tiny_model']
+
+
+class CascadeStats:
+    """
+    Where /predict requests were decided, and what each stage cost
+    - record() takes the wall time of every stage that ran and the exit taken
+    - Requests the heuristics or the tiny model decided count the full model's
+      mean measured time as saved - unless the full model still ran for them
+      (fruit crops of a multi-fruit photo)
+    - Times are wall clock, not CPU time: the model runs on the batching
+      thread and TensorFlow's own threads, which the request thread's
+      thread_time() would not see
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._exits = {name: 0 for name in EXITS}
+        self._skipped = 0
+        self._stage_runs = {name: 0 for name in STAGES}
+        self._stage_ms = {name: 0.0 for name in STAGES}
+
+    def record(self, stage_ms, exit_name):
+        with self._lock:
+            self._requests += 1
+            self._exits[exit_name] += 1
+            if exit_name in MODEL_SKIPPING_EXITS and 'full_model' not in stage_ms:
+                self._skipped += 1
+            for stage, ms in stage_ms.items():
+                self._stage_runs[stage] += 1
+                self._stage_ms[stage] += ms
+
+    def stats(self):
+        with self._lock:
+            requests = self._requests
+            runs = self._stage_runs
+            full_model_ms = (self._stage_ms['full_model'] / runs['full_model']) if runs['full_model'] else 0.0
+            skipped = self._skipped
+            return {
+                'requests': requests,
+                'exits': dict(self._exits),
+                'exit_rates': {name: (count / requests) if requests else 0.0 for name, count in self._exits.items()},
+                'stages': {
+                    name: {
+                        'runs': runs[name],
+                        'avg_ms': (self._stage_ms[name] / runs[name]) if runs[name] else 0.0
+                    }
+                    for name in STAGES
+                },
+                'full_model_skipped': skipped,
+                'est_full_model_ms_saved': skipped * full_model_ms
+            }
@@ -0,0 +1,131 @@
+"""
+HSV color-rule kernel
+Every color threshold used by the validators and the rot scorer is compiled
+into one lookup table: each rule owns a bit, and a pixel's rule bits are
+LUT_H[h] & LUT_S[s] & LUT_V[v]. One histogram of those codes gives the pixel
+count of every rule (and any union of rules) without building a mask per rule.
+"""
+
+import cv2
+import numpy as np
+
+# name -> (hue ranges, saturation range, value range), all bounds inclusive.
+# A rule's hue ranges are OR-ed, so they may only be merged when they share S/V bounds.
+# OpenCV 8-bit hue runs 0-179; ">= 160" is written as (160, 255).
+COLOR_RULES = {
+    # detect_rotten_features: red, orange/yellow and green fruit color
+    'rot_fruit_color': ([(0, 10), (160, 255), (5, 35), (35, 90)], (40, 255), (50, 255)),
+    # detect_rotten_features: brown bands (counted separately, then added)
+    'dark_brown': ([(5, 25)], (30, 255), (15, 100)),
+    'med_brown': ([(5, 30)], (25, 180), (80, 150)),
+    # detect_rotten_features: grayish mold, s < 60 and 60 < v < 200
+    'mold': ([(0, 255)], (0, 59), (61, 199)),
+    'brown_hue': ([(8, 28)], (0, 255), (0, 255)),
+    # is_fruit_like: red and orange
+    'fruit_red_orange': ([(0, 10), (160, 255), (5, 25)], (30, 255), (30, 255)),
+    # is_fruit_like: yellow and green
+    'fruit_yellow_green': ([(20, 40), (35, 90)], (25, 255), (30, 255)),
+    # is_fruit_like: brown/dark (rotten)
+    'fruit_brown': ([(5, 30)], (20, 255), (15, 150)),
+}
+
+# Pixel is fruit-colored for is_fruit_like if it matches any of these
+VALIDATOR_FRUIT_RULES = ('fruit_red_orange', 'fruit_yellow_green', 'fruit_brown')
+
+RULE_BITS = {name: 1 << i for i, name in enumerate(COLOR_RULES)}
+if len(RULE_BITS) > 8:
+    raise ValueError('COLOR_RULES must fit in 8 bits')
+
+
+def _build_lut(rules):
+    """(1, 256, 3) uint8 table mapping H, S and V values to rule bits"""
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    values = np.arange(256)
+    for name, (hue_ranges, s_range, v_range) in rules.items():
+        bit = RULE_BITS[name]
+        for lo, hi in hue_ranges:
+            lut[(values >= lo) & (values <= hi), 0] |= bit
+        lut[(values >= s_range[0]) & (values <= s_range[1]), 1] |= bit
+        lut[(values >= v_range[0]) & (values <= v_range[1]), 2] |= bit
+    return lut.reshape(1, 256, 3)
+
+
+HSV_RULE_LUT = _build_lut(COLOR_RULES)
+
+
+def codes_matching(*names):
+    """Boolean selector over the 256 rule codes: codes with at least one of the named rule bits"""
+    mask = 0
+    for name in names:
+        mask |= RULE_BITS[name]
+    return (np.arange(256) & mask) != 0
+
+
+class ColorRuleCounts:
+    """Histogram of rule codes for one image; counts any rule or union of rules"""
+
+    def __init__(self, histogram, total_pixels):
+        self.histogram = histogram
+        self.total_pixels = total_pixels
+
+    def count(self, *names):
+        """Pixels matching at least one of the named rules"""
+        return int(self.histogram[codes_matching(*names)].sum())
+
+    def ratio(self, *names):
+        return self.count(*names) / self.total_pixels
+
+
+def rule_codes(hsv):
+    """Per-pixel rule bits (H x W uint8) for an 8-bit HSV image"""
+    mapped = cv2.LUT(hsv, HSV_RULE_LUT)
+    codes = mapped[:, :, 0] & mapped[:, :, 1]
+    codes &= mapped[:, :, 2]
+    return codes
+
+
+def count_color_rules(hsv):
+    """Pixel counts for every rule in COLOR_RULES in a single pass"""
+    codes = rule_codes(hsv)
+    histogram = np.bincount(codes.ravel(), minlength=256)
+    return ColorRuleCounts(histogram, codes.size)
+
+
+def new_color_bitmap():
+    """One flag per 24-bit BGR color (16 MB)"""
+    return np.zeros(1 << 24, dtype=bool)
+
+
+def mark_colors(seen, pixels):
+    """Set the bitmap flag of every BGR color in pixels (any shape ending in 3)"""
+    pixels = np.ascontiguousarray(pixels).reshape(-1, 1, 3)
+    # BGRA viewed as little-endian uint32 is b | g << 8 | r << 16 | a << 24
+    packed = cv2.cvtColor(pixels, cv2.COLOR_BGR2BGRA).view('<u4').ravel()
+    packed &= 0xFFFFFF
+    seen[packed] = True
+
+
+def count_unique_colors(bgr, limit=None, first_chunk=1 << 16):
+    """
+    Number of distinct BGR colors in linear time
+    - Pixels are packed into 24-bit integers and marked in a 16 MB bitmap
+      (no sort, unlike np.unique(axis=0))
+    - With limit set, pixels are scanned in geometrically growing chunks and the
+      scan stops as soon as more than limit colors were seen; the returned count
+      is then only guaranteed to be > limit
+    """
+    pixels = np.ascontiguousarray(bgr).reshape(-1, 3)
+    seen = new_color_bitmap()
+
+    start = 0
+    chunk = first_chunk if limit is not None else len(pixels)
+    count = 0
+    while start < len(pixels):
+        stop = min(len(pixels), start + chunk)
+        mark_colors(seen, pixels[start:stop])
+        count = int(np.count_nonzero(seen))
+        if limit is not None and count > limit:
+            break
+        start = stop
+        chunk *= 2
+    return count
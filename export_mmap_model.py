@@ -0,0 +1,35 @@
+"""
+Export the TFLite model as a flat, memory-mappable artifact (.fmm)
+Run after convert_to_tflite.py - the server maps the artifact read-only, so
+start-up no longer parses or copies the weights
+"""
+
+import os
+import sys
+
+from model_artifact import write_artifact, open_artifact
+
+SOURCE_MODEL = 'fruit_freshness_model.h5'
+TFLITE_MODEL = 'fruit_freshness_model.tflite'
+OUTPUT_FILE = 'fruit_freshness_model.fmm'
+
+print("🔄 Exporting memory-mappable model artifact...")
+print("-" * 50)
+
+if not os.path.exists(TFLITE_MODEL):
+    print(f"❌ {TFLITE_MODEL} not found. Run convert_to_tflite.py first.")
+    sys.exit(1)
+
+metadata = write_artifact(TFLITE_MODEL, OUTPUT_FILE, source_path=SOURCE_MODEL)
+
+# Re-open exactly as the server will, including the full payload hash check
+artifact = open_artifact(OUTPUT_FILE, source_path=SOURCE_MODEL, verify_payload=True)
+artifact.close()
+
+size = os.path.getsize(OUTPUT_FILE) / (1024 * 1024)
+print(f"✅ Artifact written: {OUTPUT_FILE} ({size:.2f} MB)")
+print(f"🔑 Payload SHA-256: {metadata['payload_sha256']}")
+if 'source' in metadata:
+    print(f"📂 Source model: {metadata['source']['path']} ({metadata['source']['sha256'][:16]}...)")
+print(f"🖼️  Preprocessing: {metadata['preprocessing']}")
+print("\nServe it with: FRUIT_BACKEND=mmap gunicorn -c gunicorn.conf.py app:app")
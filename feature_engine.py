@@ -0,0 +1,215 @@
+"""
+Feature engine
+Every statistic the fruit validators and the rot scorer look at is measured
+here, once, into a compact feature vector (a numpy structured record):
+- IMAGE_FEATURES: whole-image statistics (app.is_fruit_like and
+  fruit_validator_new.is_fruit_like_optimized)
+- CENTER_FEATURES: statistics of the center region (detect_rotten_features)
+Each group is measured on first use and cached on the ImageContext, so the
+validator and the rot scorer of one request never walk the pixels twice.
+The decisions are rule sets over these vectors (feature_rules.py); adding a
+rule only reads fields that are already here.
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+from color_features import VALIDATOR_FRUIT_RULES, count_unique_colors
+from image_context import ImageContext
+from pixel_stats import histogram, histogram_mean, histogram_std, histogram_range, laplacian_variance
+from shape_features import count_rectangles, count_lines
+from tiled_analysis import needs_tiling, fit_within_budget, tiled_rot_features, tiled_fruit_stats
+
+# Unique-color counting stops here - no rule depends on exact counts above it
+UNIQUE_COLOR_LIMIT = 500
+# Hough lines are only counted from this edge ratio up (no rule reads them below it)
+LINES_MIN_EDGE_RATIO = 0.15
+
+IMAGE_FEATURES = np.dtype([
+    ('total_pixels', 'i8'),
+    ('unique_colors', 'i8'),  # exact up to UNIQUE_COLOR_LIMIT, then UNIQUE_COLOR_LIMIT + 1
+    ('edge_ratio', 'f8'),
+    ('rectangular_objects', 'i8'),  # the scan stops at 2
+    ('gray_peak', 'i8'),
+    ('num_lines', 'i8'),  # 0 below LINES_MIN_EDGE_RATIO
+    ('fruit_color_ratio', 'f8'),
+    ('laplacian_var', 'f8'),
+    ('brightness_std', 'f8')
+])
+
+CENTER_FEATURES = np.dtype([
+    ('fruit_color_ratio', 'f8'),
+    ('very_dark_ratio', 'f8'),
+    ('dark_ratio', 'f8'),
+    ('brown_ratio', 'f8'),
+    ('texture_variance', 'f8'),
+    ('avg_brightness', 'f8'),
+    ('mold_ratio', 'f8'),
+    ('brightness_std', 'f8'),
+    ('avg_saturation', 'f8'),
+    ('brown_hue_ratio', 'f8'),
+    ('num_dark_spots', 'i8'),
+    ('contrast', 'i8')
+])
+
+FEATURES = np.dtype([('image', IMAGE_FEATURES), ('center', CENTER_FEATURES)])
+
+
+def as_record(values, dtype):
+    """One-row structured array from a dict of feature values"""
+    record = np.zeros(1, dtype=dtype)
+    for name in dtype.names:
+        record[name] = values[name]
+    return record
+
+
+def as_dict(record):
+    """Plain Python values of a one-row feature array (for logs and JSON)"""
+    return {name: record[name][0].item() for name in record.dtype.names}
+
+
+# ===== CENTER REGION =====
+
+def spot_kernel_size(ctx):
+    """Dilation kernel for dark-spot grouping: 5x5 at full resolution"""
+    return max(1, int(round(ctx.scale_length(5))))
+
+
+def measure_center(center, budget_bytes=None):
+    """
+    Raw measurements of the center region that the rot scorer reads
+    Images too large for budget_bytes are measured strip by strip
+    (tiled_analysis.tiled_rot_features returns the same values)
+    """
+    if needs_tiling(center.shape, budget_bytes):
+        return tiled_rot_features(center.bgr, spot_kernel_size(center), budget_bytes)
+
+    img_center = center.bgr
+    img_hsv = center.hsv
+    total_pixels = center.total_pixels
+
+    # All HSV color rules (thresholds live in color_features.COLOR_RULES), counted in one pass
+    color_rules = center.color_rules
+
+    # Dark pixels: Stricter 40 instead of 50, 70 instead of 80
+    # (a pixel is below a threshold on all channels iff its brightest channel is)
+    brightest = img_center.max(axis=2)
+    very_dark = int(np.count_nonzero(brightest < 40))
+    dark = int(np.count_nonzero(brightest < 70))
+
+    # Concentrated dark spots (Stricter: 60 instead of 70), grouped by dilation
+    kernel_size = spot_kernel_size(center)
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    dark_dilated = cv2.dilate((brightest < 60).astype(np.uint8), kernel, iterations=2)
+
+    # Means, deviations and variances come from histograms/integer moments (pixel_stats),
+    # bit-identical to the tiled and batched paths
+    v_hist = histogram(img_hsv[:, :, 2])
+
+    return {
+        'fruit_color_ratio': color_rules.ratio('rot_fruit_color'),
+        'very_dark_ratio': very_dark / total_pixels,
+        'dark_ratio': dark / total_pixels,
+        # Dark brown (deep rot) and medium brown (rotting); overlapping pixels count twice
+        'brown_ratio': (color_rules.count('dark_brown') + color_rules.count('med_brown')) / total_pixels,
+        'texture_variance': laplacian_variance(center.gray),
+        'avg_brightness': histogram_mean(v_hist),
+        'mold_ratio': color_rules.ratio('mold'),  # Low saturation (gray), mid brightness
+        'brightness_std': histogram_std(v_hist),
+        'avg_saturation': histogram_mean(histogram(img_hsv[:, :, 1])),
+        'brown_hue_ratio': color_rules.ratio('brown_hue'),
+        'num_dark_spots': cv2.connectedComponents(dark_dilated)[0] - 1,  # -1 for background
+        'contrast': histogram_range(v_hist)
+    }
+
+
+def center_features(ctx, budget_bytes=None):
+    """CENTER_FEATURES of an image (measured once, cached on the context)"""
+    center = ctx.center
+    return center.memo('center_features', lambda: as_record(measure_center(center, budget_bytes), CENTER_FEATURES))
+
+
+# ===== WHOLE IMAGE =====
+
+def measure_image(ctx, budget_bytes=None, max_polygons=None, deadline=None, report=None):
+    """
+    Raw whole-image measurements that the fruit validators read
+    - Images too large for budget_bytes get their pixel statistics strip by
+      strip (bit-identical), and the edge/contour/line checks on a downscaled
+      copy that fits the budget - edge_ratio then differs from the full-frame
+      value (see tiled_analysis.py)
+    - deadline (perf_counter time) cuts the polygon scan and Hough short;
+      what was skipped or cut is appended to report['skipped'/'truncated']
+    """
+    if report is None:
+        report = {}
+    report.setdefault('truncated', [])
+    report.setdefault('skipped', [])
+
+    tiled = None
+    shape_ctx = ctx
+    if needs_tiling(ctx.shape, budget_bytes):
+        tiled = tiled_fruit_stats(ctx.bgr, budget_bytes, unique_color_limit=UNIQUE_COLOR_LIMIT)
+        small, scale = fit_within_budget(ctx.bgr, budget_bytes)
+        shape_ctx = ImageContext(small, scale=ctx.scale * scale)
+        report['tiled'] = True
+
+    edges = shape_ctx.edges
+    edge_ratio = np.sum(edges > 0) / shape_ctx.total_pixels
+
+    # Large rectangles/squares (boxes, packages, screens, books); small contours are
+    # dropped in one vectorized step and the scan stops at 2 rectangles
+    rectangular_objects = count_rectangles(edges, scale=shape_ctx.scale, max_polygons=max_polygons,
+                                           deadline=deadline, report=report)
+
+    # Artificial straight lines (vehicle frames); over the deadline, no lines are assumed
+    num_lines = 0
+    if edge_ratio < LINES_MIN_EDGE_RATIO:
+        report['skipped'].append('hough')
+    elif deadline is not None and time.perf_counter() > deadline:
+        report['truncated'].append('hough (budget)')
+    else:
+        num_lines = count_lines(edges, scale=shape_ctx.scale)
+
+    if tiled:
+        stats = tiled
+    else:
+        stats = {
+            'color_rules': ctx.color_rules,
+            'unique_colors': count_unique_colors(ctx.bgr, limit=UNIQUE_COLOR_LIMIT),
+            'gray_peak': int(histogram(ctx.gray).max()),
+            'laplacian_var': laplacian_variance(ctx.gray),
+            'brightness_std': histogram_std(histogram(ctx.hsv[:, :, 2]))
+        }
+
+    return {
+        'total_pixels': ctx.total_pixels,
+        # Early-stopped counts differ between paths above the limit, so they are capped
+        'unique_colors': min(stats['unique_colors'], UNIQUE_COLOR_LIMIT + 1),
+        'edge_ratio': edge_ratio,
+        'rectangular_objects': rectangular_objects,
+        'gray_peak': stats['gray_peak'],
+        'num_lines': num_lines,
+        # All fruit colors including brown for rotten: red/orange, yellow/green, brown/dark
+        'fruit_color_ratio': stats['color_rules'].ratio(*VALIDATOR_FRUIT_RULES),
+        'laplacian_var': stats['laplacian_var'],
+        'brightness_std': stats['brightness_std']
+    }
+
+
+def image_features(ctx, budget_bytes=None, max_polygons=None, deadline=None, report=None):
+    """IMAGE_FEATURES of an image (measured once, cached on the context - options apply to that first measurement)"""
+    return ctx.memo('image_features', lambda: as_record(
+        measure_image(ctx, budget_bytes=budget_bytes, max_polygons=max_polygons, deadline=deadline, report=report),
+        IMAGE_FEATURES
+    ))
+
+
+def extract_features(ctx, budget_bytes=None, max_polygons=None):
+    """Full FEATURES vector of an image (both groups)"""
+    record = np.zeros(1, dtype=FEATURES)
+    record['image'] = image_features(ctx, budget_bytes=budget_bytes, max_polygons=max_polygons)
+    record['center'] = center_features(ctx, budget_bytes=budget_bytes)
+    return record
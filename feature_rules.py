@@ -0,0 +1,194 @@
+"""
+Rule sets over feature vectors (feature_engine.py)
+The fruit validators and the rot scorer are pure functions of the feature
+arrays: no pixel access, vectorized over any number of rows, so one image
+(a one-row array) and a batch (batch_analysis.py) share the same rules.
+"""
+
+import numpy as np
+
+ROT_RESULTS = np.dtype([
+    ('is_rotten', '?'),
+    ('rot_score', 'i8'),
+    ('threshold', 'i8'),
+    ('is_group_fruit', '?'),
+    ('poor_quality', '?'),
+    ('background_penalty', '?'),
+    ('fresh_override', '?')
+])
+
+FRUIT_RESULTS = np.dtype([
+    ('is_fruit', '?'),
+    ('confidence', 'i8'),
+    ('score', 'i8'),
+    ('early_exit', 'U16'),  # key of the hard reject that fired, '' if none
+    ('reason', 'U64')
+])
+
+
+def points(conditions, values):
+    """First matching condition wins, like an if/elif chain (0 if none match)"""
+    return np.select(conditions, values, default=0)
+
+
+# ===== ROT SCORER =====
+
+# Tunable constants of rot_rules (swept by tune_rot_thresholds.py); "group_" values
+# apply when the image looks like several fruits (fruit color above group_fruit_color)
+ROT_PARAMS = {
+    # Poor image quality or insufficient fruit visible - not judged, NOT rotten
+    'min_fruit_color': 0.15,
+    'min_brightness': 80,
+    # Below this fruit color the score is reduced by 40% (background)
+    'background_fruit_color': 0.25,
+    'group_fruit_color': 0.50,
+    # Dark-pixel ratios scoring 40 (very dark), 30 and 20 points
+    'very_dark': 0.05,
+    'dark': 0.08,
+    'early_dark': 0.03,
+    'group_very_dark': 0.10,
+    'group_dark': 0.15,
+    'group_early_dark': 0.08,
+    # Score at which the image is called rotten
+    'threshold': 60,
+    'group_threshold': 70,
+    # Fresh override: bright, saturated, mostly fruit and not too brown
+    'fresh_brightness': 130,
+    'fresh_saturation': 100,
+    'fresh_fruit_color': 0.70,
+    'fresh_brown': 0.40
+}
+
+
+def rot_rules(f, params=None):
+    """
+    detect_rotten_features' scoring over CENTER_FEATURES rows
+    params overrides ROT_PARAMS; values may be (k, 1) arrays to score k
+    configurations at once, the results then have shape (k, rows)
+    """
+    p = dict(ROT_PARAMS, **(params or {}))
+    group = f['fruit_color_ratio'] > p['group_fruit_color']
+    poor = (f['fruit_color_ratio'] < p['min_fruit_color']) | (f['avg_brightness'] < p['min_brightness'])
+    penalty = ~poor & (f['fruit_color_ratio'] < p['background_fruit_color'])
+
+    # Dark spots (relaxed for group fruits: shadows between them are normal)
+    score = np.where(
+        group,
+        points([f['very_dark_ratio'] > p['group_very_dark'], f['dark_ratio'] > p['group_dark'],
+                f['dark_ratio'] > p['group_early_dark']], [40, 30, 20]),
+        points([f['very_dark_ratio'] > p['very_dark'], f['dark_ratio'] > p['dark'],
+                f['dark_ratio'] > p['early_dark']], [40, 30, 20])
+    )
+    # Brown/muddy colors, wrinkled texture, low brightness, mold
+    score = score + points([f['brown_ratio'] > 0.12, f['brown_ratio'] > 0.06, f['brown_ratio'] > 0.03], [35, 25, 15])
+    score = score + np.where(f['texture_variance'] > 1500, 20, 0)
+    score = score + points([f['avg_brightness'] < 80, f['avg_brightness'] < 120], [25, 15])
+    score = score + points([f['mold_ratio'] > 0.25, f['mold_ratio'] > 0.15], [25, 15])
+    # Blotchy brightness (group fruits naturally vary more)
+    score = score + np.where(
+        group,
+        points([f['brightness_std'] > 90, f['brightness_std'] > 75], [15, 8]),
+        points([f['brightness_std'] > 70, f['brightness_std'] > 50], [20, 10])
+    )
+    # Desaturation, brownish hue dominance
+    score = score + points([f['avg_saturation'] < 50, f['avg_saturation'] < 70], [15, 8])
+    score = score + points([f['brown_hue_ratio'] > 0.30, f['brown_hue_ratio'] > 0.20], [20, 10])
+    # Concentrated dark spots (gaps between group fruits look like spots)
+    score = score + np.where(
+        group,
+        points([f['num_dark_spots'] > 10, f['num_dark_spots'] > 6], [15, 8]),
+        points([f['num_dark_spots'] > 5, f['num_dark_spots'] > 2], [20, 10])
+    )
+    # Low contrast = mushy/soft texture
+    score = score + np.where(f['contrast'] < 100, 15, 0)
+    # Reduce score by 40% if too much background
+    score = np.where(penalty, (score * 0.6).astype(np.int64), score)
+
+    threshold = np.where(group, p['group_threshold'], p['threshold'])
+    # Bright, colorful and saturated = NOT rotten, even if shadows/gaps score high
+    fresh = ((f['avg_brightness'] > p['fresh_brightness']) & (f['avg_saturation'] > p['fresh_saturation']) &
+             (f['fruit_color_ratio'] > p['fresh_fruit_color']) & (f['brown_ratio'] < p['fresh_brown']))
+
+    results = np.zeros(np.broadcast(score, threshold, poor, fresh).shape, dtype=ROT_RESULTS)
+    results['is_group_fruit'] = group
+    results['poor_quality'] = poor
+    results['background_penalty'] = penalty
+    results['fresh_override'] = ~poor & fresh
+    results['rot_score'] = np.where(poor, 0, score)
+    results['threshold'] = threshold
+    results['is_rotten'] = ~poor & ~fresh & (score >= threshold)
+    return results
+
+
+# ===== FRUIT VALIDATORS =====
+
+def _fruit_results(f, score, is_fruit, rejects):
+    """Apply hard rejects in order (first one wins) on top of a score and decision"""
+    rejected = np.zeros(len(f), dtype=bool)
+    results = np.zeros(len(f), dtype=FRUIT_RESULTS)
+    for key, condition, reason in rejects:
+        hit = condition & ~rejected
+        results['early_exit'][hit] = key
+        results['reason'][hit] = reason
+        rejected |= hit
+
+    results['score'] = score
+    results['is_fruit'] = ~rejected & is_fruit
+    results['confidence'] = np.where(rejected, 0, np.clip(score, 0, 100))
+    for i in np.flatnonzero(~rejected):
+        results['reason'][i] = (f"Score:{score[i]}, Colors:{f['fruit_color_ratio'][i]*100:.0f}%, "
+                                f"Rectangles:{f['rectangular_objects'][i]}")
+    return results
+
+
+def fruit_rules(f):
+    """app.is_fruit_like over IMAGE_FEATURES rows"""
+    unique_colors = f['unique_colors']
+    edge_ratio = f['edge_ratio']
+    fruit_color_ratio = f['fruit_color_ratio']
+
+    # More credit for high fruit color (important for group fruits)
+    score = points([fruit_color_ratio >= 0.60, fruit_color_ratio >= 0.30,
+                    fruit_color_ratio >= 0.15, fruit_color_ratio >= 0.08], [50, 40, 25, 10])
+    score += np.where((f['laplacian_var'] > 80) & (f['laplacian_var'] < 3000), 25, 0)  # texture
+    score += np.where(f['brightness_std'] > 20, 20, 0)  # shading
+    score += points([unique_colors > 500, unique_colors > 150], [15, 10])
+    score += np.where(edge_ratio < 0.08, 10, 0)
+
+    is_fruit = ((score >= 40) & (fruit_color_ratio >= 0.06) & (f['rectangular_objects'] < 2) &
+                (edge_ratio < 0.30) & ((f['num_lines'] <= 30) | (edge_ratio < 0.15)))
+
+    rejects = [
+        ('unique_colors', unique_colors < 50, "Simple graphic"),
+        ('rectangles', f['rectangular_objects'] >= 2, "Rectangular objects detected (boxes/packages/screens)"),
+        ('metallic', (f['gray_peak'] > f['total_pixels'] * 0.2) & (edge_ratio > 0.20), "Metallic vehicle surface"),
+        ('edges', edge_ratio > 0.30, "Mechanical object (too many sharp edges)"),
+        ('lines', (f['num_lines'] > 30) & (edge_ratio > 0.15), "Artificial structure detected"),
+        ('uniform', f['brightness_std'] < 10, "Uniform fill")
+    ]
+    return _fruit_results(f, score, is_fruit, rejects)
+
+
+def legacy_fruit_rules(f):
+    """fruit_validator_new.is_fruit_like_optimized over IMAGE_FEATURES rows (stricter, no line check)"""
+    unique_colors = f['unique_colors']
+    edge_ratio = f['edge_ratio']
+    fruit_color_ratio = f['fruit_color_ratio']
+
+    score = points([fruit_color_ratio >= 0.30, fruit_color_ratio >= 0.15, fruit_color_ratio >= 0.08], [40, 25, 10])
+    score += np.where((f['laplacian_var'] > 80) & (f['laplacian_var'] < 3000), 25, 0)
+    score += np.where(f['brightness_std'] > 20, 20, 0)
+    score += points([unique_colors > 500, unique_colors > 150], [15, 10])
+    score += np.where(f['rectangular_objects'] == 0, 10, 0)
+    score += np.where(edge_ratio < 0.08, 10, 0)
+
+    is_fruit = ((score >= 45) & (fruit_color_ratio >= 0.08) & (f['rectangular_objects'] < 2) &
+                (edge_ratio < 0.25))
+
+    rejects = [
+        ('unique_colors', unique_colors < 50, "Simple graphic"),
+        ('rectangles', f['rectangular_objects'] >= 2, "Rectangular objects detected"),
+        ('edges', edge_ratio > 0.25, "Mechanical object"),
+        ('uniform', f['brightness_std'] < 10, "Uniform fill")
+    ]
+    return _fruit_results(f, score, is_fruit, rejects)
@@ -0,0 +1,119 @@
+"""
+Columnar feature store
+Feature vectors (feature_engine.FEATURES) of a labeled image collection,
+kept in one compressed .npz file with one array per feature column:
+- "image.<field>" / "center.<field>" columns hold the features
+- "path", "label", "size" and "mtime_ns" identify each image, so a later
+  extraction only measures files that are new or changed
+Loading rebuilds a FEATURES array, ready for the vectorized rule sets.
+"""
+
+import csv
+import os
+import re
+
+import numpy as np
+
+from feature_engine import FEATURES
+
+STORE_VERSION = 1
+
+# Folder names that are freshness labels (training_data/<label>/...)
+FRESHNESS_LABELS = ('fresh', 'slightly_ripe', 'ripe', 'overripe', 'rotten')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# Whole words in a file name that label it ("rotten apple.jpg" - not "carrot.jpg")
+NAME_LABELS = [
+    (re.compile(r'(^|[^a-z])rot(ten)?([^a-z]|$)'), 'rotten'),
+    (re.compile(r'(^|[^a-z])fresh([^a-z]|$)'), 'fresh')
+]
+
+
+def load_labels(path):
+    """Labels file: CSV rows of image path (or file name) and freshness label"""
+    labels = {}
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0].startswith('#'):
+                continue
+            label = row[1].strip().lower()
+            if label not in FRESHNESS_LABELS:
+                raise ValueError(f"{path}: unknown label {row[1]!r} for {row[0]}")
+            labels[os.path.normpath(row[0].strip())] = label
+    return labels
+
+
+def label_for(path, labels=None):
+    """
+    Freshness label of an image, or None when it has none
+    - its folder when that is a label (training_data/rotten/x.jpg)
+    - else its entry in labels (load_labels: by path, then by file name)
+    - else a whole word of its file name ("rotten", "rot", "fresh")
+    """
+    folder = os.path.basename(os.path.dirname(path)).lower()
+    if folder in FRESHNESS_LABELS:
+        return folder
+    if labels:
+        label = labels.get(os.path.normpath(path)) or labels.get(os.path.basename(path))
+        if label is not None:
+            return label
+    name = os.path.splitext(os.path.basename(path))[0].lower()
+    for pattern, label in NAME_LABELS:
+        if pattern.search(name):
+            return label
+    return None
+
+
+def find_images(folders):
+    """All images below the given folders, sorted"""
+    paths = []
+    for folder in folders:
+        for root, _, names in os.walk(folder):
+            paths.extend(os.path.join(root, name) for name in names if name.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+def _columns(dtype, prefix=''):
+    """(column name, field path) for every leaf field of a nested structured dtype"""
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        if field.names:
+            for column, path in _columns(field, f"{prefix}{name}."):
+                yield column, (name,) + path
+        else:
+            yield f"{prefix}{name}", (name,)
+
+
+def _field(array, path):
+    for name in path:
+        array = array[name]
+    return array
+
+
+def save_store(path, features, paths, labels, sizes, mtimes):
+    """Write a store (rows are images; features is a FEATURES array)"""
+    columns = {column: _field(features, field) for column, field in _columns(FEATURES)}
+    columns.update({
+        'version': np.array(STORE_VERSION),
+        'path': np.asarray(paths, dtype=str),
+        'label': np.asarray(labels, dtype=str),
+        'size': np.asarray(sizes, dtype=np.int64),
+        'mtime_ns': np.asarray(mtimes, dtype=np.int64)
+    })
+    np.savez_compressed(path, **columns)
+
+
+def load_store(path):
+    """Read a store: dict with 'features' (FEATURES array), 'path', 'label', 'size', 'mtime_ns'"""
+    with np.load(path) as data:
+        if int(data['version']) != STORE_VERSION:
+            raise ValueError(f"{path}: store version {int(data['version'])}, expected {STORE_VERSION}")
+        features = np.zeros(len(data['path']), dtype=FEATURES)
+        for column, field in _columns(FEATURES):
+            _field(features, field)[...] = data[column]
+        return {
+            'features': features,
+            'path': data['path'],
+            'label': data['label'],
+            'size': data['size'],
+            'mtime_ns': data['mtime_ns']
+        }
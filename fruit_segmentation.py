@@ -0,0 +1,149 @@
+"""
+Multi-fruit segmentation
+Finds individual fruit regions in a photo of several fruits (a crate, a
+bowl) so each one can be graded on its own. Works on a small pyramid level:
+- the fruit-color mask (the validator's color rules), cleaned with a
+  morphological close/open, is cut along edges so touching fruits separate
+- peaks of the distance transform of that mask (at least the radius of the
+  smallest fruit kept) seed a watershed that grows one region per fruit
+- a region whose box lies mostly inside a larger one's (or overlaps it by
+  IoU) is part of that fruit and is merged into it
+- when one region holds most of the fruit area the photo is a single fruit
+  and no regions are returned (the whole image is graded)
+- regions are returned as bounding boxes in the coordinates of the
+  uploaded image, largest first
+crop_batch cuts every region out of the analysis image and stacks the crops
+as one N x size x size x 3 model input (one batched forward pass).
+"""
+
+import cv2
+import numpy as np
+
+from color_features import VALIDATOR_FRUIT_RULES, codes_matching, rule_codes
+
+FRUIT_CODES = codes_matching(*VALIDATOR_FRUIT_RULES)
+# Distance-transform peaks must reach this share of the smallest fruit's radius
+PEAK_RADIUS_FRACTION = 0.8
+# A box covered this much by a larger region's box (share of the smaller box), or
+# overlapping it by this IoU, belongs to the same fruit
+CONTAINMENT_OVERLAP = 0.6
+MERGE_IOU = 0.5
+# Single fruit: its region holds at least this share of all fruit-region pixels
+DOMINANT_SHARE = 0.6
+
+
+def fruit_mask(ctx):
+    """uint8 mask (0/1) of pixels matching any validator fruit-color rule"""
+    return FRUIT_CODES[rule_codes(ctx.hsv)].astype(np.uint8)
+
+
+def _disk(radius):
+    return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+
+
+def fruit_markers(ctx, min_area):
+    """
+    Watershed labels of the fruit regions of ctx (int32, H x W): 1 is background,
+    fruits are 2 and up, -1 marks boundaries
+    """
+    mask = fruit_mask(ctx)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, _disk(2))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, _disk(2))
+
+    # Touching fruits of the same color are one blob in the mask; their outlines are edges
+    edges = cv2.Canny(cv2.GaussianBlur(ctx.gray, (5, 5), 0), 30, 90)
+    cut = mask.copy()
+    cut[cv2.dilate(edges, _disk(1)) > 0] = 0
+
+    # One seed per local maximum of the distance to the cut mask's border
+    radius = max(3, int(np.sqrt(min_area * ctx.total_pixels / np.pi) * PEAK_RADIUS_FRACTION))
+    dist = cv2.distanceTransform(cut, cv2.DIST_L2, 5)
+    peaks = (dist >= cv2.dilate(dist, _disk(radius))) & (dist >= radius)
+    _, seeds = cv2.connectedComponents(cv2.dilate(peaks.astype(np.uint8), _disk(1)))
+
+    markers = seeds + 1  # background seed = 1
+    markers[(mask > 0) & (seeds == 0)] = 0  # to be flooded
+    cv2.watershed(ctx.bgr, markers)
+    return markers
+
+
+def box_overlap(a, b):
+    """(intersection / area of the smaller box, IoU) of two x, y, w, h boxes"""
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    if not inter:
+        return 0.0, 0.0
+    area_a, area_b = a[2] * a[3], b[2] * b[3]
+    return inter / min(area_a, area_b), inter / (area_a + area_b - inter)
+
+
+def merge_nested(boxes, areas):
+    """
+    Fold every box that sits inside or mostly on a larger kept one into it
+    boxes/areas largest first; returns [(box, area)] of the kept ones (areas summed)
+    """
+    kept = []
+    for box, area in zip(boxes, areas):
+        for i, (kept_box, kept_area) in enumerate(kept):
+            contained, iou = box_overlap(box, kept_box)
+            if contained >= CONTAINMENT_OVERLAP or iou >= MERGE_IOU:
+                kept[i] = (kept_box, kept_area + area)
+                break
+        else:
+            kept.append((box, area))
+    return kept
+
+
+def find_fruit_regions(ctx, mask_side=256, min_area=0.02, max_regions=12, padding=0.05):
+    """
+    Fruit regions of an image as dicts with 'bbox' (x, y, w, h in upload
+    pixels) and 'area' (share of the image the region covers)
+    - mask_side: longest side of the pyramid level the regions are found on
+    - min_area: smallest region kept, as a share of the image
+    - padding: margin added around each box, as a share of its size
+    Returns [] for a photo of a single fruit (see DOMINANT_SHARE)
+    """
+    level = ctx.working(mask_side)
+    markers = fruit_markers(level, min_area)
+    h, w = markers.shape
+    total = level.total_pixels
+
+    labels = markers.ravel()
+    areas = np.bincount(labels[labels >= 2], minlength=2)[2:]
+    fruit_area = int(areas.sum())
+    order = [label for label in np.argsort(areas)[::-1] + 2 if areas[label - 2] >= total * min_area]
+    boxes = [cv2.boundingRect((markers == label).astype(np.uint8)) for label in order]
+    kept = merge_nested(boxes, [int(areas[label - 2]) for label in order])
+    kept.sort(key=lambda region: region[1], reverse=True)
+    if kept and kept[0][1] >= fruit_area * DOMINANT_SHARE:
+        return []
+
+    regions = []
+    for (x, y, bw, bh), area in kept[:max_regions]:
+        pad_x, pad_y = int(round(bw * padding)), int(round(bh * padding))
+        x0, y0 = max(0, x - pad_x), max(0, y - pad_y)
+        x1, y1 = min(w, x + bw + pad_x), min(h, y + bh + pad_y)
+        # Pyramid level -> upload coordinates
+        regions.append({
+            'bbox': [int(round(v / level.scale)) for v in (x0, y0, x1 - x0, y1 - y0)],
+            'area': area / total
+        })
+    return regions
+
+
+def crop_batch(ctx, regions, size):
+    """
+    Model inputs for every region: RGB crops of ctx resized to size x size and
+    scaled to [0, 1], stacked as float32 N x size x size x 3 (as preprocess_image)
+    """
+    rgb = ctx.rgb
+    h, w = rgb.shape[:2]
+    crops = np.empty((len(regions), size, size, 3), dtype=np.float32)
+    for i, region in enumerate(regions):
+        x, y, bw, bh = (v * ctx.scale for v in region['bbox'])
+        x0, y0 = min(w - 1, int(x)), min(h - 1, int(y))
+        x1, y1 = max(x0 + 1, min(w, int(round(x + bw)))), max(y0 + 1, min(h, int(round(y + bh))))
+        crops[i] = cv2.resize(rgb[y0:y1, x0:x1], (size, size))
+    crops /= 255.0
+    return crops
@@ -0,0 +1,28 @@
+"""
+Gunicorn settings for serving app:app with preload_app
+- The master imports app.py once (Flask app, OpenCV, NumPy) and forks workers
+  that share those pages copy-on-write; TFLite/mmap model files are shared
+  through the page cache (a Keras model is loaded by each worker - app.py
+  serves the .tflite model under preload when it exists)
+- post_fork rebuilds the per-process runtime state in each worker
+Command-line flags (workers, threads, timeouts) still override these values.
+"""
+
+import gc
+import os
+
+# Tell app.py it is being imported by a master that will fork
+os.environ.setdefault('FRUIT_PRELOAD', '1')
+
+preload_app = True
+
+
+def when_ready(server):
+    # Move everything allocated during preload out of the GC's reach, so collections
+    # in the workers don't write to (and un-share) those pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    app.after_fork()
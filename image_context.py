@@ -0,0 +1,259 @@
+import hashlib
+import struct
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from color_features import count_color_rules
+
+
+# DCT-domain reduced JPEG decode, largest reduction first
+REDUCED_DECODE_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+# JPEG start-of-frame markers (baseline, progressive, lossless...) - C4, C8 and CC are not frames
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def read_image_size(data):
+    """
+    (format, width, height) from a JPEG or PNG header without decoding pixels
+    Returns None for other formats or a header that can't be parsed
+    """
+    data = memoryview(data)
+    if bytes(data[:8]) == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        width, height = struct.unpack('>II', data[16:24])
+        return 'png', width, height
+    if bytes(data[:2]) != b'\xff\xd8':
+        return None
+
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # markers without a length field
+            pos += 2
+            continue
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return 'jpeg', width, height
+        pos += 2 + length
+    return None
+
+
+def reduced_decode_flag(image_size, target_side):
+    """Largest JPEG reduction that keeps the longest side at or above target_side"""
+    if not target_side or image_size is None or image_size[0] != 'jpeg':
+        return 1, cv2.IMREAD_COLOR
+    longest = max(image_size[1:])
+    for factor, flag in REDUCED_DECODE_FLAGS:
+        if longest / factor >= target_side:
+            return factor, flag
+    return 1, cv2.IMREAD_COLOR
+
+
+class ImageContext:
+    """
+    Per-request image holder - decode once, derive lazily
+    - Keeps the raw upload bytes (for hashing) and the decoded BGR image
+    - Color planes, color-rule counts and edges are computed on first use and cached
+    - center gives a child context over the middle 70% of the image
+    - working(max_side) gives a child context at a smaller pyramid level;
+      scale records its size relative to the original upload
+    """
+
+    def __init__(self, bgr, raw=None, scale=1.0):
+        self.raw = raw
+        self._bgr = bgr
+        self.scale = scale
+        self.decode_ms = None
+        self.reduction = 1
+        self._cache = {}
+        self._center = None
+        self._pyramid = None
+
+    @classmethod
+    def from_bytes(cls, data, sha256=None, target_side=None):
+        """
+        Decode an encoded image buffer (JPEG, PNG, WebP...)
+        data may be bytes or a memoryview; sha256 can be passed in when it
+        was already computed while the upload streamed in
+        With target_side set, large JPEGs are decoded at 1/2, 1/4 or 1/8 scale
+        in the DCT domain, keeping the longest side >= target_side
+        """
+        start = time.perf_counter()
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        image_size = read_image_size(data) if target_side else None
+        factor, flag = reduced_decode_flag(image_size, target_side)
+        bgr = cv2.imdecode(buffer, flag) if buffer.size else None
+        if bgr is None and factor > 1:
+            # Header parsed but the reduced decoder refused it - fall back to a full decode
+            factor, bgr = 1, cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+        scale = 1.0
+        if bgr is not None and factor > 1:
+            scale = max(bgr.shape[:2]) / max(image_size[1:])
+        ctx = cls(bgr, raw=data, scale=scale)
+        ctx.decode_ms = (time.perf_counter() - start) * 1000.0
+        ctx.reduction = factor
+        if sha256 is not None:
+            ctx._cache['sha256'] = sha256
+        return ctx
+
+    @classmethod
+    def from_file(cls, image_path):
+        """Read the file once and decode it from memory"""
+        try:
+            with open(image_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return cls(None)
+        return cls.from_bytes(data)
+
+    @classmethod
+    def from_source(cls, image):
+        """Accept an ImageContext, a file path or a BGR array"""
+        if isinstance(image, ImageContext):
+            return image
+        if isinstance(image, np.ndarray):
+            return cls(image)
+        return cls.from_file(image)
+
+    @property
+    def is_valid(self):
+        return self._bgr is not None
+
+    @property
+    def shape(self):
+        return self._bgr.shape
+
+    @property
+    def total_pixels(self):
+        return self._bgr.shape[0] * self._bgr.shape[1]
+
+    def _cached(self, key, compute):
+        value = self._cache.get(key)
+        if value is None:
+            value = compute()
+            self._cache[key] = value
+        return value
+
+    def memo(self, key, compute):
+        """Cache a value derived from this image for the other pipeline stages (e.g. feature vectors)"""
+        return self._cached(key, compute)
+
+    @property
+    def bgr(self):
+        return self._bgr
+
+    @property
+    def rgb(self):
+        return self._cached('rgb', lambda: cv2.cvtColor(self._bgr, cv2.COLOR_BGR2RGB))
+
+    @property
+    def hsv(self):
+        return self._cached('hsv', lambda: cv2.cvtColor(self._bgr, cv2.COLOR_BGR2HSV))
+
+    @property
+    def gray(self):
+        return self._cached('gray', lambda: cv2.cvtColor(self._bgr, cv2.COLOR_BGR2GRAY))
+
+    @property
+    def edges(self):
+        """Canny edges (100, 200) of the grayscale plane"""
+        return self._cached('edges', lambda: cv2.Canny(self.gray, 100, 200))
+
+    @property
+    def color_rules(self):
+        """Pixel counts of every HSV color rule (color_features.COLOR_RULES), one pass"""
+        return self._cached('color_rules', lambda: count_color_rules(self.hsv))
+
+    @property
+    def center(self):
+        """Child context over the center region (15%-85% on both axes)"""
+        if self._center is None:
+            h, w = self._bgr.shape[:2]
+            crop = self._bgr[int(h * 0.15):int(h * 0.85), int(w * 0.15):int(w * 0.85)]
+            self._center = ImageContext(crop, scale=self.scale)
+        return self._center
+
+    # ===== RESOLUTION =====
+
+    def working(self, max_side):
+        """
+        Context at the largest pyramid level whose longest side is <= max_side
+        - Levels are built once by repeated pyrDown (blur + halve) and shared
+        - max_side of 0/None, or an image already small enough, returns self
+        """
+        if not max_side or max(self._bgr.shape[:2]) <= max_side:
+            return self
+        if self._pyramid is None:
+            self._pyramid = [self]
+        for level in self._pyramid:
+            if max(level.shape[:2]) <= max_side:
+                return level
+        level = self._pyramid[-1]
+        while max(level.shape[:2]) > max_side:
+            smaller = cv2.pyrDown(level.bgr)
+            level = ImageContext(smaller, scale=self.scale * smaller.shape[1] / self._bgr.shape[1])
+            self._pyramid.append(level)
+        return level
+
+    def scale_length(self, pixels):
+        """A length tuned at full resolution, expressed at this context's resolution"""
+        return pixels * self.scale
+
+    def scale_area(self, pixels):
+        """An area tuned at full resolution, expressed at this context's resolution"""
+        return pixels * self.scale * self.scale
+
+    def resized_rgb(self, size):
+        """RGB image resized to (size, size) for the model"""
+        return self._cached(('resized_rgb', size), lambda: cv2.resize(self.rgb, (size, size)))
+
+    def sha256(self):
+        """SHA-256 of the original upload bytes"""
+        if self.raw is None:
+            return None
+        return self._cached('sha256', lambda: hashlib.sha256(self.raw).hexdigest())
+
+
+class DecodeStats:
+    """Decode time and JPEG reduction factor per request, for /metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._total_ms = 0.0
+        self._max_ms = 0.0
+        self._reductions = {}
+
+    def record(self, ctx):
+        if ctx.decode_ms is None:
+            return
+        with self._lock:
+            self._count += 1
+            self._total_ms += ctx.decode_ms
+            self._max_ms = max(self._max_ms, ctx.decode_ms)
+            self._reductions[ctx.reduction] = self._reductions.get(ctx.reduction, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'decodes': self._count,
+                'avg_decode_ms': (self._total_ms / self._count) if self._count else 0.0,
+                'max_decode_ms': self._max_ms,
+                'reduction_histogram': dict(sorted(self._reductions.items()))
+            }
@@ -0,0 +1,346 @@
+"""
+Pluggable inference backends for the freshness model
+- KerasBackend: the original .h5 model through tf.keras
+- TFLiteBackend: the converted .tflite model with a per-thread interpreter pool
+Both take a float32 batch (N x 128 x 128 x 3, values in [0, 1]) and return
+an N x 5 array of class probabilities.
+"""
+
+import argparse
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+def load_tflite_interpreter_class():
+    """
+    Import the lightest available TFLite interpreter
+    Returns: (Interpreter class, runtime name) - tflite_runtime and ai_edge_litert
+    start in well under a second, full TensorFlow is only the last resort
+    """
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter, 'tflite_runtime'
+    except ImportError:
+        pass
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter, 'ai_edge_litert'
+    except ImportError:
+        pass
+    import tensorflow as tf
+    return tf.lite.Interpreter, 'tensorflow'
+
+
+class KerasBackend:
+    """
+    The original .h5 model through tf.keras
+    With lazy=True neither TensorFlow nor the model is loaded until the
+    first prediction, so worker start-up stays cheap
+    """
+
+    name = 'keras'
+
+    def __init__(self, model_path, lazy=False):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(model_path)
+        self.model_path = model_path
+        self.runtime = 'tensorflow'
+        self.model = None
+        self.timings = {'import_s': None, 'model_load_s': None}
+        self._load_lock = threading.Lock()
+        if not lazy:
+            self.load()
+
+    def reset_after_fork(self):
+        """Nothing to rebuild - the model is only ever loaded inside the worker process"""
+        pass
+
+    def load(self):
+        """Import TensorFlow and load the model (once)"""
+        with self._load_lock:
+            if self.model is not None:
+                return
+            start = time.perf_counter()
+            import tensorflow as tf
+            imported = time.perf_counter()
+            self.model = tf.keras.models.load_model(self.model_path)
+            self.timings['import_s'] = imported - start
+            self.timings['model_load_s'] = time.perf_counter() - imported
+            print(f"[Startup] TensorFlow import {self.timings['import_s']:.2f}s | "
+                  f"model load {self.timings['model_load_s']:.2f}s")
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def predict_batch(self, batch):
+        if self.model is None:
+            self.load()
+        return self.model.predict(batch, verbose=0)
+
+    def stats(self):
+        return {'runtime': self.runtime, 'loaded': self.loaded, **self.timings}
+
+
+class _PooledInterpreter:
+    """One allocated interpreter plus the batch size its tensors are currently sized for"""
+
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+        self.input = interpreter.get_input_details()[0]
+        self.output = interpreter.get_output_details()[0]
+        self.batch_size = int(self.input['shape'][0])
+
+    def resize(self, batch_size):
+        if batch_size == self.batch_size:
+            return
+        shape = list(self.input['shape'])
+        shape[0] = batch_size
+        self.interpreter.resize_tensor_input(self.input['index'], shape)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = batch_size
+
+
+class TFLiteBackend:
+    """
+    TFLite serving backend
+    - Interpreters are not thread-safe, so each thread is bound to its own one
+    - pool_size interpreters are created and allocated up front
+    - num_threads sets the XNNPACK/CPU thread count of every interpreter
+    - float32, float16 and uint8 (quantized) model inputs are supported;
+      callers may pass float batches in [0, 1] or raw uint8 pixels
+    - Interpreters read the model through a read-only mmap of the file, so
+      every worker process shares the same page-cache copy of the weights
+    - defer_pool=True validates the model but creates no interpreters, for a
+      gunicorn master that forks workers (call reset_after_fork() in each)
+    """
+
+    name = 'tflite'
+
+    loaded = True
+
+    def __init__(self, model_path, pool_size=4, num_threads=1, defer_pool=False):
+        self.model_path = model_path
+        self.pool_size = max(1, int(pool_size))
+        self.num_threads = max(1, int(num_threads))
+
+        start = time.perf_counter()
+        self._interpreter_class, self.runtime = load_tflite_interpreter_class()
+        imported = time.perf_counter()
+
+        # Probe once for the input spec; this also pulls the model into the page cache
+        probe = self._new_interpreter(count=False)
+        self.input_dtype = np.dtype(probe.input['dtype'])
+        del probe
+
+        self._init_pool()
+        if not defer_pool:
+            self._fill_pool()
+        self.timings = {'import_s': imported - start, 'model_load_s': time.perf_counter() - imported}
+
+    def _init_pool(self):
+        self._free = queue.Queue()
+        self._local = threading.local()
+        self._created = 0
+        self._created_lock = threading.Lock()
+
+    def _fill_pool(self):
+        for _ in range(self.pool_size):
+            self._free.put(self._new_interpreter())
+
+    def warm_idle_interpreters(self, batch):
+        """Run every interpreter still waiting in the pool once, so no thread gets a cold one"""
+        idle = []
+        while True:
+            try:
+                idle.append(self._free.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            for pooled in idle:
+                pooled.resize(len(batch))
+                pooled.interpreter.set_tensor(pooled.input['index'], self._prepare_input(batch, pooled.input))
+                pooled.interpreter.invoke()
+        finally:
+            for pooled in idle:
+                self._free.put(pooled)
+        return len(idle)
+
+    def reset_after_fork(self):
+        """Drop interpreters inherited from the parent process and build a fresh pool"""
+        self._init_pool()
+        self._fill_pool()
+
+    def _new_interpreter(self, count=True):
+        interpreter = self._interpreter_class(model_path=self.model_path, num_threads=self.num_threads)
+        interpreter.allocate_tensors()
+        if count:
+            with self._created_lock:
+                self._created += 1
+        return _PooledInterpreter(interpreter)
+
+    def _thread_interpreter(self):
+        pooled = getattr(self._local, 'interpreter', None)
+        if pooled is None:
+            try:
+                pooled = self._free.get_nowait()
+            except queue.Empty:
+                # More threads than pre-allocated interpreters - grow the pool
+                pooled = self._new_interpreter()
+            self._local.interpreter = pooled
+        return pooled
+
+    def _prepare_input(self, batch, details):
+        batch = np.asarray(batch)
+        dtype = np.dtype(details['dtype'])
+        if dtype == np.uint8 or dtype == np.int8:
+            scale, zero_point = details['quantization']
+            if batch.dtype == np.uint8:
+                batch = batch.astype(np.float32) / 255.0
+            if scale:
+                batch = np.round(batch / scale + zero_point)
+            info = np.iinfo(dtype)
+            return np.clip(batch, info.min, info.max).astype(dtype)
+        if batch.dtype == np.uint8:
+            batch = batch.astype(np.float32) / 255.0
+        return batch.astype(dtype, copy=False)
+
+    def _read_output(self, pooled):
+        output = pooled.interpreter.get_tensor(pooled.output['index'])
+        if output.dtype in (np.uint8, np.int8):
+            scale, zero_point = pooled.output['quantization']
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output.astype(np.float32, copy=False)
+
+    def predict_batch(self, batch):
+        pooled = self._thread_interpreter()
+        pooled.resize(len(batch))
+        pooled.interpreter.set_tensor(pooled.input['index'], self._prepare_input(batch, pooled.input))
+        pooled.interpreter.invoke()
+        return self._read_output(pooled).copy()
+
+    def stats(self):
+        return {
+            'runtime': self.runtime,
+            **self.timings,
+            'interpreters': self._created,
+            'idle_interpreters': self._free.qsize(),
+            'num_threads': self.num_threads,
+            'input_dtype': str(self.input_dtype)
+        }
+
+
+class MappedTFLiteBackend(TFLiteBackend):
+    """
+    TFLite backend over a verified .fmm artifact (see model_artifact.py)
+    - The artifact is checked before any interpreter is built, including the
+      payload hash (one full read at load), so a stale, mismatched or corrupt
+      export is refused at start-up
+    - The check's own mapping is closed again: the interpreters map the file
+      themselves (the flatbuffer sits at offset 0), so the weights live once
+      in the page cache, shared by every interpreter and worker
+    """
+
+    name = 'mmap'
+
+    def __init__(self, artifact_path, source_path=None, pool_size=4, num_threads=1, defer_pool=False):
+        from model_artifact import open_artifact
+        artifact = open_artifact(artifact_path, source_path=source_path, verify_payload=True)
+        self.artifact_fingerprint = artifact.fingerprint
+        self.artifact_metadata = artifact.metadata
+        artifact.close()
+        super().__init__(artifact_path, pool_size=pool_size, num_threads=num_threads, defer_pool=defer_pool)
+
+    def stats(self):
+        return {
+            **super().stats(),
+            'artifact_fingerprint': self.artifact_fingerprint,
+            'artifact_created': self.artifact_metadata.get('created')
+        }
+
+
+def create_backend(name, keras_model_path, tflite_model_path, pool_size=4, num_threads=1, lazy=False,
+                   preload=False, mmap_model_path=None):
+    """
+    Build the backend selected by configuration ('keras', 'tflite' or 'mmap')
+    preload=True means we are in a gunicorn master that will fork: only
+    fork-safe state is created here. TensorFlow's runtime threads do not
+    survive fork(), so the Keras model always loads inside the worker - one
+    copy per worker; only the tflite/mmap backends share their weights.
+    """
+    if name == 'tflite':
+        return TFLiteBackend(tflite_model_path, pool_size=pool_size, num_threads=num_threads, defer_pool=preload)
+    if name == 'mmap':
+        return MappedTFLiteBackend(mmap_model_path, source_path=keras_model_path, pool_size=pool_size,
+                                   num_threads=num_threads, defer_pool=preload)
+    if name == 'keras':
+        return KerasBackend(keras_model_path, lazy=lazy or preload)
+    raise ValueError(f"Unknown inference backend: {name}")
+
+
+def benchmark_backends(backends, inputs, runs=20, warmup=2):
+    """
+    Time each backend on the same inputs
+    Returns: {backend name: {mean_ms, p50_ms, p95_ms, max_abs_diff}}, where
+    max_abs_diff compares outputs with the first backend
+    """
+    results = {}
+    reference = None
+    for backend in backends:
+        for _ in range(warmup):
+            backend.predict_batch(inputs)
+
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            outputs = np.asarray(backend.predict_batch(inputs))
+            timings.append((time.perf_counter() - start) * 1000.0)
+
+        if reference is None:
+            reference = outputs
+        timings = np.array(timings)
+        results[backend.name] = {
+            'mean_ms': float(np.mean(timings)),
+            'p50_ms': float(np.percentile(timings, 50)),
+            'p95_ms': float(np.percentile(timings, 95)),
+            'max_abs_diff': float(np.max(np.abs(outputs - reference)))
+        }
+    return results
+
+
+def load_benchmark_inputs(folder, batch_size):
+    """Preprocess up to batch_size images from a folder exactly as /predict does"""
+    from image_context import ImageContext
+    files = sorted(f for f in os.listdir(folder) if f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')))
+    images = [ImageContext.from_file(os.path.join(folder, f)).resized_rgb(128) for f in files[:batch_size]]
+    return np.stack(images).astype('float32') / 255.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare Keras and TFLite serving latency on the same inputs')
+    parser.add_argument('--images', default='img', help='Folder of sample images')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=1, help='TFLite XNNPACK threads')
+    parser.add_argument('--keras-model', default='fruit_freshness_model.h5')
+    parser.add_argument('--tflite-model', default='fruit_freshness_model.tflite')
+    args = parser.parse_args()
+
+    inputs = load_benchmark_inputs(args.images, args.batch_size)
+    print(f"Benchmarking on {len(inputs)} image(s) from {args.images}, {args.runs} runs each")
+
+    backends = []
+    if os.path.exists(args.keras_model):
+        backends.append(KerasBackend(args.keras_model))
+    if os.path.exists(args.tflite_model):
+        backends.append(TFLiteBackend(args.tflite_model, pool_size=1, num_threads=args.threads))
+
+    for name, result in benchmark_backends(backends, inputs, runs=args.runs).items():
+        print(f"{name:8s} | mean {result['mean_ms']:7.2f} ms | p50 {result['p50_ms']:7.2f} ms | "
+              f"p95 {result['p95_ms']:7.2f} ms | max diff {result['max_abs_diff']:.5f}")
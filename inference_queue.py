@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class _PendingRequest:
+    """One caller waiting for its slice of a batched forward pass"""
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.rows = inputs.shape[0]
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchingPredictor:
+    """
+    Dynamic micro-batching between Flask handlers and the model
+    - Handlers submit preprocessed tensors (N x 128 x 128 x 3) to a shared queue
+    - One inference thread gathers up to max_batch_size rows, or waits at most
+      max_wait_ms after the first item arrives, and runs a single forward pass
+    - Each caller gets back only the rows it submitted
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=5):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._rows = 0
+        self._max_depth = 0
+        self._batch_size_counts = {}
+
+    def start(self):
+        """Start the inference thread (safe to call more than once)"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='batching-predictor', daemon=True)
+            self._thread.start()
+
+    def predict(self, inputs, timeout=None):
+        """Queue inputs for the next batch and block until their predictions are ready"""
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if inputs.ndim == 3:
+            inputs = np.expand_dims(inputs, axis=0)
+
+        self.start()
+        pending = _PendingRequest(inputs)
+        with self._cond:
+            self._queue.append(pending)
+            depth = len(self._queue)
+            self._cond.notify()
+
+        with self._stats_lock:
+            self._max_depth = max(self._max_depth, depth)
+
+        if not pending.done.wait(timeout):
+            raise TimeoutError('Timed out waiting for batched prediction')
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect_batch(self):
+        """Block for the first request, then gather more until full or the wait expires"""
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+
+            batch = [self._queue.popleft()]
+            rows = batch[0].rows
+            deadline = time.monotonic() + self.max_wait
+
+            while rows < self.max_batch_size:
+                if not self._queue:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                    continue
+                # Never split a caller's rows across two forward passes
+                if rows + self._queue[0].rows > self.max_batch_size:
+                    break
+                pending = self._queue.popleft()
+                batch.append(pending)
+                rows += pending.rows
+
+        return batch, rows
+
+    def _run(self):
+        while True:
+            batch, rows = self._collect_batch()
+            try:
+                if len(batch) == 1:
+                    inputs = batch[0].inputs
+                else:
+                    inputs = np.concatenate([pending.inputs for pending in batch], axis=0)
+                outputs = np.asarray(self.predict_fn(inputs))
+
+                offset = 0
+                for pending in batch:
+                    pending.result = outputs[offset:offset + pending.rows]
+                    offset += pending.rows
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            finally:
+                for pending in batch:
+                    pending.done.set()
+
+            with self._stats_lock:
+                self._batches += 1
+                self._rows += rows
+                self._batch_size_counts[rows] = self._batch_size_counts.get(rows, 0) + 1
+
+    def queue_depth(self):
+        """Number of requests currently waiting for a batch"""
+        with self._cond:
+            return len(self._queue)
+
+    def stats(self):
+        """Queue depth and realized batch sizes for throughput/latency tuning"""
+        with self._stats_lock:
+            batches = self._batches
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'queue_depth': self.queue_depth(),
+                'max_queue_depth': self._max_depth,
+                'batches': batches,
+                'rows': self._rows,
+                'avg_batch_size': (self._rows / batches) if batches else 0.0,
+                'batch_size_histogram': dict(sorted(self._batch_size_counts.items()))
+            }
+
+
+class DirectPredictor:
+    """Same interface as BatchingPredictor, but runs each request in the calling thread"""
+
+    def __init__(self, predict_fn):
+        self.predict_fn = predict_fn
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def start(self):
+        pass
+
+    def predict(self, inputs, timeout=None):
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if inputs.ndim == 3:
+            inputs = np.expand_dims(inputs, axis=0)
+        with self._lock:
+            self._calls += 1
+        return np.asarray(self.predict_fn(inputs))
+
+    def stats(self):
+        with self._lock:
+            return {'max_batch_size': None, 'batches': self._calls, 'queue_depth': 0}
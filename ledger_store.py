@@ -0,0 +1,339 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development server only
+    fcntl = None
+
+# Every record: payload length and CRC-32 of the payload, then the payload
+RECORD_HEADER = struct.Struct('<II')
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+
+# Snapshot: magic, version, verified-up-to index, its hash (SHA-256), time of the last deep
+# check, then the tip's position (first index of its segment, end offset of its record);
+# followed by the CRC-32 of all that
+SNAPSHOT = struct.Struct('<8sIq32sdqq')
+SNAPSHOT_CRC = struct.Struct('<I')
+SNAPSHOT_MAGIC = b'FRLEDGER'
+SNAPSHOT_VERSION = 1
+
+
+def segment_name(first_index):
+    """Segments are named after the index of their first block, so they sort in chain order"""
+    return f"{SEGMENT_PREFIX}{first_index:012d}{SEGMENT_SUFFIX}"
+
+
+def list_segments(directory):
+    """Segment file paths of a ledger directory in chain order"""
+    names = sorted(name for name in os.listdir(directory)
+                   if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+    return [os.path.join(directory, name) for name in names]
+
+
+def segment_first_index(path):
+    """Index of the first block in a segment, from its file name"""
+    return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+def record_offsets(data, count=None):
+    """
+    Offsets of the first count complete records in a segment (all when None),
+    walking the headers only
+    Returns: (offsets, end) - end is the offset just past the last one
+    """
+    offsets = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data) and (count is None or len(offsets) < count):
+        length, _ = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + length
+        if end > len(data):
+            break
+        offsets.append(offset)
+        offset = end
+    return offsets, offset
+
+
+def read_record(data, offset):
+    """Payload of the record at offset (ValueError if its CRC doesn't match)"""
+    length, crc = RECORD_HEADER.unpack_from(data, offset)
+    payload = bytes(data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length])
+    if len(payload) < length or zlib.crc32(payload) != crc:
+        raise ValueError(f"Corrupt ledger record at byte {offset}")
+    return payload
+
+
+def write_snapshot(path, snapshot):
+    """
+    Write a snapshot dict (index, hash, deep_verified_at, segment_first_index, end)
+    atomically: a crash leaves the previous snapshot in place
+    """
+    body = SNAPSHOT.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, snapshot['index'], bytes.fromhex(snapshot['hash']),
+                         snapshot['deep_verified_at'], snapshot['segment_first_index'], snapshot['end'])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(body + SNAPSHOT_CRC.pack(zlib.crc32(body)))
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    """Snapshot dict written by write_snapshot, or None if missing or unreadable"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if len(data) != SNAPSHOT.size + SNAPSHOT_CRC.size or \
+            SNAPSHOT_CRC.unpack_from(data, SNAPSHOT.size)[0] != zlib.crc32(data[:SNAPSHOT.size]):
+        print(f"[Ledger] Ignoring unreadable snapshot {path}")
+        return None
+    magic, version, index, block_hash, deep_verified_at, segment_first, end = SNAPSHOT.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        print(f"[Ledger] Ignoring snapshot {path} (version {version})")
+        return None
+    return {
+        'index': index,
+        'hash': block_hash.hex(),
+        'deep_verified_at': deep_verified_at,
+        'segment_first_index': segment_first,
+        'end': end
+    }
+
+
+def scan_records(data, start=0):
+    """
+    Complete, CRC-valid records in data from offset start
+    Returns: (payloads, end) - end is the offset just past the last good record
+    """
+    payloads = []
+    offset = start
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        payload_start = offset + RECORD_HEADER.size
+        payload = bytes(data[payload_start:payload_start + length])
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        payloads.append(payload)
+        offset = payload_start + length
+    return payloads, offset
+
+
+class SegmentLog:
+    """
+    Append-only record log split into segment files
+    - One framed record per append (length + CRC-32 + payload), so an insert
+      costs the same however long the log is
+    - fsync after every fsync_every records and/or at most fsync_interval_ms
+      after an unsynced append (a timer fires if no later append does it);
+      0 disables either trigger; sync() forces it
+    - A torn record at the tail (crash mid-write) is truncated away on read
+    - Several processes may share a log: appends hold an exclusive flock and
+      first read what the others appended (read_new)
+    """
+
+    def __init__(self, directory, segment_max_bytes=64 * 1024 * 1024, fsync_every=1, fsync_interval_ms=0):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_every = max(0, int(fsync_every))
+        self.fsync_interval = max(0.0, float(fsync_interval_ms)) / 1000.0
+        os.makedirs(directory, exist_ok=True)
+
+        self._path = None  # segment we append to
+        self._offset = 0  # bytes of it read or written by this process
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._timer = None  # pending fsync_interval_ms deadline
+        self.recovered_bytes = 0
+        self.fsyncs = 0
+        self._open_lock()
+
+    def _open_lock(self):
+        self._lock = threading.Lock()
+        self._lock_file = open(os.path.join(self.directory, 'LOCK'), 'a+')
+
+    def reset_after_fork(self):
+        """flock and file offsets are shared with the parent after fork() - reopen them"""
+        self._open_lock()
+        self._timer = None  # threads don't survive fork()
+        if self._file is not None:
+            self._file = open(self._path, 'ab')
+
+    # ===== LOCKING =====
+
+    @contextmanager
+    def exclusive(self):
+        """Hold the log for this thread and process (read_new + append as one step)"""
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    # ===== READING =====
+
+    def segments(self):
+        """Segment file paths in chain order"""
+        return list_segments(self.directory)
+
+    def _read_segment(self, path, start, is_last):
+        with open(path, 'rb') as f:
+            data = f.read()
+        payloads, end = scan_records(data, start)
+        if end < len(data):
+            if not is_last:
+                raise ValueError(f"Ledger segment {path} is corrupt at byte {end} (not at the tail - not truncating)")
+            # Torn tail: the writer died mid-record; nothing after it was ever acknowledged
+            print(f"[Ledger] Truncating torn record at {os.path.basename(path)}:{end} ({len(data) - end} bytes)")
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+            self.recovered_bytes += len(data) - end
+        return payloads, end
+
+    def read_all(self):
+        """Every record payload in the log, in order (recovers a torn tail)"""
+        payloads = []
+        with self.exclusive():
+            segments = self.segments()
+            for i, path in enumerate(segments):
+                records, end = self._read_segment(path, 0, is_last=(i == len(segments) - 1))
+                payloads.extend(records)
+                self._path, self._offset = path, end
+            self._reopen()
+        return payloads
+
+    def read_new(self):
+        """
+        Records other processes appended since this process last read or wrote
+        (call while holding exclusive())
+        """
+        if self._path is None:
+            return self._read_segments(self.segments())
+        size = os.path.getsize(self._path)
+        # Writers only start a new segment once the current one is full
+        rolled = size >= self.segment_max_bytes and self._has_later_segment()
+        if size == self._offset and not rolled:
+            return []
+        return self._read_segments([self._path] + ([path for path in self.segments() if path > self._path] if rolled else []))
+
+    def read_from(self, path, offset):
+        """Records from offset in segment path on, through all later segments (appends continue after them)"""
+        with self.exclusive():
+            self._path, self._offset = path, offset
+            return self._read_segments([path] + [later for later in self.segments() if later > path])
+
+    def _read_segments(self, segments):
+        payloads = []
+        for i, path in enumerate(segments):
+            start = self._offset if path == self._path else 0
+            records, end = self._read_segment(path, start, is_last=(i == len(segments) - 1))
+            payloads.extend(records)
+            self._path, self._offset = path, end
+        self._reopen()
+        return payloads
+
+    def position(self):
+        """(segment path, offset) just past the last record read or written by this process"""
+        return self._path, self._offset
+
+    def _has_later_segment(self):
+        segments = self.segments()
+        return bool(segments) and segments[-1] > self._path
+
+    # ===== WRITING =====
+
+    def _reopen(self):
+        if self._file is not None and self._file.name == self._path:
+            return
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self._path, 'ab') if self._path else None
+
+    def _start_segment(self, first_index):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+        self._path = os.path.join(self.directory, segment_name(first_index))
+        self._offset = 0
+        self._file = open(self._path, 'ab')
+        # Make the new file's directory entry durable too
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def append(self, payload, index):
+        """
+        Append one record (call while holding exclusive(), after read_new())
+        index is the block index, used to name a new segment
+        """
+        if self._file is None or self._offset >= self.segment_max_bytes:
+            self._start_segment(index)
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        self._file.write(record)
+        self._file.flush()
+        self._offset += len(record)
+        self._unsynced += 1
+
+        due = self.fsync_every and self._unsynced >= self.fsync_every
+        if self.fsync_interval and time.monotonic() - self._last_sync >= self.fsync_interval:
+            due = True
+        if due:
+            self.sync()
+        elif self.fsync_interval:
+            self._arm_timer()
+
+    def _arm_timer(self):
+        """Sync by the interval deadline even if no further append comes"""
+        if self._timer is None:
+            delay = max(0.0, self.fsync_interval - (time.monotonic() - self._last_sync))
+            self._timer = threading.Timer(delay, self._timed_sync)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timed_sync(self):
+        with self._lock:
+            self._timer = None
+            self.sync()
+
+    def sync(self):
+        """fsync everything appended so far"""
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self.fsyncs += 1
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """sync and release the segment and lock files"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._lock_file.close()
+
+    def stats(self):
+        return {
+            'directory': self.directory,
+            'segments': len(self.segments()),
+            'current_segment': os.path.basename(self._path) if self._path else None,
+            'current_segment_bytes': self._offset,
+            'unsynced_records': self._unsynced,
+            'fsyncs': self.fsyncs,
+            'fsync_every': self.fsync_every,
+            'fsync_interval_ms': self.fsync_interval * 1000.0,
+            'recovered_bytes': self.recovered_bytes
+        }
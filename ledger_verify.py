@@ -0,0 +1,365 @@
+"""
+Parallel deep verification of the ledger
+Re-checks every block of a ledger directory (ledger_store segment files) on
+all CPU cores, reading the stored records rather than a loaded chain:
+- the record boundaries of every segment are found once (headers only) and
+  each segment is split into byte ranges; a process pool recomputes the
+  SHA-256 of each block in a range, compares it with the stored hash and
+  checks the links inside the range
+- the parts are then joined in order: block indices must be contiguous and
+  each part's first previous_hash must be the hash the part before ended on
+- the result names the first bad block (and why)
+A record still being written at the very end of the ledger is left out, so a
+running server can be audited.
+VerifyJobs runs verifications for the admin endpoint as a separate process
+(this script with --status-file), so the pool never re-imports the server.
+
+Usage:
+  python ledger_verify.py [ledger_dir] [--workers N] [--status-file job.json]
+"""
+import argparse
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development server only
+    fcntl = None
+
+from blockchain import Block
+from ledger_store import RECORD_HEADER, list_segments, record_offsets
+
+# Parts per pool worker, so a slow part doesn't leave the other cores idle
+PARTS_PER_WORKER = 4
+
+
+def split_segment(path, parts):
+    """
+    Byte ranges (start, end) of up to `parts` runs of whole records in a segment,
+    and the bytes after its last complete record
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return [], 0
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offsets, end = record_offsets(data)
+    bounds = sorted({len(offsets) * part // parts for part in range(parts + 1)})
+    ranges = [(offsets[lo], offsets[hi] if hi < len(offsets) else end) for lo, hi in zip(bounds, bounds[1:])]
+    return ranges, size - end
+
+
+def verify_range(path, start, end):
+    """
+    Verify the records in bytes start..end of one segment file (runs in a pool worker)
+    Returns a summary: first/last index and hash of the range, and the first
+    bad block in it (bad_index None with a reason: the range's first record)
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    summary = {
+        'blocks': 0,
+        'first_index': None,
+        'first_previous_hash': None,
+        'last_index': None,
+        'last_hash': None,
+        'bad_index': None,
+        'reason': None,
+        'trailing_bytes': 0
+    }
+
+    for offset in record_offsets(data)[0]:
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+        expected_index = summary['last_index'] + 1 if summary['last_index'] is not None else None
+        if zlib.crc32(payload) != crc:
+            summary.update(bad_index=expected_index, reason='corrupt record')
+            return summary
+        block_data = json.loads(payload)
+        index = block_data['index']
+
+        if summary['first_index'] is None:
+            summary['first_index'] = index
+            summary['first_previous_hash'] = block_data['previous_hash']
+        elif index != expected_index:
+            summary.update(bad_index=expected_index, reason='index gap')
+            return summary
+        elif block_data['previous_hash'] != summary['last_hash']:
+            summary.update(bad_index=index, reason='broken link')
+            return summary
+
+        block = Block.from_dict(block_data)
+        if block.calculate_hash() != block.hash:
+            summary.update(bad_index=index, reason='hash mismatch')
+            return summary
+        summary['blocks'] += 1
+        summary['last_index'] = index
+        summary['last_hash'] = block.hash
+    return summary
+
+
+def verify_ledger(directory, workers=None, progress=None):
+    """
+    Verify every block of the ledger in directory with a pool of `workers`
+    processes (default: one per CPU)
+    - progress(parts_done, parts_total, blocks_verified) is called as parts finish
+    Returns: dict with is_valid, blocks, first_invalid_index, reason, last_index,
+             last_hash, elapsed_s
+    """
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    segments = list_segments(directory) if os.path.isdir(directory) else []
+    parts = max(1, -(-workers * PARTS_PER_WORKER // max(1, len(segments))))
+    tasks, trailing = [], []
+    for path in segments:
+        ranges, trailing_bytes = split_segment(path, parts)
+        if not ranges:
+            ranges = [(0, 0)]
+        tasks.extend((path, range_start, range_end) for range_start, range_end in ranges)
+        trailing.extend([0] * (len(ranges) - 1) + [trailing_bytes])
+
+    summaries = [None] * len(tasks)
+    blocks_done = 0
+    if workers == 1:
+        for i, task in enumerate(tasks):
+            summaries[i] = verify_range(*task)
+            blocks_done += summaries[i]['blocks']
+            if progress is not None:
+                progress(i + 1, len(tasks), blocks_done)
+    else:
+        # spawn, not fork: the caller may be a threaded server process
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = {pool.submit(verify_range, *task): i for i, task in enumerate(tasks)}
+            for done, future in enumerate(as_completed(futures), 1):
+                summaries[futures[future]] = future.result()
+                blocks_done += summaries[futures[future]]['blocks']
+                if progress is not None:
+                    progress(done, len(tasks), blocks_done)
+    for summary, trailing_bytes in zip(summaries, trailing):
+        summary['trailing_bytes'] = trailing_bytes
+
+    result = {
+        'is_valid': True,
+        'blocks': 0,
+        'first_invalid_index': None,
+        'reason': None,
+        'last_index': None,
+        'last_hash': None,
+        'segments': len(segments),
+        'parts': len(tasks),
+        'workers': workers,
+        'unverified_tail_bytes': 0
+    }
+
+    # Join the parts in chain order; the first failure wins
+    last_index, last_hash = -1, '0'
+    for i, summary in enumerate(summaries):
+        bad_index, reason = None, None
+        if summary['first_index'] is not None and summary['first_index'] != last_index + 1:
+            bad_index, reason = last_index + 1, 'index gap'
+        elif summary['first_index'] is not None and last_index >= 0 and summary['first_previous_hash'] != last_hash:
+            bad_index, reason = summary['first_index'], 'broken link'
+        elif summary['reason'] is not None:
+            bad_index = summary['bad_index'] if summary['bad_index'] is not None else last_index + 1
+            reason = summary['reason']
+        elif summary['trailing_bytes'] and tasks[i][0] != segments[-1]:
+            # Only the newest segment may end in a record that is still being written
+            bad_index, reason = (summary['last_index'] if summary['last_index'] is not None else last_index) + 1, 'corrupt record'
+        elif summary['trailing_bytes']:
+            result['unverified_tail_bytes'] = summary['trailing_bytes']
+
+        if reason is not None:
+            result.update(is_valid=False, first_invalid_index=bad_index, reason=reason)
+            break
+        if summary['last_index'] is not None:
+            last_index, last_hash = summary['last_index'], summary['last_hash']
+            result['blocks'] += summary['blocks']
+
+    result['last_index'] = last_index if last_index >= 0 else None
+    result['last_hash'] = last_hash if last_index >= 0 else None
+    result['elapsed_s'] = time.perf_counter() - start
+    return result
+
+
+# ===== BACKGROUND JOBS =====
+
+def write_status(path, status):
+    """Replace a job status file atomically (readers never see half of it)"""
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(status, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class VerifyJobs:
+    """
+    Deep verifications for the admin endpoint, each run as a separate
+    `ledger_verify.py --status-file` process (its pool then spawns from this
+    script, not from the server's __main__)
+    - Job status is kept as a JSON file in jobs_dir, so any gunicorn worker can
+      report on a job another worker started
+    - on_done(result) is called in the starting process when a job finishes
+    - One job per ledger at a time: start() hands back the running job instead
+      of launching another pool of one process per CPU
+    """
+    JOB_ID = re.compile(r'[0-9a-f]{12}')
+
+    def __init__(self, ledger_dir, jobs_dir=None, workers=None, on_done=None):
+        self.ledger_dir = ledger_dir
+        self.jobs_dir = jobs_dir or os.path.join(ledger_dir, 'verify-jobs')
+        self.workers = workers
+        self.on_done = on_done
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    @contextmanager
+    def _exclusive(self):
+        """Hold the jobs folder across threads and processes (check for a running job + start one)"""
+        with self._lock, open(os.path.join(self.jobs_dir, 'LOCK'), 'a+') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def running_job(self):
+        """Status of the job running on this ledger, or None (a job whose process died is marked failed)"""
+        for name in sorted(os.listdir(self.jobs_dir)):
+            status = self.status(name[:-len('.json')]) if name.endswith('.json') else None
+            if status is None or status['state'] != 'running':
+                continue
+            pid = status.get('pid')
+            if process_alive(pid) if pid else time.time() - status['started_at'] < 60:
+                return status
+            status = self.status(status['job_id'])  # it may have finished just now
+            if status['state'] == 'running':
+                status.update(state='failed', error='verifier process is gone', finished_at=time.time())
+                write_status(self._path(status['job_id']), status)
+        return None
+
+    def latest_finished(self):
+        """Status of the most recently finished ('done') job, or None"""
+        latest = None
+        for name in os.listdir(self.jobs_dir):
+            status = self.status(name[:-len('.json')]) if name.endswith('.json') else None
+            if status is not None and status['state'] == 'done' and \
+                    (latest is None or status['finished_at'] > latest['finished_at']):
+                latest = status
+        return latest
+
+    def start(self):
+        """
+        Start a verification unless one is running
+        Returns: (job_id, started) - the running job's id and False if there is one
+        """
+        with self._exclusive():
+            running = self.running_job()
+            if running is not None:
+                return running['job_id'], False
+            job_id = uuid.uuid4().hex[:12]
+            path = self._path(job_id)
+            status = {'job_id': job_id, 'state': 'running', 'started_at': time.time(), 'pid': None,
+                      'parts_done': 0, 'parts_total': None, 'blocks_verified': 0, 'result': None}
+            write_status(path, status)
+            command = [sys.executable, os.path.abspath(__file__), self.ledger_dir, '--status-file', path]
+            if self.workers:
+                command += ['--workers', str(self.workers)]
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+            status['pid'] = process.pid  # the verifier records it too, whichever writes first
+            write_status(path, status)
+
+        def wait():
+            process.wait()
+            status = self.status(job_id)
+            if status is None:
+                print(f"[Verify] Job {job_id} exited with code {process.returncode}; its status file is gone")
+                return
+            if status['state'] == 'running':
+                # Died before it could record a result
+                status.update(state='failed', error=f"verifier exited with code {process.returncode}",
+                              finished_at=time.time())
+                write_status(path, status)
+            elif status['state'] == 'done' and self.on_done is not None:
+                self.on_done(status['result'])
+            print(f"[Verify] Job {job_id} {status['state']}: {status.get('result') or status.get('error')}")
+
+        threading.Thread(target=wait, name=f"ledger-verify-{job_id}", daemon=True).start()
+        return job_id, True
+
+    def status(self, job_id):
+        """Status dict of a job, or None if there is no such job"""
+        if not self.JOB_ID.fullmatch(job_id or ''):
+            return None
+        try:
+            with open(self._path(job_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify every block of the ledger in parallel')
+    parser.add_argument('ledger_dir', nargs='?', default=os.environ.get('FRUIT_LEDGER_DIR', 'ledger'))
+    parser.add_argument('--workers', type=int, default=None, help='Pool processes (default: one per CPU)')
+    parser.add_argument('--status-file', default=None, help='Report progress and the result to this job status file')
+    args = parser.parse_args()
+
+    status = None
+    if args.status_file:
+        with open(args.status_file, 'r') as f:
+            status = json.load(f)
+        status['pid'] = os.getpid()
+
+    def progress(done, total, blocks):
+        if status is not None:
+            status.update(parts_done=done, parts_total=total, blocks_verified=blocks)
+            write_status(args.status_file, status)
+        else:
+            print(f"\r[Verify] {done}/{total} parts, {blocks} blocks", end='', flush=True)
+
+    try:
+        result = verify_ledger(args.ledger_dir, workers=args.workers, progress=progress)
+    except Exception as e:
+        if status is not None:
+            status.update(state='failed', error=str(e), finished_at=time.time())
+            write_status(args.status_file, status)
+        raise
+    if status is not None:
+        status.update(state='done', result=result, finished_at=time.time())
+        write_status(args.status_file, status)
+        return
+
+    print()
+    if result['is_valid']:
+        print(f"[Verify] OK: {result['blocks']} blocks in {result['elapsed_s']:.2f}s "
+              f"({result['segments']} segments, {result['workers']} workers)")
+    else:
+        print(f"[Verify] INVALID at block {result['first_invalid_index']}: {result['reason']} "
+              f"({result['blocks']} blocks verified before it)")
+    sys.exit(0 if result['is_valid'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Flat, memory-mappable model artifact (.fmm)
+
+Layout:
+    [TFLite flatbuffer][zero padding to 64 bytes][metadata JSON][u64 metadata length][MAGIC]
+
+The flatbuffer sits at offset 0, so TFLite can map the artifact file
+directly (trailing bytes are ignored). The trailer records a SHA-256 of the
+flatbuffer, the fingerprint of the source .h5 and the preprocessing spec
+the model was trained with.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+from datetime import datetime
+
+MAGIC = b'FRUITMM1'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+TRAILER = struct.Struct('<Q8s')  # metadata length, magic
+
+# How /predict turns an image into model input - must match preprocess_image() in app.py
+PREPROCESSING_SPEC = {
+    'input_size': 128,
+    'color_order': 'RGB',
+    'resize': 'INTER_LINEAR',
+    'scale': 1.0 / 255.0,
+    'layout': 'NHWC',
+    'dtype': 'float32'
+}
+
+
+class ArtifactError(ValueError):
+    """The artifact is unreadable, stale or does not match the server"""
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def write_artifact(tflite_path, output_path, source_path=None, spec=PREPROCESSING_SPEC):
+    """Wrap a .tflite flatbuffer into an .fmm artifact. Returns the metadata dict"""
+    with open(tflite_path, 'rb') as f:
+        payload = f.read()
+
+    metadata = {
+        'format_version': FORMAT_VERSION,
+        'payload_size': len(payload),
+        'payload_sha256': hashlib.sha256(payload).hexdigest(),
+        'preprocessing': spec,
+        'created': datetime.now().isoformat()
+    }
+    if source_path and os.path.exists(source_path):
+        st = os.stat(source_path)
+        metadata['source'] = {
+            'path': os.path.basename(source_path),
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'sha256': file_sha256(source_path)
+        }
+
+    meta_bytes = json.dumps(metadata, sort_keys=True).encode()
+    padding = (-len(payload)) % ALIGNMENT
+
+    # Write to a temp file and rename, so a running server never maps a half-written artifact
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.write(b'\0' * padding)
+        f.write(meta_bytes)
+        f.write(TRAILER.pack(len(meta_bytes), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, output_path)
+    return metadata
+
+
+class ModelArtifact:
+    """A read-only mapping of an .fmm file plus its metadata"""
+
+    def __init__(self, path, mapping, metadata):
+        self.path = path
+        self.mapping = mapping
+        self.metadata = metadata
+
+    @property
+    def payload(self):
+        """Zero-copy view of the TFLite flatbuffer"""
+        return memoryview(self.mapping)[:self.metadata['payload_size']]
+
+    @property
+    def fingerprint(self):
+        return self.metadata['payload_sha256'][:16]
+
+    def close(self):
+        self.mapping.close()
+
+
+def _source_is_stale(recorded, source_path):
+    """Cheap stat comparison first; hash the source only if the stat changed"""
+    st = os.stat(source_path)
+    if st.st_size == recorded['size'] and st.st_mtime_ns == recorded['mtime_ns']:
+        return False
+    return file_sha256(source_path) != recorded['sha256']
+
+
+def open_artifact(path, expected_spec=PREPROCESSING_SPEC, source_path=None, verify_payload=False):
+    """
+    Map an artifact read-only and check it before serving
+    - Trailer, format version and payload size must be intact
+    - The preprocessing spec must equal expected_spec
+    - If source_path exists and changed since export, the artifact is stale
+    - verify_payload=True also re-hashes the flatbuffer (costs a full read)
+    Raises ArtifactError on any mismatch
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < TRAILER.size:
+            raise ArtifactError(f"{path}: file too small to be a model artifact")
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        meta_len, magic = TRAILER.unpack_from(mapping, size - TRAILER.size)
+        if magic != MAGIC:
+            raise ArtifactError(f"{path}: not a model artifact (bad magic)")
+        meta_start = size - TRAILER.size - meta_len
+        if meta_start < 0:
+            raise ArtifactError(f"{path}: corrupt trailer")
+        metadata = json.loads(bytes(mapping[meta_start:meta_start + meta_len]))
+
+        if metadata.get('format_version') != FORMAT_VERSION:
+            raise ArtifactError(f"{path}: unsupported format version {metadata.get('format_version')}")
+        if metadata['payload_size'] > meta_start:
+            raise ArtifactError(f"{path}: truncated payload")
+        if metadata.get('preprocessing') != expected_spec:
+            raise ArtifactError(f"{path}: preprocessing spec {metadata.get('preprocessing')} "
+                                f"does not match the server's {expected_spec}")
+        recorded = metadata.get('source')
+        if recorded and source_path and os.path.exists(source_path) and _source_is_stale(recorded, source_path):
+            raise ArtifactError(f"{path}: stale - {source_path} changed since the artifact was exported")
+        if verify_payload:
+            digest = hashlib.sha256(memoryview(mapping)[:metadata['payload_size']]).hexdigest()
+            if digest != metadata['payload_sha256']:
+                raise ArtifactError(f"{path}: payload hash mismatch")
+    except Exception:
+        mapping.close()
+        raise
+
+    return ModelArtifact(path, mapping, metadata)
+
+
+def artifact_fingerprint(path):
+    """Model version of an artifact from its trailer, without hashing the weights"""
+    try:
+        artifact = open_artifact(path, expected_spec=PREPROCESSING_SPEC)
+    except (OSError, ArtifactError):
+        return 'no-model'
+    fingerprint = artifact.fingerprint
+    artifact.close()
+    return fingerprint
@@ -0,0 +1,65 @@
+"""
+Exact per-image statistics from histograms and integer moments
+The single-image, tiled and batched heuristics all reduce 8-bit planes to
+256-bin histograms and the (integer) Laplacian to its sum and sum of squares,
+then finish with the same integer arithmetic - so all three paths produce
+bit-identical means, deviations and variances.
+"""
+
+import math
+
+import cv2
+import numpy as np
+
+LEVELS = np.arange(256, dtype=np.int64)
+
+
+def histogram(values):
+    """256-bin histogram of an 8-bit array"""
+    return np.bincount(values.ravel(), minlength=256)
+
+
+def batch_histograms(values):
+    """
+    Per-image 256-bin histograms of an N x ... 8-bit stack in one bincount
+    (image i's values are offset by 256 * i)
+    """
+    n = values.shape[0]
+    keys = values.reshape(n, -1).astype(np.int64)
+    keys += (np.arange(n, dtype=np.int64) * 256)[:, None]
+    return np.bincount(keys.ravel(), minlength=256 * n).reshape(n, 256)
+
+
+def moments_variance(count, total, total_sq):
+    """Population variance from integer count, sum and sum of squares (exact until the division)"""
+    count, total, total_sq = int(count), int(total), int(total_sq)
+    return (count * total_sq - total * total) / (count * count)
+
+
+def histogram_mean(hist):
+    return int((hist * LEVELS).sum()) / int(hist.sum())
+
+
+def histogram_std(hist):
+    return math.sqrt(moments_variance(hist.sum(), (hist * LEVELS).sum(), (hist * LEVELS * LEVELS).sum()))
+
+
+def histogram_range(hist):
+    """max - min of the values behind a histogram"""
+    present = np.flatnonzero(hist)
+    return int(present[-1] - present[0])
+
+
+def laplacian_rows(gray):
+    """3x3 Laplacian as int16 (|value| <= 1020, so exact)"""
+    return cv2.Laplacian(gray, cv2.CV_16S)
+
+
+def laplacian_moments(lap):
+    """(count, sum, sum of squares) of an integer Laplacian; float64 sums of integers stay exact"""
+    values = lap.astype(np.float64).ravel()
+    return values.size, int(values.sum()), int(values @ values)
+
+
+def laplacian_variance(gray):
+    return moments_variance(*laplacian_moments(laplacian_rows(gray)))
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def model_fingerprint(model_path):
+    """SHA-256 of the model file, used as the model version in cache keys"""
+    if not os.path.exists(model_path):
+        return 'no-model'
+    sha256 = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()[:16]
+
+
+def pipeline_fingerprint(settings):
+    """Short hash of the settings that shape a verdict besides the model (JSON-serializable dict)"""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+class PredictionCache:
+    """
+    Content-addressed cache of /predict results
+    - Keyed by image SHA-256 plus model version and pipeline version (a hash of
+      the analysis/cascade settings), so a config change never serves old verdicts
+    - In-memory LRU tier with optional TTL
+    - Optional SQLite tier on disk that survives worker restarts
+    - Everything is invalidated when a new model is loaded (set_model_version);
+      a model file that merely changed on disk is only reported (check_model)
+    """
+
+    def __init__(self, model_path, max_entries=1024, ttl_seconds=None, disk_path=None, fingerprint=model_fingerprint,
+                 pipeline_version=''):
+        self.model_path = model_path
+        self.pipeline_version = pipeline_version
+        self._fingerprint = fingerprint
+        self.max_entries = max(0, int(max_entries))
+        self.ttl = float(ttl_seconds) if ttl_seconds else None
+        self.disk_path = disk_path
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (created, value)
+        self._model_stat = self._stat_model()
+        self.model_version = fingerprint(model_path)
+        self.model_file_changed = False
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._db = None
+        if disk_path:
+            self._open_disk()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    # ===== MODEL VERSION =====
+
+    def _stat_model(self):
+        try:
+            st = os.stat(self.model_path)
+            return (st.st_size, st.st_mtime_ns)
+        except OSError:
+            return None
+
+    def check_model(self):
+        """
+        Notice a model file that changed on disk (one stat call)
+        The running backend still serves the weights it loaded, so results keep
+        the loaded model's version until set_model_version() is called
+        Returns: True while the file on disk differs from the served model
+        """
+        current = self._stat_model()
+        if current == self._model_stat:
+            return self.model_file_changed
+        version = self._fingerprint(self.model_path)
+        with self._lock:
+            self._model_stat = current
+            self.model_file_changed = version != self.model_version
+        if self.model_file_changed:
+            print(f"[Cache] Model file changed on disk (version {version}) - still serving version "
+                  f"{self.model_version} until the model is reloaded")
+        return self.model_file_changed
+
+    def set_model_version(self, version):
+        """Switch to a newly loaded model (call once the backend serves it): drops all cached results"""
+        with self._lock:
+            if version == self.model_version:
+                return False
+            self.model_version = version
+            self.model_file_changed = False
+        print(f"[Cache] Now serving model version {version} - invalidating cached predictions")
+        self.invalidate()
+        return True
+
+    def _key(self, image_hash):
+        return f"{self.model_version}:{self.pipeline_version}:{image_hash}"
+
+    # ===== DISK TIER =====
+
+    def _open_disk(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.disk_path)), exist_ok=True)
+        self._db = sqlite3.connect(self.disk_path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, created REAL, value TEXT)'
+        )
+
+    def reset_after_fork(self):
+        """SQLite connections and locks must not be shared with the parent process"""
+        self._lock = threading.Lock()
+        if self.disk_path:
+            self._open_disk()
+
+    def _disk_get(self, key, now):
+        row = self._db.execute('SELECT created, value FROM predictions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        created, value = row
+        if self.ttl is not None and now - created > self.ttl:
+            self._db.execute('DELETE FROM predictions WHERE key = ?', (key,))
+            return None
+        return created, json.loads(value)
+
+    def _disk_put(self, key, created, value):
+        self._db.execute(
+            'INSERT OR REPLACE INTO predictions (key, created, value) VALUES (?, ?, ?)',
+            (key, created, json.dumps(value))
+        )
+
+    # ===== LOOKUP =====
+
+    def get(self, image_hash):
+        """Return the cached value for an image, or None"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            key = self._key(image_hash)
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, value = entry
+                if self.ttl is None or now - created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._db is not None:
+                entry = self._disk_get(key, now)
+                if entry is not None:
+                    self._remember(key, *entry)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return entry[1]
+
+            self.misses += 1
+            return None
+
+    def put(self, image_hash, value):
+        """Store a JSON-serializable result for an image"""
+        if not self.enabled:
+            return
+        created = time.time()
+        with self._lock:
+            key = self._key(image_hash)
+            self._remember(key, created, value)
+            if self._db is not None:
+                self._disk_put(key, created, value)
+
+    def _remember(self, key, created, value):
+        self._entries[key] = (created, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self):
+        """Drop every cached result, in memory and on disk"""
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM predictions')
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'model_version': self.model_version,
+                'pipeline_version': self.pipeline_version,
+                'model_file_changed': self.model_file_changed,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'disk_tier': self.disk_path,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
@@ -0,0 +1,63 @@
+"""
+Shared vs private memory of gunicorn workers (Linux /proc)
+Usage: python process_memory.py <master pid>
+"""
+
+import os
+import sys
+
+SMAPS_FIELDS = ['Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty', 'Swap']
+
+
+def read_smaps_rollup(pid='self'):
+    """Memory totals in KB for one process, or None if /proc is unavailable"""
+    path = f'/proc/{pid}/smaps_rollup'
+    if not os.path.exists(path):
+        return None
+    report = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            key = parts[0].rstrip(':')
+            if key in SMAPS_FIELDS:
+                report[key.lower() + '_kb'] = int(parts[1])
+    report['shared_kb'] = report.get('shared_clean_kb', 0) + report.get('shared_dirty_kb', 0)
+    report['private_kb'] = report.get('private_clean_kb', 0) + report.get('private_dirty_kb', 0)
+    return report
+
+
+def child_pids(pid):
+    """PIDs whose parent is pid (the workers of a gunicorn master)"""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # Field 4 is the parent pid; the command name (field 2) may contain spaces
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == int(pid):
+            children.append(int(entry))
+    return sorted(children)
+
+
+def worker_memory_report(master_pid):
+    """smaps totals for a gunicorn master and each of its workers"""
+    return {
+        'master': {'pid': int(master_pid), **(read_smaps_rollup(master_pid) or {})},
+        'workers': [{'pid': pid, **(read_smaps_rollup(pid) or {})} for pid in child_pids(master_pid)]
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(__doc__.strip())
+        sys.exit(1)
+
+    report = worker_memory_report(sys.argv[1])
+    print(f"{'role':8s} {'pid':>7s} {'rss MB':>9s} {'pss MB':>9s} {'shared MB':>10s} {'private MB':>11s}")
+    for role, entry in [('master', report['master'])] + [('worker', w) for w in report['workers']]:
+        print(f"{role:8s} {entry['pid']:7d} {entry.get('rss_kb', 0) / 1024:9.1f} {entry.get('pss_kb', 0) / 1024:9.1f} "
+              f"{entry.get('shared_kb', 0) / 1024:10.1f} {entry.get('private_kb', 0) / 1024:11.1f}")
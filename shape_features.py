@@ -0,0 +1,87 @@
+"""
+Shape checks shared by the single-image and batched fruit validators
+Rectangles (boxes, packages, screens) from Canny contours, and straight
+lines (vehicle frames) from the probabilistic Hough transform
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+
+def contour_areas(contours):
+    """
+    Areas of all contours in one vectorized shoelace pass
+    Same values as cv2.contourArea (integer points, so the sums are exact)
+    """
+    if len(contours) == 0:
+        return np.zeros(0)
+    lengths = np.array([len(c) for c in contours])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.float64)
+
+    # Index of each point's successor, wrapping around within its own contour
+    following = np.arange(len(points)) + 1
+    following[starts + lengths - 1] = starts
+    x, y = points[:, 0], points[:, 1]
+    cross = x * y[following] - x[following] * y
+    return np.abs(np.add.reduceat(cross, starts)) / 2.0
+
+
+def count_rectangles(edges, scale=1.0, max_polygons=None, deadline=None, report=None):
+    """
+    Large rectangles/squares among the external contours of an edge map, counted up to 2
+    - Only contours >= 500px (at full resolution, scaled by scale^2) and > 5% of
+      the image can count; they are filtered in one vectorized step, largest first
+    - At most max_polygons are approximated; the scan stops at the second
+      rectangle or once time.perf_counter() passes deadline
+    """
+    if report is None:
+        report = {}
+    report.setdefault('truncated', [])
+    total_pixels = edges.shape[0] * edges.shape[1]
+
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    areas = contour_areas(contours)
+
+    candidates = np.flatnonzero((areas >= 500 * scale * scale) & (areas > total_pixels * 0.05))
+    candidates = candidates[np.argsort(-areas[candidates], kind='stable')]
+    report['contours'] = len(contours)
+    report['polygon_candidates'] = len(candidates)
+    if max_polygons is not None and len(candidates) > max_polygons:
+        candidates = candidates[:max_polygons]
+        report['truncated'].append('polygons')
+
+    rectangular_objects = 0
+    examined = 0
+    for i in candidates:
+        if deadline is not None and time.perf_counter() > deadline:
+            report['truncated'].append('polygons (budget)')
+            break
+        examined += 1
+        contour = contours[i]
+
+        # Approximate contour to polygon
+        peri = cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, 0.04 * peri, True)
+
+        # Check if it's a rectangle/square (4 corners)
+        if len(approx) == 4:
+            x, y, w, h = cv2.boundingRect(approx)
+            aspect_ratio = float(w) / h if h > 0 else 0
+
+            # Rectangle or square (aspect ratio between 0.5 and 2.0)
+            if 0.5 <= aspect_ratio <= 2.0:
+                rectangular_objects += 1
+                if rectangular_objects >= 2:
+                    break
+    report['polygons_examined'] = examined
+    return rectangular_objects
+
+
+def count_lines(edges, scale=1.0):
+    """Straight line segments (HoughLinesP, constants tuned at full resolution)"""
+    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=max(1, int(round(80 * scale))),
+                            minLineLength=50 * scale, maxLineGap=10 * scale)
+    return len(lines) if lines is not None else 0
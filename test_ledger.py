@@ -0,0 +1,375 @@
+"""
+Checks of the append-only ledger (blockchain.py, ledger_store.py, ledger_verify.py)
+Runs on throwaway ledgers in a temp folder - no model needed:
+  python test_ledger.py      (or: python -m pytest test_ledger.py)
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+from blockchain import Block, Blockchain
+from ledger_store import RECORD_HEADER, list_segments, read_snapshot
+from ledger_verify import VerifyJobs, verify_ledger, write_status
+
+
+def make_ledger(blocks=300, segment_max_bytes=8 * 1024, **kwargs):
+    """A fresh ledger of `blocks` freshness records plus genesis, in small segments"""
+    folder = tempfile.mkdtemp(prefix='ledger-test-')
+    chain = Blockchain(os.path.join(folder, 'ledger'), legacy_file=None, fsync_every=0,
+                       segment_max_bytes=segment_max_bytes, **kwargs)
+    for i in range(blocks):
+        chain.add_block({'type': 'freshness_check', 'image_hash': f"{i:064x}", 'freshness_level': 'Fresh'})
+    return folder, chain
+
+
+def discard(folder, *chains):
+    for chain in chains:
+        if chain is not None:
+            chain.close()
+    shutil.rmtree(folder)
+
+
+def reopen(chain, **kwargs):
+    return Blockchain(chain.storage_dir, legacy_file=None, fsync_every=0,
+                      segment_max_bytes=chain.log.segment_max_bytes, **kwargs)
+
+
+def edit_record(storage_dir, index, edit):
+    """Change the stored record of block `index` in place: edit(data, payload_start, length)"""
+    for path in list_segments(storage_dir):
+        with open(path, 'r+b') as f:
+            data = bytearray(f.read())
+            offset = 0
+            while offset < len(data):
+                length, _ = RECORD_HEADER.unpack_from(data, offset)
+                payload_start = offset + RECORD_HEADER.size
+                if bytes(data[payload_start:payload_start + length]).startswith(b'{"index":%d,' % index):
+                    edit(data, payload_start, length)
+                    f.seek(0)
+                    f.write(data)
+                    f.truncate()
+                    return
+                offset = payload_start + length
+    raise AssertionError(f"block {index} not found")
+
+
+def flip_payload_byte(storage_dir, index):
+    """Corrupt the stored record of block `index` (its CRC no longer matches)"""
+    def flip(data, payload_start, length):
+        data[payload_start + length // 2] ^= 0x01
+    edit_record(storage_dir, index, flip)
+
+
+def forge_payload(storage_dir, index):
+    """Change block `index`'s data and fix up the CRC, as a tamperer would (stored hash now wrong)"""
+    def forge(data, payload_start, length):
+        payload = bytes(data[payload_start:payload_start + length]).replace(b'"Fresh"', b'"Fres!"')
+        data[payload_start - RECORD_HEADER.size:payload_start + length] = \
+            RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+    edit_record(storage_dir, index, forge)
+
+
+def count_hashes(check):
+    """Number of block hashes check() recomputes"""
+    calculate_hash = Block.calculate_hash
+    calls = []
+
+    def counted(block):
+        calls.append(block.index)
+        return calculate_hash(block)
+    Block.calculate_hash = counted
+    try:
+        check()
+    finally:
+        Block.calculate_hash = calculate_hash
+    return len(calls)
+
+
+def append_blocks(storage_dir, count, worker):
+    """Add count blocks from a separate process (multiprocessing target)"""
+    chain = Blockchain(storage_dir, legacy_file=None, fsync_every=0, segment_max_bytes=8 * 1024)
+    for i in range(count):
+        chain.add_block({'type': 'freshness_check', 'worker': worker, 'n': i})
+    chain.close()
+
+
+def cut_record(storage_dir, index):
+    """Leave only the first bytes of block `index`'s record and drop everything after it"""
+    def cut(data, payload_start, length):
+        del data[payload_start + 3:]
+    edit_record(storage_dir, index, cut)
+
+
+# ===== STORAGE =====
+
+def test_fsync_interval_syncs_an_idle_ledger():
+    folder, chain = make_ledger(blocks=0, fsync_interval_ms=50)
+    try:
+        chain.add_block({'type': 'freshness_check'})
+        chain.add_block({'type': 'freshness_check'})
+        assert chain.log.stats()['unsynced_records'] >= 1
+        time.sleep(0.3)  # no further appends: the deadline timer has to sync
+        assert chain.log.stats()['unsynced_records'] == 0
+    finally:
+        discard(folder, chain)
+
+
+def test_torn_tail_is_truncated_on_load():
+    folder, chain = make_ledger()
+    restarted = None
+    try:
+        chain.close()
+        os.remove(chain.snapshot_file)  # read every record, not just those after the snapshot
+        last_segment = list_segments(chain.storage_dir)[-1]
+        with open(last_segment, 'ab') as f:
+            f.write(RECORD_HEADER.pack(100, 0) + b'{"index":301,')  # writer died mid-record
+        restarted = reopen(chain)
+        assert len(restarted.chain) == 301
+        assert restarted.log.stats()['recovered_bytes'] == RECORD_HEADER.size + 13
+        assert restarted.add_block({'type': 'freshness_check'}).index == 301
+        assert restarted.is_chain_valid(deep=True)
+    finally:
+        discard(folder, restarted)
+
+
+def test_legacy_json_chain_is_migrated_once():
+    folder = tempfile.mkdtemp(prefix='ledger-test-')
+    chain = restarted = None
+    try:
+        blocks = [Block(0, '2024-01-01T00:00:00', {'type': 'genesis'}, '0')]
+        for i in range(1, 50):
+            blocks.append(Block(i, f"2024-01-01T00:00:{i:02d}", {'type': 'freshness_check', 'n': i}, blocks[-1].hash))
+        legacy_file = os.path.join(folder, 'blockchain_data.json')
+        with open(legacy_file, 'w') as f:
+            json.dump([block.to_dict() for block in blocks], f, indent=2)
+
+        chain = Blockchain(os.path.join(folder, 'ledger'), legacy_file=legacy_file, fsync_every=0)
+        assert [block.hash for block in chain.chain] == [block.hash for block in blocks]
+        assert chain.is_chain_valid(deep=True)
+        chain.add_block({'type': 'freshness_check'})
+        chain.close()
+
+        with open(legacy_file, 'w') as f:
+            json.dump([blocks[0].to_dict()], f)  # ignored from now on: the ledger has segments
+        restarted = Blockchain(os.path.join(folder, 'ledger'), legacy_file=legacy_file, fsync_every=0)
+        assert len(restarted.chain) == 51 and restarted.chain[49].hash == blocks[49].hash
+    finally:
+        discard(folder, restarted)
+
+
+def test_processes_append_to_one_ledger():
+    folder, chain = make_ledger(blocks=0)
+    try:
+        context = multiprocessing.get_context('spawn')
+        writers = [context.Process(target=append_blocks, args=(chain.storage_dir, 100, worker)) for worker in range(3)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join(60)
+            assert writer.exitcode == 0
+        chain.refresh()
+        assert [block.index for block in chain.chain] == list(range(301))
+        assert chain.is_chain_valid(deep=True)
+        assert sorted(block.data['worker'] for block in chain.chain if 'worker' in block.data) == [0] * 100 + [1] * 100 + [2] * 100
+        assert verify_ledger(chain.storage_dir, workers=1)['is_valid']
+    finally:
+        discard(folder, chain)
+
+
+# ===== WATERMARK =====
+
+def test_routine_checks_only_verify_new_blocks():
+    folder, chain = make_ledger()
+    restarted = None
+    try:
+        assert count_hashes(chain.is_chain_valid) == 300  # first check: everything after genesis
+        assert chain.watermark['index'] == 300
+        assert count_hashes(chain.is_chain_valid) == 0
+        for _ in range(5):
+            chain.add_block({'type': 'freshness_check'})
+        assert count_hashes(chain.is_chain_valid) == 5
+        assert count_hashes(lambda: chain.is_chain_valid(deep=True)) == 305
+
+        chain.close()
+        restarted = reopen(chain)
+        assert restarted.watermark['index'] == 305  # persisted
+        assert count_hashes(restarted.is_chain_valid) == 0
+    finally:
+        discard(folder, restarted)
+
+
+def test_deep_check_catches_tampering_below_the_watermark():
+    folder, chain = make_ledger(deep_verify_interval_s=3600)
+    try:
+        assert chain.is_chain_valid()  # first check is deep: never verified before
+        chain.chain[10].data['freshness_level'] = 'Rotten'
+        assert chain.is_chain_valid()  # routine: block 10 is below the watermark
+        assert not chain.is_chain_valid(deep=True)
+        assert (chain.first_invalid_index, chain.invalid_reason) == (10, 'hash mismatch')
+
+        chain.chain[10].data['freshness_level'] = 'Fresh'
+        assert chain.is_chain_valid(deep=True)
+        chain.chain[10].data['freshness_level'] = 'Rotten'
+        chain.watermark['deep_verified_at'] -= 7200  # scheduled deep check is due
+        assert not chain.is_chain_valid()
+        assert chain.first_invalid_index == 10
+        chain.chain[10].data['freshness_level'] = 'Fresh'
+    finally:
+        discard(folder, chain)
+
+
+def test_scheduled_deep_check_is_handed_to_the_background():
+    folder, chain = make_ledger(deep_verify_interval_s=3600)
+    try:
+        requested = []
+        chain.on_deep_verify_due = lambda: requested.append(time.time())
+        assert count_hashes(chain.is_chain_valid) == 300  # routine over everything: no watermark yet
+        assert len(requested) == 1
+        chain.add_block({'type': 'freshness_check'})
+        assert count_hashes(chain.is_chain_valid) == 1 and len(requested) == 1  # asked once, not per request
+
+        result = verify_ledger(chain.storage_dir, workers=1)  # the audit reports back
+        chain.record_deep_verification(result['last_index'], result['last_hash'])
+        assert time.time() - chain.watermark['deep_verified_at'] < 60
+        assert chain.is_chain_valid() and len(requested) == 1
+
+        chain.record_audit_failure(42, 'hash mismatch')
+        assert not chain.is_chain_valid()
+        assert (chain.first_invalid_index, chain.invalid_reason) == (42, 'hash mismatch')
+        assert chain.is_chain_valid(deep=True) and chain.is_chain_valid()  # a passing deep check clears it
+    finally:
+        discard(folder, chain)
+
+
+def test_watermark_restarts_when_its_block_changed():
+    folder, chain = make_ledger()
+    try:
+        assert chain.is_chain_valid()
+        chain.chain[300].hash = '0' * 64  # the verified tip no longer matches: start over
+        assert count_hashes(chain.is_chain_valid) == 300
+        assert (chain.first_invalid_index, chain.invalid_reason) == (300, 'hash mismatch')
+    finally:
+        chain.chain[300].hash = chain.chain[300].calculate_hash()
+        discard(folder, chain)
+
+
+# ===== SNAPSHOT =====
+
+def test_snapshot_deep_verify_reports_corrupt_sealed_record():
+    folder, chain = make_ledger()
+    restarted = None
+    try:
+        assert chain.is_chain_valid()
+        assert read_snapshot(chain.snapshot_file)['index'] == 300
+        assert len(list_segments(chain.storage_dir)) > 2
+
+        flip_payload_byte(chain.storage_dir, 5)  # first segment: sealed, never reread on start
+        restarted = reopen(chain)
+        assert len(restarted.chain.hot) == 0  # everything up to the snapshot stays on disk
+        assert restarted.is_chain_valid()  # routine check: nothing new since the snapshot
+        assert not restarted.is_chain_valid(deep=True)
+        assert restarted.first_invalid_index == 5
+        assert restarted.invalid_reason == 'corrupt record'
+        restarted.checkpoint()  # must not raise either
+    finally:
+        discard(folder, chain, restarted)
+
+
+# ===== PARALLEL VERIFY =====
+
+def test_parallel_verify_matches_a_clean_ledger():
+    folder, chain = make_ledger(segment_max_bytes=1024 * 1024)  # one segment, split into parts
+    try:
+        for workers in (1, 3):
+            result = verify_ledger(chain.storage_dir, workers=workers)
+            assert result['is_valid'] and result['blocks'] == 301
+            assert result['last_index'] == 300 and result['last_hash'] == chain.chain[-1].hash
+        assert result['parts'] > result['segments']  # with 3 workers, segments are split up
+    finally:
+        discard(folder, chain)
+
+
+def test_parallel_verify_names_the_first_bad_block():
+    cases = [
+        (forge_payload, 150, 'hash mismatch'),
+        (flip_payload_byte, 42, 'corrupt record'),
+        (cut_record, 20, 'corrupt record'),  # torn inside a sealed segment
+    ]
+    for damage, index, reason in cases:
+        folder, chain = make_ledger()
+        try:
+            damage(chain.storage_dir, index)
+            result = verify_ledger(chain.storage_dir, workers=2)
+            assert not result['is_valid']
+            assert (result['first_invalid_index'], result['reason']) == (index, reason), (damage.__name__, result)
+        finally:
+            discard(folder, chain)
+
+
+def test_parallel_verify_skips_a_record_still_being_written():
+    folder, chain = make_ledger()
+    try:
+        cut_record(chain.storage_dir, 300)
+        result = verify_ledger(chain.storage_dir, workers=2)
+        assert result['is_valid'] and result['last_index'] == 299
+        assert result['unverified_tail_bytes'] > 0
+    finally:
+        discard(folder, chain)
+
+
+def test_verify_job_reports_progress_and_result():
+    folder, chain = make_ledger()
+    try:
+        results = []
+        jobs = VerifyJobs(chain.storage_dir, workers=2, on_done=results.append)
+        job_id, started = jobs.start()
+        assert started
+        assert jobs.start() == (job_id, False)  # one job per ledger
+        assert VerifyJobs(chain.storage_dir).start() == (job_id, False)  # also for another worker
+        deadline = time.monotonic() + 60
+        while jobs.status(job_id)['state'] == 'running' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        status = jobs.status(job_id)
+        assert status['state'] == 'done', status
+        assert status['parts_done'] == status['parts_total'] and status['blocks_verified'] == 301
+        assert status['result']['is_valid']
+        time.sleep(0.2)  # on_done runs right after the status file is final
+        assert results and results[0]['last_index'] == 300
+        assert jobs.status('../../etc/passwd') is None
+        assert jobs.running_job() is None
+    finally:
+        discard(folder, chain)
+
+
+def test_verify_job_of_a_dead_process_is_not_running():
+    folder, chain = make_ledger(blocks=10)
+    try:
+        jobs = VerifyJobs(chain.storage_dir)
+        gone = subprocess.Popen([sys.executable, '-c', 'pass'])
+        gone.wait()
+        write_status(os.path.join(jobs.jobs_dir, 'abcdef012345.json'),
+                     {'job_id': 'abcdef012345', 'state': 'running', 'started_at': time.time(), 'pid': gone.pid})
+        assert jobs.running_job() is None
+        assert jobs.status('abcdef012345')['state'] == 'failed'
+        job_id, started = jobs.start()
+        assert started and job_id != 'abcdef012345'
+        deadline = time.monotonic() + 60
+        while jobs.status(job_id)['state'] == 'running' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert jobs.status(job_id)['state'] == 'done'
+    finally:
+        discard(folder, chain)
+
+
+if __name__ == '__main__':
+    tests = [(name, test) for name, test in sorted(globals().items()) if name.startswith('test_')]
+    for name, test in tests:
+        test()
+        print(f"✅ {name}")
+    print(f"{len(tests)} ledger checks passed")
@@ -0,0 +1,731 @@
+"""
+Checks of the request pipeline around the model (decode, ingest, features, cache, batching, backends)
+Runs on synthetic images - no model or TensorFlow needed:
+  python test_pipeline.py      (or: python -m pytest test_pipeline.py)
+"""
+import atexit
+import hashlib
+import importlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+from flask import Flask, jsonify, request
+
+from batch_analysis import batch_features
+from cascade import CascadeStats
+from color_features import VALIDATOR_FRUIT_RULES, count_color_rules, count_unique_colors
+from feature_engine import (IMAGE_FEATURES, as_dict, as_record, center_features, extract_features, image_features,
+                            measure_center, measure_image)
+from feature_rules import fruit_rules, legacy_fruit_rules
+from feature_store import label_for, load_labels
+from fruit_validator_new import is_fruit_like_optimized
+from fruit_segmentation import box_overlap, crop_batch, find_fruit_regions
+from image_context import ImageContext
+import inference_backends
+from inference_queue import BatchingPredictor, DirectPredictor
+from model_artifact import PREPROCESSING_SPEC, ArtifactError, open_artifact, write_artifact
+from prediction_cache import PredictionCache, pipeline_fingerprint
+from shape_features import contour_areas, count_rectangles
+from single_flight import SingleFlight
+from upload_ingest import HashingUploadBuffer, IngestRequest
+
+
+def make_jpeg(width=1600, height=1200, quality=90):
+    """Encoded JPEG of a fruit-colored ellipse on a light background"""
+    img = np.full((height, width, 3), 230, dtype=np.uint8)
+    cv2.ellipse(img, (width // 2, height // 2), (width // 3, height // 3), 0, 0, 360, (40, 90, 220), -1)
+    ok, data = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    assert ok
+    return data.tobytes()
+
+
+def make_spotted_fruit(width, height, seed=7):
+    """BGR image of a noisy fruit-colored ellipse with dark spots (rot) on a light background"""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 230, dtype=np.uint8)
+    cv2.ellipse(img, (width // 2, height // 2), (width // 3, height // 3), 0, 0, 360, (40, 90, 220), -1)
+    for _ in range(40):
+        x, y = rng.integers(width // 3, 2 * width // 3, size=2)
+        cv2.circle(img, (int(x), int(y) * height // width), int(rng.integers(8, 40)), (20, 40, 60), -1)
+    noise = rng.integers(-12, 13, img.shape)
+    return np.clip(img.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def hsv_test_pixels():
+    """Random HSV pixels plus every hue at each saturation/value rule bound (and its neighbours)"""
+    rng = np.random.default_rng(3)
+    random = np.stack([rng.integers(0, 180, 1 << 16), rng.integers(0, 256, 1 << 16),
+                       rng.integers(0, 256, 1 << 16)], axis=1)
+    s_bounds = [0, 19, 20, 21, 24, 25, 26, 29, 30, 31, 39, 40, 41, 59, 60, 61, 179, 180, 181, 255]
+    v_bounds = [0, 14, 15, 16, 29, 30, 31, 49, 50, 51, 60, 61, 62, 79, 80, 81, 99, 100, 101,
+                149, 150, 151, 198, 199, 200, 255]
+    grid = np.stack(np.meshgrid(np.arange(180), s_bounds, v_bounds, indexing='ij'), axis=-1).reshape(-1, 3)
+    return np.concatenate([random, grid]).astype(np.uint8).reshape(1, -1, 3)
+
+
+def make_fruits(centers, radius, size=(480, 640)):
+    """BGR image of orange discs (fruits) on a white background"""
+    img = np.full((*size, 3), 245, dtype=np.uint8)
+    for center in centers:
+        cv2.circle(img, center, radius, (30, 120, 230), -1)
+    return img
+
+
+def sample_image(name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'img', name)
+
+
+def fake_interpreter_class(dtype=np.float32, quantization=(0.0, 0)):
+    """
+    Stand-in for the TFLite Interpreter API: the "model" scores each image by its
+    mean input value (column 0) and 1 - mean (column 1)
+    """
+    class FakeInterpreter:
+        def __init__(self, model_path, num_threads=1):
+            self.shape = [1, 128, 128, 3]
+
+        def get_input_details(self):
+            return [{'index': 0, 'shape': np.array(self.shape), 'dtype': dtype, 'quantization': quantization}]
+
+        def get_output_details(self):
+            return [{'index': 1, 'shape': np.array([self.shape[0], 5]), 'dtype': dtype, 'quantization': quantization}]
+
+        def resize_tensor_input(self, index, shape):
+            self.shape = list(shape)
+
+        def allocate_tensors(self):
+            pass
+
+        def set_tensor(self, index, value):
+            assert value.shape == tuple(self.shape) and value.dtype == dtype
+            self.value = value
+
+        def invoke(self):
+            scale, zero_point = quantization
+            values = (self.value.astype(np.float32) - zero_point) * scale if scale else self.value
+            mean = values.reshape(len(values), -1).mean(axis=1)
+            scores = np.zeros((len(values), 5), dtype=np.float32)
+            scores[:, 0], scores[:, 1] = mean, 1 - mean
+            self.output = np.round(scores / scale + zero_point).astype(dtype) if scale else scores.astype(dtype)
+
+        def get_tensor(self, index):
+            return self.output
+    return FakeInterpreter
+
+
+def make_tflite_backend(interpreter_class, **kwargs):
+    """TFLiteBackend over a fake interpreter class (no TFLite runtime needed)"""
+    saved = inference_backends.load_tflite_interpreter_class
+    inference_backends.load_tflite_interpreter_class = lambda: (interpreter_class, 'fake')
+    try:
+        return inference_backends.TFLiteBackend('model.tflite', **kwargs)
+    finally:
+        inference_backends.load_tflite_interpreter_class = saved
+
+
+def make_upload_app(max_image_bytes):
+    """Flask app with the /predict upload path only: reports what the ingest buffer saw"""
+    app = Flask(__name__)
+    app.request_class = type('TestIngestRequest', (IngestRequest,), {'max_image_bytes': max_image_bytes})
+
+    @app.route('/upload', methods=['POST'])
+    def upload():
+        stream = request.files['file'].stream
+        return jsonify({
+            'in_memory': isinstance(stream, HashingUploadBuffer),
+            'sha256': stream.hexdigest(),
+            'image_type': stream.image_type,
+            'size': stream.size
+        })
+    return app
+
+
+# ===== IMAGE CONTEXT =====
+
+def test_context_derives_each_plane_once():
+    data = make_jpeg()
+    ctx = ImageContext.from_bytes(data)
+    assert ctx.is_valid and ctx.shape == (1200, 1600, 3)
+    assert ctx.hsv is ctx.hsv and ctx.gray is ctx.gray and ctx.edges is ctx.edges
+    assert ctx.center is ctx.center and ctx.center.shape[:2] == (840, 1120)
+    assert ctx.sha256() == hashlib.sha256(data).hexdigest()
+    assert ImageContext.from_source(ctx) is ctx
+
+
+def test_working_levels_are_shared_and_scaled():
+    ctx = ImageContext.from_bytes(make_jpeg())
+    small = ctx.working(512)
+    assert max(small.shape[:2]) <= 512 and small.scale == small.shape[1] / 1600
+    assert ctx.working(512) is small and ctx.working(0) is ctx and ctx.working(4000) is ctx
+    assert ctx.working(1024) in ctx._pyramid
+
+
+def test_reduced_decode_keeps_the_target_side():
+    data = make_jpeg(width=4000, height=3000)
+    ctx = ImageContext.from_bytes(data, sha256='precomputed', target_side=1024)
+    assert ctx.reduction == 2 and ctx.shape[:2] == (1500, 2000)
+    assert ctx.scale == 0.5
+    assert ctx.sha256() == 'precomputed'  # hashed while streaming, not again
+    assert ImageContext.from_bytes(make_jpeg(), target_side=1024).reduction == 1
+    assert ImageContext.from_bytes(b'not an image').is_valid is False
+
+
+# ===== UPLOAD INGEST =====
+
+def test_upload_is_hashed_while_streaming_in():
+    data = make_jpeg()
+    client = make_upload_app(max_image_bytes=len(data)).test_client()
+    response = client.post('/upload', data={'file': (io.BytesIO(data), 'fruit.jpg')})
+    assert response.status_code == 200
+    assert response.get_json() == {
+        'in_memory': True,
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'image_type': 'jpeg',
+        'size': len(data)
+    }
+
+
+def test_upload_rejects_oversized_and_non_image_bodies():
+    data = make_jpeg()
+    client = make_upload_app(max_image_bytes=len(data) - 1).test_client()
+    assert client.post('/upload', data={'file': (io.BytesIO(data), 'fruit.jpg')}).status_code == 413
+    assert client.post('/upload', data={'file': (io.BytesIO(b'GIF89a' + bytes(64)), 'x.gif')}).status_code == 415
+    assert client.post('/upload', data={'file': (io.BytesIO(b'tiny'), 'x.jpg')}).status_code == 415  # < SNIFF_BYTES
+
+
+def row_sums(inputs):
+    """Stand-in model: one output row per input row, traceable back to its input"""
+    return inputs.reshape(inputs.shape[0], -1).sum(axis=1, keepdims=True)
+
+
+def call_concurrently(fn, args_list):
+    """fn(*args) in one thread each, started together; results in args order"""
+    results = [None] * len(args_list)
+    barrier = threading.Barrier(len(args_list))
+
+    def run(i, args):
+        barrier.wait()
+        results[i] = fn(*args)
+    threads = [threading.Thread(target=run, args=(i, args)) for i, args in enumerate(args_list)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+# ===== BATCHING =====
+
+def test_batching_returns_each_caller_its_rows():
+    batch_sizes = []
+
+    def model(inputs):
+        batch_sizes.append(inputs.shape[0])
+        time.sleep(0.01)
+        return row_sums(inputs)
+    predictor = BatchingPredictor(model, max_batch_size=8, max_wait_ms=20)
+    inputs = [np.full((rows, 2, 2, 3), i, dtype=np.float32) for i, rows in enumerate([1, 3, 1, 2, 13, 1])]
+    results = call_concurrently(predictor.predict, [(x,) for x in inputs])
+
+    for x, result in zip(inputs, results):
+        assert result.shape == (x.shape[0], 1) and np.all(result == x[0].sum())
+    assert max(batch_sizes) == 13  # larger than the limit: runs as a batch of its own
+    assert all(size <= 8 for size in batch_sizes if size != 13)
+    assert len(batch_sizes) < len(inputs)  # some callers shared a forward pass
+    stats = predictor.stats()
+    assert stats['rows'] == 21 and sum(stats['batch_size_histogram'].values()) == stats['batches']
+
+
+def test_batching_passes_model_errors_to_every_caller():
+    def broken(inputs):
+        raise RuntimeError('model failed')
+    predictor = BatchingPredictor(broken, max_batch_size=4, max_wait_ms=20)
+
+    def predict(x):
+        try:
+            predictor.predict(x, timeout=5)
+        except RuntimeError as e:
+            return str(e)
+    assert call_concurrently(predict, [(np.zeros((1, 2, 2, 3)),)] * 3) == ['model failed'] * 3
+
+
+# ===== COLOR FEATURES =====
+
+def test_color_rule_lut_matches_the_per_pixel_masks():
+    hsv = hsv_test_pixels()
+    h, s, v = (hsv[0, :, i].astype(int) for i in range(3))
+    # The masks detect_rotten_features and is_fruit_like built pixel by pixel before the LUT
+    red, orange, yellow, green = (h <= 10) | (h >= 160), (h >= 5) & (h <= 25), (h >= 20) & (h <= 40), (h >= 35) & (h <= 90)
+    reference = {
+        'rot_fruit_color': (red | ((h >= 5) & (h <= 35)) | green) & (s >= 40) & (v >= 50),
+        'dark_brown': (h >= 5) & (h <= 25) & (s >= 30) & (v >= 15) & (v <= 100),
+        'med_brown': (h >= 5) & (h <= 30) & (s >= 25) & (s <= 180) & (v >= 80) & (v <= 150),
+        'mold': (s < 60) & (v > 60) & (v < 200),
+        'brown_hue': (h >= 8) & (h <= 28),
+        'validator_fruit': ((red | orange) & (s >= 30) & (v >= 30)) | ((yellow | green) & (s >= 25) & (v >= 30)) |
+                           ((h >= 5) & (h <= 30) & (s >= 20) & (v >= 15) & (v <= 150))
+    }
+    counts = count_color_rules(hsv)
+    for name, mask in reference.items():
+        rules = VALIDATOR_FRUIT_RULES if name == 'validator_fruit' else (name,)
+        assert counts.count(*rules) == np.count_nonzero(mask), name
+
+
+def test_unique_colors_match_np_unique():
+    rng = np.random.default_rng(5)
+    few = rng.integers(0, 4, (120, 160, 3)).astype(np.uint8) * 60
+    many = rng.integers(0, 256, (120, 160, 3)).astype(np.uint8)
+    for img in (few, many, make_fruits([(320, 240)], radius=150)):
+        exact = len(np.unique(img.reshape(-1, 3), axis=0))
+        assert count_unique_colors(img) == exact
+        limited = count_unique_colors(img, limit=500, first_chunk=1024)
+        assert limited == exact if exact <= 500 else limited > 500
+
+
+# ===== BOUNDED VALIDATOR =====
+
+def test_vectorized_contour_areas_match_opencv():
+    noise = cv2.GaussianBlur(np.random.default_rng(9).integers(0, 256, (240, 320)).astype(np.uint8), (9, 9), 0)
+    contours, _ = cv2.findContours(cv2.Canny(noise, 20, 40), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    assert len(contours) > 10
+    assert np.array_equal(contour_areas(contours), [cv2.contourArea(c) for c in contours])
+
+
+def test_rectangle_scan_is_capped_and_cut_by_the_deadline():
+    img = np.zeros((480, 640), dtype=np.uint8)
+    for x in (20, 230, 440):
+        cv2.rectangle(img, (x, 100), (x + 180, 300), 255, 2)
+    report = {}
+    assert count_rectangles(img, report=report) == 2
+    assert report['polygon_candidates'] == 3 and report['polygons_examined'] == 2 and report['truncated'] == []
+
+    report = {}
+    assert count_rectangles(img, max_polygons=1, report=report) == 1
+    assert report['truncated'] == ['polygons']
+
+    report = {}
+    assert count_rectangles(img, deadline=time.perf_counter() - 1, report=report) == 0
+    assert report['polygons_examined'] == 0 and report['truncated'] == ['polygons (budget)']
+
+
+def test_validator_reports_what_it_skipped_or_cut():
+    report = {}
+    measure_image(ImageContext(make_fruits([(320, 240)], radius=150)), deadline=time.perf_counter() - 1, report=report)
+    assert report['skipped'] == ['hough'] and report['truncated'] == ['polygons (budget)']
+
+
+# ===== BATCHED FEATURES =====
+
+def test_batched_features_equal_the_single_image_features():
+    batch = np.stack([make_spotted_fruit(320, 240, seed=1), make_spotted_fruit(320, 240, seed=2),
+                      make_fruits([(80, 120), (240, 120)], radius=60, size=(240, 320)),
+                      np.full((240, 320, 3), 128, dtype=np.uint8)])
+    batched = batch_features(batch)
+    for i, img in enumerate(batch):
+        single = extract_features(ImageContext(img), max_polygons=64)
+        assert batched[i:i + 1].tobytes() == single.tobytes(), i
+
+
+# ===== SHARED FEATURES =====
+
+def test_validators_and_rot_scorer_share_one_measurement():
+    ctx = ImageContext(make_spotted_fruit(320, 240))
+    image = image_features(ctx)
+    center = center_features(ctx)
+    legacy = as_dict(legacy_fruit_rules(image))
+    assert is_fruit_like_optimized(ctx) == (legacy['is_fruit'], legacy['confidence'], legacy['reason'])
+    # Later stages read the cached vectors instead of measuring again
+    assert image_features(ctx) is image and center_features(ctx) is center
+    features = extract_features(ctx)
+    assert features['image'].tobytes() == image.tobytes() and features['center'].tobytes() == center.tobytes()
+    assert as_dict(image) == as_dict(as_record(measure_image(ImageContext(ctx.bgr)), IMAGE_FEATURES))
+
+
+# ===== TILED ANALYSIS =====
+
+def test_tiled_rot_features_match_the_full_frame():
+    ctx = ImageContext(make_spotted_fruit(1600, 1200))
+    budget = 1600 * 1200 * 48 // 6
+    full = measure_center(ctx.center)
+    assert full['num_dark_spots'] > 1
+    assert measure_center(ctx.center, budget) == full
+
+
+def test_tiled_validator_keeps_pixel_stats_and_verdict():
+    img = make_spotted_fruit(1600, 1200)
+    full = measure_image(ImageContext(img))
+    report = {}
+    tiled = measure_image(ImageContext(img), budget_bytes=1600 * 1200 * 48 // 6, report=report)
+    assert report['tiled']
+    # Pixel statistics are exact; the shape checks see a downscaled copy (documented divergence)
+    shape_checks = ('edge_ratio', 'rectangular_objects', 'num_lines')
+    assert {k: v for k, v in tiled.items() if k not in shape_checks} == \
+           {k: v for k, v in full.items() if k not in shape_checks}
+    assert full['edge_ratio'] / 4 <= tiled['edge_ratio'] <= full['edge_ratio'] * 4
+    verdicts = fruit_rules(np.concatenate([as_record(full, IMAGE_FEATURES), as_record(tiled, IMAGE_FEATURES)]))
+    assert verdicts['is_fruit'].tolist() == [True, True]
+
+
+# ===== INFERENCE BACKENDS =====
+
+def test_tflite_pool_binds_one_interpreter_per_thread():
+    backend = make_tflite_backend(fake_interpreter_class(), pool_size=2)
+    assert backend.stats()['interpreters'] == 2 and backend.stats()['idle_interpreters'] == 2
+    batch = np.stack([np.full((128, 128, 3), value, dtype=np.float32) for value in (0.25, 0.5, 0.75)])
+    assert np.allclose(backend.predict_batch(batch)[:, :2], [[0.25, 0.75], [0.5, 0.5], [0.75, 0.25]])
+    assert np.allclose(backend.predict_batch(batch[:1])[:, 0], [0.25])  # resized back to one image
+
+    # Three more threads: the pool's last idle interpreter, then two new ones; none is shared
+    def request(_):
+        backend.predict_batch(batch[:1])
+        return backend._thread_interpreter()
+    assert len({id(pooled) for pooled in call_concurrently(request, [(i,) for i in range(3)])}) == 3
+    assert backend.stats()['interpreters'] == 4 and backend.stats()['idle_interpreters'] == 0
+
+
+def test_tflite_quantized_io_and_deferred_pool():
+    backend = make_tflite_backend(fake_interpreter_class(np.uint8, (1 / 255.0, 0)), pool_size=2, defer_pool=True)
+    assert backend.input_dtype == np.uint8 and backend.stats()['interpreters'] == 0
+    backend.reset_after_fork()
+    assert backend.stats()['interpreters'] == 2
+    pixels = np.full((2, 128, 128, 3), 51, dtype=np.uint8)  # raw uint8 pixels = 0.2
+    floats = pixels.astype(np.float32) / 255.0
+    for batch in (pixels, floats):
+        assert np.allclose(backend.predict_batch(batch)[:, :2], [[0.2, 0.8]] * 2, atol=1 / 255.0)
+
+
+# ===== SEGMENTATION =====
+
+def test_segmentation_finds_each_of_two_fruits():
+    ctx = ImageContext(make_fruits([(160, 240), (480, 240)], radius=110))
+    regions = find_fruit_regions(ctx)
+    assert len(regions) == 2
+    for center in ((160, 240), (480, 240)):
+        fruit_box = (center[0] - 110, center[1] - 110, 220, 220)
+        assert max(box_overlap(region['bbox'], fruit_box)[1] for region in regions) > 0.7
+    crops = crop_batch(ctx, regions, 128)
+    assert crops.shape == (2, 128, 128, 3) and crops.dtype == np.float32 and crops.max() <= 1.0
+
+
+def test_segmentation_leaves_a_single_fruit_whole():
+    squash = ImageContext.from_file(sample_image(
+        'single-squash-vegetable-marrow-zucchini-isolated-as-package-design-element-68958488.webp'))
+    assert squash.is_valid
+    assert find_fruit_regions(squash.working(1024)) == []
+    assert find_fruit_regions(ImageContext(make_fruits([(320, 240)], radius=150))) == []
+
+
+def test_multi_fruit_crops_share_the_photo_model_call():
+    app = load_app()
+    saved = (app.predictor, app.tiny_predictor, app.app.config['SEGMENTATION'])
+    batches = []
+    def full_model(batch):
+        batches.append(len(batch))
+        return np.tile(np.array([0.9, 0.1, 0, 0, 0], dtype=np.float32), (len(batch), 1))
+    img = make_fruits([(160, 240), (480, 240)], radius=110)
+    img = np.clip(img.astype(np.int16) + np.random.default_rng(1).integers(-12, 13, img.shape), 0, 255)
+    try:
+        app.predictor, app.tiny_predictor = DirectPredictor(full_model), None
+        app.app.config['SEGMENTATION'] = True
+        status, result = app.classify_image(ImageContext(img.astype(np.uint8)), 'two.jpg')
+        assert status == 200 and batches == [3]  # the photo plus both crops in one forward pass
+        assert len(result['fruits']) == 2 and result['aggregate']
+    finally:
+        app.predictor, app.tiny_predictor, app.app.config['SEGMENTATION'] = saved
+
+
+# ===== FEATURE STORE =====
+
+def test_labels_need_a_folder_file_entry_or_whole_word():
+    assert label_for('training_data/overripe/IMG_1.jpg') == 'overripe'
+    assert label_for('img/rotten apple.jpeg') == 'rotten' and label_for('img/Rotten orange.jpeg') == 'rotten'
+    assert label_for('x/rot-01.jpg') == 'rotten' and label_for('x/fresh_apple.png') == 'fresh'
+    assert label_for('img/carrrrot.webp') is None and label_for('x/carrot.jpg') is None
+    assert label_for('x/rotation.jpg') is None and label_for('img/apple.jpg') is None  # unlabeled: skipped
+
+    folder = tempfile.mkdtemp(prefix='labels-test-')
+    try:
+        labels_file = os.path.join(folder, 'labels.csv')
+        with open(labels_file, 'w') as f:
+            f.write('# path or file name, label\nimg/apple.jpg,fresh\ncarrot.jpg,Ripe\n')
+        labels = load_labels(labels_file)
+        assert label_for('img/apple.jpg', labels) == 'fresh' and label_for('other/carrot.jpg', labels) == 'ripe'
+        with open(labels_file, 'a') as f:
+            f.write('kiwi.jpg,mouldy\n')
+        try:
+            load_labels(labels_file)
+            assert False, 'unknown label accepted'
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(folder)
+
+
+# ===== PREDICTION CACHE =====
+
+def test_cache_lru_and_ttl():
+    cache = PredictionCache('no-such-model.h5', max_entries=2, ttl_seconds=0.2)
+    cache.put('a', {'status': 200})
+    cache.put('b', {'status': 200})
+    assert cache.get('a') == {'status': 200}  # a is now the most recent
+    cache.put('c', {'status': 400})
+    assert cache.get('b') is None and cache.get('a') is not None and cache.get('c') is not None
+    time.sleep(0.3)
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (3, 2, 1)
+    assert PredictionCache('no-such-model.h5', max_entries=0).get('a') is None
+
+
+def test_cache_disk_tier_and_invalidation():
+    folder = tempfile.mkdtemp(prefix='cache-test-')
+    try:
+        model_path = os.path.join(folder, 'model.h5')
+        with open(model_path, 'wb') as f:
+            f.write(b'weights v1')
+        disk_path = os.path.join(folder, 'cache.sqlite')
+        cache = PredictionCache(model_path, disk_path=disk_path)
+        cache.put('a', {'status': 200, 'result': {'freshness_level': 'Fresh'}})
+
+        restarted = PredictionCache(model_path, disk_path=disk_path)  # a new worker
+        assert restarted.get('a') == {'status': 200, 'result': {'freshness_level': 'Fresh'}}
+        assert restarted.stats()['disk_hits'] == 1
+
+        with open(model_path, 'wb') as f:
+            f.write(b'weights v2, retrained')
+        assert restarted.check_model() and restarted.check_model()  # stale until reloaded
+        assert restarted.get('a') is not None  # still the v1 weights answering
+        new_version = PredictionCache(model_path).model_version
+        assert restarted.model_version != new_version
+        assert restarted.set_model_version(new_version) and restarted.get('a') is None
+        assert not restarted.check_model()
+        assert PredictionCache(model_path, disk_path=disk_path).get('a') is None
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_cache_keys_include_pipeline_settings():
+    folder = tempfile.mkdtemp(prefix='cache-test-')
+    try:
+        disk_path = os.path.join(folder, 'cache.sqlite')
+        settings = {'ANALYSIS_MAX_SIDE': 1024, 'SEGMENTATION': True}
+        cache = PredictionCache('no-such-model.h5', disk_path=disk_path, pipeline_version=pipeline_fingerprint(settings))
+        cache.put('a', {'status': 200})
+        assert pipeline_fingerprint(dict(reversed(list(settings.items())))) == cache.pipeline_version
+
+        same = PredictionCache('no-such-model.h5', disk_path=disk_path, pipeline_version=pipeline_fingerprint(settings))
+        changed = PredictionCache('no-such-model.h5', disk_path=disk_path,
+                                  pipeline_version=pipeline_fingerprint({**settings, 'ANALYSIS_MAX_SIDE': 0}))
+        assert same.get('a') == {'status': 200}
+        assert changed.get('a') is None
+    finally:
+        shutil.rmtree(folder)
+
+
+# ===== MODEL ARTIFACT =====
+
+def expect_artifact_error(path, **kwargs):
+    try:
+        open_artifact(path, **kwargs)
+    except ArtifactError as e:
+        return str(e)
+    raise AssertionError(f"{path} was accepted")
+
+
+def test_artifact_refuses_mismatched_or_corrupt_files():
+    tmp = tempfile.mkdtemp()
+    try:
+        tflite_path, source_path, path = (os.path.join(tmp, name) for name in ('m.tflite', 'm.h5', 'm.fmm'))
+        payload = os.urandom(1000)
+        for name, data in ((tflite_path, payload), (source_path, b'weights')):
+            with open(name, 'wb') as f:
+                f.write(data)
+        metadata = write_artifact(tflite_path, path, source_path=source_path)
+
+        artifact = open_artifact(path, source_path=source_path, verify_payload=True)
+        assert bytes(artifact.payload) == payload and artifact.fingerprint == metadata['payload_sha256'][:16]
+        artifact.close()
+
+        assert 'preprocessing spec' in expect_artifact_error(path, expected_spec=dict(PREPROCESSING_SPEC, input_size=224))
+
+        with open(path, 'r+b') as f:
+            f.write(bytes([payload[0] ^ 0xFF]))
+        assert 'hash mismatch' in expect_artifact_error(path, verify_payload=True)
+
+        with open(source_path, 'wb') as f:
+            f.write(b'retrained weights')
+        assert 'stale' in expect_artifact_error(path, source_path=source_path)
+
+        with open(path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'X')
+        assert 'bad magic' in expect_artifact_error(path)
+        with open(path, 'wb') as f:
+            f.write(b'tiny')
+        assert 'too small' in expect_artifact_error(path)
+    finally:
+        shutil.rmtree(tmp)
+
+
+# ===== READINESS =====
+
+_app = None
+
+
+def load_app():
+    """
+    app.py imported once per run, with its ledger in a temp dir and a model file
+    that does not exist (no TensorFlow needed); removed again at exit
+    """
+    global _app
+    if _app is not None:
+        return _app
+    tmp = tempfile.mkdtemp()
+    env = {'FRUIT_LEDGER_DIR': os.path.join(tmp, 'ledger'), 'FRUIT_BACKEND': 'tflite',
+           'FRUIT_TFLITE_MODEL_PATH': os.path.join(tmp, 'missing.tflite'), 'FRUIT_WARMUP_PASSES': '1'}
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        _app = importlib.import_module('app')
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    for thread in threading.enumerate():
+        if thread.name == 'model-warmup':
+            thread.join(5)
+    atexit.register(lambda: (_app.blockchain.close(), shutil.rmtree(tmp)))
+    return _app
+
+
+def test_ready_answers_503_until_warmup_has_finished():
+    app = load_app()
+    saved = app.predictor
+    client = app.app.test_client()
+    try:
+        app.predictor = None
+        app.run_warmup()
+        response = client.get('/ready')
+        assert response.status_code == 503 and response.get_json()['status'] == 'model not loaded'
+
+        called, release = threading.Event(), threading.Event()
+        def predict_batch(batch):
+            called.set()
+            release.wait(5)
+            return np.zeros((len(batch), 5), dtype=np.float32)
+        app.predictor = DirectPredictor(predict_batch)
+        warmup = threading.Thread(target=app.run_warmup)
+        warmup.start()
+        assert called.wait(5)
+        response = client.get('/ready')
+        assert response.status_code == 503 and response.get_json()['status'] == 'warming up'
+
+        release.set()
+        warmup.join(5)
+        response = client.get('/ready')
+        assert response.status_code == 200 and response.get_json() == {'ready': True, 'status': 'ready'}
+    finally:
+        app.predictor = saved
+
+
+# ===== CASCADE =====
+
+def test_cascade_exits_and_full_model_savings():
+    app = load_app()
+    saved = (app.predictor, app.tiny_predictor, app.cascade_stats)
+    full_calls = []
+    tiny_confidence = [0.95]
+    def full_model(batch):
+        full_calls.append(len(batch))
+        return np.tile(np.array([0.9, 0.1, 0, 0, 0], dtype=np.float32), (len(batch), 1))
+    def tiny_model(batch):
+        return np.tile(np.array([0, tiny_confidence[0], 0, 0, 0], dtype=np.float32), (len(batch), 1))
+    try:
+        app.predictor, app.tiny_predictor = DirectPredictor(full_model), DirectPredictor(tiny_model)
+        app.cascade_stats = CascadeStats()
+        fruit = app.make_warmup_images(1)[0]
+        assert app.classify_image(ImageContext(np.full((480, 640, 3), 128, dtype=np.uint8)), 'gray.jpg')[0] == 400
+        assert app.classify_image(ImageContext(make_spotted_fruit(640, 480)), 'spots.jpg')[0] == 200
+        assert app.classify_image(ImageContext(fruit), 'tiny.jpg')[0] == 200
+        assert full_calls == []
+        tiny_confidence[0] = 0.5
+        assert app.classify_image(ImageContext(fruit), 'full.jpg')[0] == 200
+        assert full_calls == [1]
+
+        stats = app.cascade_stats.stats()
+        assert stats['exits'] == {'validator_reject': 1, 'rotten_override': 1, 'fresh_override': 0,
+                                  'tiny_model': 1, 'full_model': 1}
+        assert {name: stage['runs'] for name, stage in stats['stages'].items()} == \
+               {'validator': 4, 'rot_heuristics': 3, 'tiny_model': 2, 'full_model': 1}
+        assert stats['full_model_skipped'] == 2
+        assert stats['est_full_model_ms_saved'] == 2 * stats['stages']['full_model']['avg_ms']
+    finally:
+        app.predictor, app.tiny_predictor, app.cascade_stats = saved
+
+    # An early exit whose fruit crops still ran the full model saved nothing
+    crops = CascadeStats()
+    crops.record({'validator': 1.0, 'rot_heuristics': 1.0, 'full_model': 10.0}, 'rotten_override')
+    assert crops.stats()['full_model_skipped'] == 0 and crops.stats()['exits']['rotten_override'] == 1
+
+
+# ===== SINGLE-FLIGHT =====
+
+def test_single_flight_runs_duplicates_once():
+    in_flight = SingleFlight()
+    runs = []
+    release = threading.Event()
+
+    def classify(key):
+        runs.append(key)
+        release.wait(5)
+        return {'image': key}
+
+    def request(key):
+        return in_flight.do(key, lambda: classify(key))
+    timer = threading.Timer(0.2, release.set)  # let the duplicates arrive while 'a' is in flight
+    timer.start()
+    results = call_concurrently(request, [('a',), ('a',), ('a',), ('b',)])
+    timer.cancel()
+
+    assert sorted(runs) == ['a', 'b']
+    assert [result for result, _ in results] == [{'image': 'a'}] * 3 + [{'image': 'b'}]
+    assert sorted(coalesced for _, coalesced in results[:3]) == [False, True, True]
+    stats = in_flight.stats()
+    assert (stats['leaders'], stats['coalesced'], stats['in_flight']) == (2, 2, 0)
+    assert in_flight.do('a', lambda: 'again') == ('again', False)  # nothing cached once done
+
+
+def test_single_flight_shares_the_leader_error():
+    in_flight = SingleFlight()
+    started = threading.Event()
+
+    def failing():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError('pipeline failed')
+
+    def request(leader):
+        if not leader:
+            started.wait(5)
+        try:
+            return in_flight.do('a', failing)
+        except ValueError as e:
+            return str(e)
+    assert call_concurrently(request, [(True,), (False,)]) == ['pipeline failed'] * 2
+    assert in_flight.stats()['in_flight'] == 0
+
+
+if __name__ == '__main__':
+    tests = [(name, test) for name, test in sorted(globals().items()) if name.startswith('test_')]
+    for name, test in tests:
+        test()
+        print(f"✅ {name}")
+    print(f"{len(tests)} pipeline checks passed")
@@ -0,0 +1,221 @@
+"""
+Memory-bounded image statistics for very large images
+The full-frame heuristics hold several image-sized temporaries at once (HSV,
+masks, a float64 Laplacian, dilations). Here the image is walked in horizontal
+strips sized from a memory budget, and only additive totals are kept: rule-code
+and channel histograms, integer Laplacian sums and sums of squares, and
+dark-spot labels merged across strip seams with union-find. Totals are
+finished with pixel_stats, so the rot features and the validator's pixel
+statistics are bit-identical to the full-frame measurements.
+The validator's edge/contour/line checks are not tiled: they run on an
+INTER_AREA copy that fits the budget (fit_within_budget). Canny edge density
+depends on resolution, so edge_ratio there matches the full-frame value of a
+downscaled image, not of the original - on 12 MP photos it moved by 2-4x,
+enough to cross the 0.15/0.30 edge_ratio rules on busy scenes. At the
+default ANALYSIS_MAX_SIDE and memory budget the analysed image is small
+enough that tiling never kicks in.
+"""
+
+import math
+
+import cv2
+import numpy as np
+
+from color_features import ColorRuleCounts, rule_codes, new_color_bitmap, mark_colors
+from pixel_stats import (histogram, histogram_mean, histogram_std, histogram_range,
+                         laplacian_rows, laplacian_moments, moments_variance)
+
+# Rough peak of temporaries per pixel: full-frame path vs one strip of the tiled path
+FULL_FRAME_BYTES_PER_PIXEL = 48
+STRIP_BYTES_PER_PIXEL = 40
+MIN_STRIP_ROWS = 16
+
+
+def needs_tiling(shape, budget_bytes):
+    """True if the full-frame heuristics would exceed budget_bytes on an image of this shape"""
+    if not budget_bytes:
+        return False
+    return shape[0] * shape[1] * FULL_FRAME_BYTES_PER_PIXEL > budget_bytes
+
+
+def strip_rows(width, budget_bytes):
+    """Rows per strip so one strip's temporaries stay within budget_bytes"""
+    return max(MIN_STRIP_ROWS, int(budget_bytes // (width * STRIP_BYTES_PER_PIXEL)))
+
+
+def iter_strips(height, rows, halo=0):
+    """
+    Yield (start, stop, top, bottom) for consecutive strips of `rows` rows
+    start:stop is the strip itself; top:bottom adds up to `halo` rows of
+    context on each side for neighbourhood filters
+    """
+    for start in range(0, height, rows):
+        stop = min(height, start + rows)
+        yield start, stop, max(0, start - halo), min(height, stop + halo)
+
+
+def fit_within_budget(bgr, budget_bytes):
+    """Downscaled copy (INTER_AREA) small enough for the full-frame path, plus its scale"""
+    h, w = bgr.shape[:2]
+    factor = math.sqrt(budget_bytes / (h * w * FULL_FRAME_BYTES_PER_PIXEL))
+    if factor >= 1:
+        return bgr, 1.0
+    size = (max(1, int(w * factor)), max(1, int(h * factor)))
+    return cv2.resize(bgr, size, interpolation=cv2.INTER_AREA), size[0] / w
+
+
+class SpotCounter:
+    """
+    Connected components (8-connectivity) of a binary mask fed strip by strip
+    Each strip is labelled on its own; labels touching across a seam are
+    merged with union-find, so a spot spanning several strips counts once
+    """
+
+    def __init__(self):
+        self._parent = [0]
+        self._merges = 0
+        self._last_row = None
+
+    def _find(self, label):
+        root = label
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[label] != root:
+            self._parent[label], label = root, self._parent[label]
+        return root
+
+    def _union(self, a, b):
+        a, b = self._find(a), self._find(b)
+        if a != b:
+            self._parent[max(a, b)] = min(a, b)
+            self._merges += 1
+
+    def add(self, mask):
+        """Label the next strip (uint8 mask of consecutive rows)"""
+        count, labels = cv2.connectedComponents(mask)
+        offset = len(self._parent) - 1
+        self._parent.extend(range(offset + 1, offset + count))
+
+        first = np.where(labels[0] > 0, labels[0] + offset, 0)
+        if self._last_row is not None:
+            self._merge_seam(self._last_row, first)
+        self._last_row = np.where(labels[-1] > 0, labels[-1] + offset, 0)
+
+    def _merge_seam(self, above, below):
+        # 8-connectivity: each pixel touches the three pixels below it
+        pairs = []
+        for shift in (-1, 0, 1):
+            a = above[max(0, -shift):len(above) - max(0, shift)]
+            b = below[max(0, shift):len(below) - max(0, -shift)]
+            touching = (a > 0) & (b > 0)
+            pairs.append(np.stack([a[touching], b[touching]], axis=1))
+        pairs = np.unique(np.concatenate(pairs), axis=0)
+        for a, b in pairs:
+            self._union(int(a), int(b))
+
+    @property
+    def count(self):
+        return len(self._parent) - 1 - self._merges
+
+
+def _laplacian_sums(gray, top, start, stop):
+    """Sum and sum of squares of the Laplacian over rows start:stop of a strip read from top"""
+    _, total, total_sq = laplacian_moments(laplacian_rows(gray)[start - top:stop - top])
+    return total, total_sq
+
+
+def tiled_rot_features(bgr, kernel_size, budget_bytes):
+    """
+    Same measurements as feature_engine.measure_center, computed strip by strip
+    bgr is the center region; kernel_size is the dark-spot dilation kernel
+    """
+    h, w = bgr.shape[:2]
+    total_pixels = h * w
+    halo = max(1, 2 * (kernel_size // 2))  # two dilation passes; the Laplacian needs 1
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+
+    codes_hist = np.zeros(256, dtype=np.int64)
+    v_hist = np.zeros(256, dtype=np.int64)
+    s_hist = np.zeros(256, dtype=np.int64)
+    very_dark = dark = 0
+    lap_sum = lap_sq = 0
+    spots = SpotCounter()
+
+    for start, stop, top, bottom in iter_strips(h, strip_rows(w, budget_bytes), halo):
+        padded = bgr[top:bottom]
+        core = bgr[start:stop]
+
+        hsv = cv2.cvtColor(core, cv2.COLOR_BGR2HSV)
+        codes_hist += np.bincount(rule_codes(hsv).ravel(), minlength=256)
+        s_hist += histogram(hsv[:, :, 1])
+        v_hist += histogram(hsv[:, :, 2])
+
+        # A pixel is below a threshold on all channels iff its brightest channel is
+        brightest = core.max(axis=2)
+        very_dark += int(np.count_nonzero(brightest < 40))
+        dark += int(np.count_nonzero(brightest < 70))
+
+        s, l = _laplacian_sums(cv2.cvtColor(padded, cv2.COLOR_BGR2GRAY), top, start, stop)
+        lap_sum += s
+        lap_sq += l
+
+        dark_mask = (padded.max(axis=2) < 60).astype(np.uint8)
+        dilated = cv2.dilate(dark_mask, kernel, iterations=2)
+        spots.add(dilated[start - top:stop - top])
+
+    colors = ColorRuleCounts(codes_hist, total_pixels)
+    return {
+        'fruit_color_ratio': colors.ratio('rot_fruit_color'),
+        'very_dark_ratio': very_dark / total_pixels,
+        'dark_ratio': dark / total_pixels,
+        'brown_ratio': (colors.count('dark_brown') + colors.count('med_brown')) / total_pixels,
+        'texture_variance': moments_variance(total_pixels, lap_sum, lap_sq),
+        'avg_brightness': histogram_mean(v_hist),
+        'mold_ratio': colors.ratio('mold'),
+        'brightness_std': histogram_std(v_hist),
+        'avg_saturation': histogram_mean(s_hist),
+        'brown_hue_ratio': colors.ratio('brown_hue'),
+        'num_dark_spots': spots.count,
+        'contrast': histogram_range(v_hist)
+    }
+
+
+def tiled_fruit_stats(bgr, budget_bytes, unique_color_limit=None):
+    """
+    Whole-image pixel statistics used by is_fruit_like, computed strip by strip
+    (the edge/contour/line checks run on fit_within_budget() instead)
+    """
+    h, w = bgr.shape[:2]
+    total_pixels = h * w
+
+    codes_hist = np.zeros(256, dtype=np.int64)
+    v_hist = np.zeros(256, dtype=np.int64)
+    gray_hist = np.zeros(256, dtype=np.int64)
+    lap_sum = lap_sq = 0
+    seen = new_color_bitmap()
+    unique_colors = 0
+
+    for start, stop, top, bottom in iter_strips(h, strip_rows(w, budget_bytes), halo=1):
+        core = bgr[start:stop]
+
+        hsv = cv2.cvtColor(core, cv2.COLOR_BGR2HSV)
+        codes_hist += np.bincount(rule_codes(hsv).ravel(), minlength=256)
+        v_hist += histogram(hsv[:, :, 2])
+
+        gray = cv2.cvtColor(bgr[top:bottom], cv2.COLOR_BGR2GRAY)
+        gray_hist += histogram(gray[start - top:stop - top])
+        s, l = _laplacian_sums(gray, top, start, stop)
+        lap_sum += s
+        lap_sq += l
+
+        if unique_color_limit is None or unique_colors <= unique_color_limit:
+            mark_colors(seen, core)
+            unique_colors = int(np.count_nonzero(seen))
+
+    return {
+        'color_rules': ColorRuleCounts(codes_hist, total_pixels),
+        'unique_colors': unique_colors,
+        'gray_peak': int(gray_hist.max()),
+        'laplacian_var': moments_variance(total_pixels, lap_sum, lap_sq),
+        'brightness_std': histogram_std(v_hist)
+    }
@@ -0,0 +1,201 @@
+"""
+Tune detect_rotten_features' thresholds on labeled images
+extract: measure the feature vectors of every image once (decoded and
+         analysed as /predict does) into a columnar store (feature_store.py);
+         unchanged files are not measured again
+sweep:   score thousands of ROT_PARAMS configurations against the stored
+         vectors as NumPy array operations (feature_rules.rot_rules over a
+         (configs, images) grid) and rank them by accuracy
+
+Labels come from the folder (training_data/<label>/), a --labels CSV file
+(path or file name, label) or whole words of the file name ("rotten", "rot",
+"fresh"); unlabeled images are skipped. Only images accepted by the fruit
+validator are scored, as in /predict; the CNN is not involved.
+
+Usage:
+  python tune_rot_thresholds.py extract [folder ...] [--labels labels.csv]
+  python tune_rot_thresholds.py sweep [--set name=v1,v2,... | name=start:stop:step ...]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from feature_engine import FEATURES, extract_features
+from feature_rules import ROT_PARAMS, fruit_rules, rot_rules
+from feature_store import label_for, load_labels, find_images, save_store, load_store
+from image_context import ImageContext
+
+DEFAULT_FOLDERS = ['training_data', 'img', 'realimages']
+DEFAULT_STORE = 'rot_features.npz'
+
+# Swept when no --set is given: 4^6 = 4096 configurations around the current values
+DEFAULT_GRID = {
+    'very_dark': [0.03, 0.05, 0.07, 0.10],
+    'dark': [0.06, 0.08, 0.10, 0.12],
+    'early_dark': [0.02, 0.03, 0.04, 0.05],
+    'threshold': [50, 55, 60, 65],
+    'group_threshold': [60, 65, 70, 75],
+    'fresh_brightness': [110, 120, 130, 140]
+}
+
+# Upper bound on configs x images evaluated in one array operation
+MAX_CELLS = 1 << 22
+
+
+# ===== EXTRACT =====
+
+def extract(args):
+    budget_bytes = args.memory_mb * 1024 * 1024
+    previous = {}
+    if os.path.exists(args.store):
+        stored = load_store(args.store)
+        for i, path in enumerate(stored['path']):
+            previous[str(path)] = (int(stored['size'][i]), int(stored['mtime_ns'][i]), stored['features'][i])
+
+    labels_file = load_labels(args.labels) if args.labels else None
+    paths = find_images(args.folders)
+    rows, kept, unlabeled = [], [], []
+    reused = 0
+    start = time.perf_counter()
+    for path in paths:
+        label = label_for(path, labels_file)
+        if label is None:
+            unlabeled.append(path)
+            continue
+        st = os.stat(path)
+        cached = previous.get(path)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+            features = cached[2]
+            reused += 1
+        else:
+            with open(path, 'rb') as f:
+                ctx = ImageContext.from_bytes(f.read(), target_side=args.max_side or None)
+            if not ctx.is_valid:
+                print(f"[Extract] Skipping unreadable image: {path}")
+                continue
+            ctx = ctx.working(args.max_side)
+            features = extract_features(ctx, budget_bytes=budget_bytes, max_polygons=args.max_polygons)[0]
+        rows.append(features)
+        kept.append((path, label, st.st_size, st.st_mtime_ns))
+
+    if unlabeled:
+        print(f"[Extract] Skipped {len(unlabeled)} unlabeled images (no label folder, --labels entry "
+              f"or label word in the name), e.g. {unlabeled[0]}")
+    if not rows:
+        print("[Extract] No labeled images found")
+        return
+    paths, labels, sizes, mtimes = zip(*kept)
+    save_store(args.store, np.array(rows, dtype=FEATURES), paths, labels, sizes, mtimes)
+    counts = {label: labels.count(label) for label in sorted(set(labels))}
+    print(f"[Extract] {len(rows)} images ({len(rows) - reused} measured, {reused} unchanged) "
+          f"in {time.perf_counter() - start:.1f}s -> {args.store}")
+    print(f"[Extract] Labels: {counts}")
+
+
+# ===== SWEEP =====
+
+def parse_values(text):
+    """'0.03,0.05' or 'start:stop:step' (stop included)"""
+    if ':' in text:
+        start, stop, step = (float(part) for part in text.split(':'))
+        return list(np.arange(start, stop + step / 2, step))
+    return [float(value) for value in text.split(',')]
+
+
+def build_grid(settings):
+    """Cartesian product of the swept values as {name: (k, 1) array}"""
+    grid = dict(DEFAULT_GRID) if not settings else {}
+    for setting in settings:
+        name, _, values = setting.partition('=')
+        if name not in ROT_PARAMS:
+            raise SystemExit(f"Unknown parameter '{name}' - choose from: {', '.join(ROT_PARAMS)}")
+        grid[name] = parse_values(values)
+    names = list(grid)
+    mesh = np.meshgrid(*[np.asarray(grid[name], dtype=np.float64) for name in names], indexing='ij')
+    return {name: values.reshape(-1, 1) for name, values in zip(names, mesh)}
+
+
+def evaluate(features, is_rotten_label, grid):
+    """Metrics of every configuration in the grid, one row each"""
+    configs = len(next(iter(grid.values())))
+    step = max(1, MAX_CELLS // len(features))
+    n_rotten = max(1, int(is_rotten_label.sum()))
+    n_other = max(1, int((~is_rotten_label).sum()))
+
+    metrics = {key: np.empty(configs) for key in ('accuracy', 'false_rotten', 'missed_rotten', 'rejected')}
+    for start in range(0, configs, step):
+        chunk = {name: values[start:start + step] for name, values in grid.items()}
+        results = rot_rules(features, chunk)
+        predicted = results['is_rotten']
+        stop = start + len(predicted)
+        metrics['accuracy'][start:stop] = (predicted == is_rotten_label).mean(axis=1)
+        metrics['false_rotten'][start:stop] = (predicted & ~is_rotten_label).sum(axis=1) / n_other
+        metrics['missed_rotten'][start:stop] = (~predicted & is_rotten_label).sum(axis=1) / n_rotten
+        metrics['rejected'][start:stop] = results['poor_quality'].mean(axis=1)
+    return metrics
+
+
+def print_row(label, values, metrics, i):
+    settings = ' '.join(f"{name}={value:g}" for name, value in values.items())
+    print(f"{label:>8s} {metrics['accuracy'][i] * 100:8.1f}% {metrics['false_rotten'][i] * 100:11.1f}% "
+          f"{metrics['missed_rotten'][i] * 100:12.1f}% {metrics['rejected'][i] * 100:8.1f}%  {settings}")
+
+
+def sweep(args):
+    store = load_store(args.store)
+    accepted = fruit_rules(store['features']['image'])['is_fruit']
+    features = store['features']['center'][accepted]
+    is_rotten_label = store['label'][accepted] == 'rotten'
+    print(f"Scoring {len(features)} images accepted by the fruit validator "
+          f"({int(is_rotten_label.sum())} rotten, {len(store['path']) - len(features)} rejected as non-fruit)")
+    if not len(features):
+        return
+
+    grid = build_grid(args.set)
+    configs = len(next(iter(grid.values())))
+    start = time.perf_counter()
+    metrics = evaluate(features, is_rotten_label, grid)
+    elapsed = time.perf_counter() - start
+    print(f"Evaluated {configs} configurations in {elapsed:.2f}s")
+    print("=" * 100)
+
+    # Best accuracy first; ties go to fewer fresh fruits called rotten
+    order = np.lexsort((metrics['false_rotten'], -metrics['accuracy']))
+    print(f"{'rank':>8s} {'accuracy':>9s} {'false rotten':>12s} {'missed rotten':>13s} {'rejected':>9s}  settings")
+    current = evaluate(features, is_rotten_label, {name: np.array([[ROT_PARAMS[name]]]) for name in grid})
+    print_row('current', {name: ROT_PARAMS[name] for name in grid}, current, 0)
+    for rank, i in enumerate(order[:args.top], 1):
+        print_row(str(rank), {name: grid[name][i, 0] for name in grid}, metrics, i)
+    print("=" * 100)
+    print("false rotten: share of non-rotten images called rotten; rejected: judged poor quality (not scored)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune detect_rotten_features' thresholds on labeled images")
+    commands = parser.add_subparsers(dest='command', required=True)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--store', default=DEFAULT_STORE, help='Columnar feature store (.npz)')
+
+    extract_parser = commands.add_parser('extract', parents=[common], help='Measure feature vectors into the store')
+    extract_parser.add_argument('folders', nargs='*', default=DEFAULT_FOLDERS)
+    extract_parser.add_argument('--labels', default=None, help='CSV of image path (or file name) and label')
+    extract_parser.add_argument('--max-side', type=int, default=int(os.environ.get('FRUIT_ANALYSIS_MAX_SIDE', 1024)))
+    extract_parser.add_argument('--memory-mb', type=float, default=float(os.environ.get('FRUIT_ANALYSIS_MEMORY_MB', 96)))
+    extract_parser.add_argument('--max-polygons', type=int, default=int(os.environ.get('FRUIT_VALIDATOR_MAX_POLYGONS', 64)))
+
+    sweep_parser = commands.add_parser('sweep', parents=[common], help='Rank threshold configurations on the stored vectors')
+    sweep_parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUES',
+                              help='Values to sweep for one ROT_PARAMS entry (repeatable)')
+    sweep_parser.add_argument('--top', type=int, default=15)
+
+    args = parser.parse_args()
+    if args.command == 'extract':
+        extract(args)
+    else:
+        sweep(args)
+
+
+if __name__ == '__main__':
+    main()
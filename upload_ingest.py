@@ -0,0 +1,84 @@
+import hashlib
+import io
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+# Magic bytes of the formats OpenCV can decode for us
+IMAGE_SIGNATURES = [
+    ('jpeg', 0, b'\xff\xd8\xff'),
+    ('png', 0, b'\x89PNG\r\n\x1a\n'),
+    ('bmp', 0, b'BM'),
+    ('tiff', 0, b'II*\x00'),
+    ('tiff', 0, b'MM\x00*'),
+]
+
+SNIFF_BYTES = 12
+
+
+def sniff_image_type(header):
+    """Return the image format for the first bytes of a file, or None"""
+    if len(header) >= 12 and header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    for name, offset, signature in IMAGE_SIGNATURES:
+        if header[offset:offset + len(signature)] == signature:
+            return name
+    return None
+
+
+class HashingUploadBuffer(io.BytesIO):
+    """
+    In-memory upload container filled while the request body streams in
+    - SHA-256 is updated chunk by chunk, so the hash is ready when parsing ends
+    - Oversized payloads are rejected as soon as they cross max_bytes
+    - Non-image payloads are rejected from their first bytes
+    """
+
+    def __init__(self, max_bytes=None):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.image_type = None
+        self._sha256 = hashlib.sha256()
+        self._size = 0
+        self._header = b''
+
+    def write(self, data):
+        self._size += len(data)
+        if self.max_bytes is not None and self._size > self.max_bytes:
+            raise RequestEntityTooLarge('Image is larger than the upload limit')
+
+        if self.image_type is None:
+            self._header += bytes(data[:SNIFF_BYTES - len(self._header)])
+            if len(self._header) >= SNIFF_BYTES:
+                self._check_header()
+
+        self._sha256.update(data)
+        return super().write(data)
+
+    def _check_header(self):
+        self.image_type = sniff_image_type(self._header)
+        if self.image_type is None:
+            raise UnsupportedMediaType('Upload is not a supported image file')
+
+    def seek(self, pos, whence=0):
+        # The parser rewinds once the part is complete - tiny files never hit SNIFF_BYTES
+        if self.image_type is None and self._size:
+            self._check_header()
+        return super().seek(pos, whence)
+
+    @property
+    def size(self):
+        return self._size
+
+    def hexdigest(self):
+        """SHA-256 of everything written so far"""
+        return self._sha256.hexdigest()
+
+
+class IngestRequest(Request):
+    """Flask request that streams file uploads into HashingUploadBuffer instead of temp files"""
+
+    max_image_bytes = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingUploadBuffer(max_bytes=self.max_image_bytes)